@@ -3,14 +3,19 @@ import google.generativeai as genai
 import os
 import re
 import time
-import tempfile
 import pandas as pd
 from datetime import datetime, timedelta
 import database as db
+import ia
+import jobs
+import company_index
+import search_index  # Também mantém o índice de busca atualizado a cada gravação no histórico
+import llm
 import extra_streamlit_components as stx
 from io import BytesIO
 import random
 import base64 
+import hashlib
 
 # --- MAPA DE NOMES DE PLANOS (NOVOS REQUISITOS) ---
 PLAN_MAP = {
@@ -101,6 +106,16 @@ except:
 
 db.init_db()
 
+# --- WORKERS DA FILA DE JOBS ---
+# Rodam em threads do servidor, fora do script de cada sessão. Com URBANO_EXTERNAL_WORKERS=1
+# a fila é atendida por processos separados (python worker.py).
+@st.cache_resource
+def start_job_workers():
+    return jobs.start_workers(jobs.WORKERS)
+
+if os.environ.get("URBANO_EXTERNAL_WORKERS") != "1":
+    start_job_workers()
+
 # --- CSS LIMPO (A Guilhotina resolve o rodapé no HTML) ---
 st.markdown("""
     <style>
@@ -126,12 +141,7 @@ except:
     pass
 
 # --- ESTRUTURA DE DOCUMENTOS ---
-DOC_STRUCTURE = {
-    "1. Habilitacao Juridica": ["Contrato Social", "CNPJ", "Documentos Sócios"],
-    "2. Habilitacao Fiscal": ["Federal", "Estadual", "Municipal", "FGTS", "Trabalhista"],
-    "3. Qualificacao Tecnica": ["Atestados Operacionais", "Atestados Profissionais", "Certidao de Registro no Conselho - Profissionais", "Certidao de Registro no Conselho - Empresa"],
-    "4. Habilitacao Financeira": ["Balanco Patrimonial", "Indices Financeiros", "Certidao Falencia"]
-}
+DOC_STRUCTURE = company_index.DOC_STRUCTURE  # Também usada no roteamento do cruzamento (company_index.py)
 
 # --- FUNÇÕES AUXILIARES ---
 
@@ -165,27 +175,45 @@ def convert_to_pdf(source_md):
     if pisa_status.err: return None
     return result_file.getvalue()
 
-def extract_title(text):
+PDF_RENDER_VERSION = "p1"  # Incremente ao mudar o estilo do PDF: os PDFs guardados são refeitos
+PDF_CACHE_ENTRIES = 64
+
+class PdfRenderError(Exception):
+    pass
+
+@st.cache_data(max_entries=PDF_CACHE_ENTRIES, show_spinner=False)
+def _cached_report_pdf(source_md, username, doc_id):
+    key = hashlib.sha256(f"{PDF_RENDER_VERSION}|{source_md}".encode('utf-8')).hexdigest()
+    pdf = db.get_rendered_pdf(username, doc_id, key) if doc_id else None
+    if pdf is None:
+        pdf = convert_to_pdf(source_md)
+        if not pdf: raise PdfRenderError()  # Exceções não entram no cache: a próxima tentativa renderiza de novo
+        if doc_id: db.save_rendered_pdf(username, doc_id, key, pdf)
+    return pdf
+
+def get_report_pdf(source_md, username=None, doc_id=None):
+    """
+    PDF do relatório, reaproveitado enquanto o texto não muda (LRU em memória + cópia no Storage sob o item
+    doc_id, apagada com ele). Sem doc_id, só o cache em memória. Retorna None se a renderização falhar.
+    """
     try:
-        orgao = "Órgão Indefinido"
-        match_orgao = re.search(r"(?:1\.|órgão).*?[:\-\?]\s*(.*?)(?:\n|2\.|Qual|$)", text, re.IGNORECASE)
-        if match_orgao: 
-            orgao = match_orgao.group(1).replace("*", "").strip()
+        return _cached_report_pdf(source_md, username, doc_id)
+    except PdfRenderError:
+        return None
 
-        data_sessao = "Data Pendente"
-        match_data_tag = re.search(r"DATA_CHAVE:\s*(\d{2}/\d{2}/\d{4})", text)
-        
-        if match_data_tag:
-            data_sessao = match_data_tag.group(1)
-        else:
-            match_q5 = re.search(r"5\.(.*?)(?:6\.|CRONOGRAMA|\n\n|$)", text, re.DOTALL | re.IGNORECASE)
-            if match_q5:
-                match_generic = re.search(r"(\d{2}/\d{2}/\d{4})", match_q5.group(1))
-                if match_generic: data_sessao = match_generic.group(1)
+def session_date_str(item):
+    return item['session_date'].strftime("%d/%m/%Y") if item.get('session_date') else "Data Pendente"
 
-        return f"Edital {orgao} | {data_sessao}"
-    except:
-        return f"Edital Processado em {datetime.now().strftime('%d/%m/%Y')}"
+def history_title(item):
+    """Título do item a partir dos campos de resumo da listagem (sem ler o texto da análise)."""
+    if item.get('orgao'): return f"Edital {item['orgao']} | {session_date_str(item)}"
+    return item.get('title') or "Edital"
+
+def render_viability_plan(plan_md):
+    """Plano de envio do cruzamento (o que foi à IA por exigência): só na tela, fora do relatório e do PDF."""
+    if plan_md:
+        with st.expander("📦 Documentos da empresa usados no cruzamento"):
+            st.markdown(plan_md)
 
 def extract_date_for_calendar(title_str):
     try:
@@ -574,8 +602,10 @@ if query_params.get("status") == "approved" and query_params.get("payment_id"):
                 st.error("Erro ao validar pagamento. Entre em contato com o suporte.")
 if 'analise_atual' not in st.session_state: st.session_state.analise_atual = None
 if 'chat_history' not in st.session_state: st.session_state.chat_history = []
+if 'chat_memory' not in st.session_state: st.session_state.chat_memory = ia.new_chat_memory()
 if 'gemini_files_handles' not in st.session_state: st.session_state.gemini_files_handles = []
 if 'last_analysis_id' not in st.session_state: st.session_state.last_analysis_id = None
+if 'viability_plan' not in st.session_state: st.session_state.viability_plan = None
 
 fresh = db.get_user_by_username(user['username'])
 if fresh: 
@@ -708,6 +738,26 @@ if menu == "Admin":
         
         st.divider()
 
+        # --- SEÇÃO: AÇÕES EM LOTE (uma gravação em lote em vez de uma por usuário) ---
+        with st.expander("⚡ Ações em Lote"):
+            bulk_users = st.multiselect("Usuários", df_active['username'].tolist(), key="bulk_users")
+            bulk_plan = st.selectbox("Novo plano", valid_plans, format_func=lambda x: PLAN_MAP.get(x, x), key="bulk_plan")
+            b1, b2 = st.columns(2)
+            bulk_changes = None
+            if b1.button("Aplicar plano", disabled=not bulk_users):
+                fields = {'plan_type': bulk_plan}
+                if bulk_plan == 'unlimited_30': fields['plan_expires_at'] = datetime.now() + timedelta(days=30)
+                bulk_changes = {u: fields for u in bulk_users}
+            if b2.button("Zerar créditos usados", disabled=not bulk_users):
+                bulk_changes = {u: {'credits_used': 0} for u in bulk_users}
+            if bulk_changes:
+                with st.spinner("Gravando..."):
+                    bulk_res = db.admin_update_users(bulk_changes)
+                failed_users = [u for u, ok in bulk_res.items() if not ok]
+                if failed_users: st.error(f"Falha em: {', '.join(failed_users)}")
+                if len(failed_users) < len(bulk_res):
+                    st.success(f"{len(bulk_res) - len(failed_users)} usuário(s) atualizados!"); time.sleep(1); st.rerun()
+
         # --- SEÇÃO: BASE DE USUÁRIOS ATIVOS ---
         st.subheader(f"👥 Base de Usuários Ativos ({len(df_active)})")
         
@@ -830,6 +880,26 @@ if menu == "Admin":
                         time.sleep(1)
                         st.rerun()         
 
+    # --- MIGRAÇÃO: CAMPOS DE RESUMO DO HISTÓRICO ---
+    st.divider()
+    st.subheader("🧱 Migração do Histórico")
+    st.caption("Grava órgão, objeto, data da sessão, hora e plataforma nas análises antigas (listagens e calendário passam a ler só esses campos).")
+    mig_jobs = jobs.get_user_jobs(user['username'], kind='summary_backfill', unseen_only=False)
+    mig_job = mig_jobs[0] if mig_jobs else None
+    if mig_job and mig_job['status'] in jobs.ACTIVE:
+        st.progress(min(max(mig_job['progress'] or 0.0, 0.0), 1.0), text=mig_job['message'] or "Na fila...")
+        if st.button("🔄 Atualizar andamento", key="mig_refresh"): st.rerun()
+    else:
+        if mig_job and mig_job['status'] == 'done':
+            res = mig_job['result'] or {}
+            st.success(f"Última migração: {res.get('updated', 0)} itens atualizados, {res.get('skipped', 0)} já em dia, "
+                       f"{res.get('errors', 0)} usuário(s) com erro.")
+        elif mig_job and mig_job['error']:
+            st.error(f"Erro na última migração: {mig_job['error']}")
+        if st.button("🧱 Migrar campos de resumo"):
+            jobs.submit_job('summary_backfill', user['username'], {}, timeout=6 * 3600)
+            st.rerun()
+
 # 2. DOCUMENTOS
 elif menu == "📂 Documentos da Empresa":
     st.title("📂 Acervo Digital")
@@ -893,10 +963,51 @@ elif menu == "Análise de Editais":
             st.session_state.analise_atual = None
             st.session_state.gemini_files_handles = []
             st.session_state.chat_history = []
+            st.session_state.chat_memory = ia.new_chat_memory()
             st.session_state.last_analysis_id = None
+            st.session_state.viability_plan = None
+            st.session_state.prep_stats = None
+            st.session_state.analise_dados = None
             st.rerun()
     
     if not st.session_state.analise_atual:
+        # Análise em andamento (ou concluída) na fila de jobs: sobrevive a refresh e queda de conexão.
+        # Jobs presos são encerrados aqui também, para o crédito voltar mesmo sem nenhum worker ativo.
+        jobs.expire_stale_jobs()
+        pending_jobs = jobs.get_user_jobs(user['username'], kind='analysis')
+        if pending_jobs:
+            job = pending_jobs[0]
+            if job['status'] in jobs.ACTIVE:
+                st.info("⏳ Sua auditoria está sendo processada. Você pode atualizar a página sem perder o andamento.")
+                st.progress(min(max(job['progress'] or 0.0, 0.0), 1.0), text=job['message'] or "Na fila...")
+                if st.button("✖️ Cancelar Análise"):
+                    jobs.cancel_job(job['id'])
+                    st.rerun()
+                if job['partial']:
+                    st.markdown(job['partial'])
+                time.sleep(1.5)
+                st.rerun()
+            elif job['status'] == 'done':
+                item = db.get_history_item(user['username'], job['result']['doc_id'])
+                jobs.mark_job_seen(job['id'])
+                if item:
+                    st.session_state.analise_atual = item['content']
+                    st.session_state.analise_dados = item.get('dados')
+                    st.session_state.last_analysis_id = job['result']['doc_id']
+                    st.session_state.gemini_files_handles = ia.get_file_handles(job['result'].get('file_names', []))
+                    st.session_state.chat_history = []
+                    st.session_state.chat_memory = ia.new_chat_memory()
+                    st.session_state.prep_stats = job['result'].get('prep_stats')
+                    st.rerun()
+            else:
+                if job.get('refunded'):
+                    st.error(f"Erro: {job['error']} Crédito devolvido.")
+                else:
+                    st.error(f"Erro: {job['error']} Confira o Histórico antes de tentar de novo.")
+                if st.button("OK"):
+                    jobs.mark_job_seen(job['id'])
+                    st.rerun()
+
         if user['credits'] >= limit: st.warning("Limite atingido."); st.stop()
         
         st.markdown("""
@@ -948,58 +1059,38 @@ elif menu == "Análise de Editais":
                     valid_files.append(up)
             ups = valid_files
 
+        slim = st.checkbox("🗜️ Otimizar PDFs digitalizados antes do envio", value=ia.SLIM_PDFS,
+                           help="Reduz a resolução de imagens pesadas e remove recursos duplicados. Acelera o envio e evita falhas por tamanho.")
+        sectional = st.checkbox("⚡ Gerar seções em paralelo", value=ia.ANALYSIS_MODE == "sectional",
+                                help="Relatório pronto mais rápido, mas cada seção reenvia os arquivos: cerca de 4x mais tokens de entrada.")
+        mode = "sectional" if sectional else "single"
+        if ups:
+            # Pré-checagem local: páginas, tokens, imagens pesadas, tempo e custo estimados
+            with st.spinner("Verificando arquivos..."):
+                pre = ia.preflight([(up.name, up.getvalue()) for up in ups], slim=slim, mode=mode)
+            st.caption(ia.format_preflight(pre))
+            for w in pre['warnings']: st.warning(w)
+
         if ups and st.button("🚀 Iniciar Auditoria IA"):
-            with st.status("Processando...", expanded=True) as status:
+            if any(j['status'] in jobs.ACTIVE for j in pending_jobs):
+                st.warning("Já existe uma análise em andamento.")
+            elif not db.consume_credit_atomic(user['username']):
+                st.error("Erro crédito")
+            else:
+                # Qualquer falha daqui até o job entrar na fila (ou o item ser gravado) devolve o crédito
                 try:
-                    status.write("Validando plano...")
-                    if not db.consume_credit_atomic(user['username']): st.error("Erro crédito"); st.stop()
-                    
-                    status.write(f"Lendo {len(ups)} arquivos...")
-                    files_ai = []; temps = []
-                    for up in ups:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                            tmp.write(up.getvalue()); tmp_path = tmp.name; temps.append(tmp_path)
-                        files_ai.append(genai.upload_file(tmp_path, display_name=up.name))
-                    st.session_state.gemini_files_handles = files_ai
-                    
-                    status.write("Gerando Relatório Detalhado...")
-                    model = genai.GenerativeModel('gemini-pro-latest')
-                    
-                    prompt = """
-                    ATUE COMO AUDITOR SÊNIOR DE ENGENHARIA.
-                    Analise TODOS os documentos fornecidos (Edital e Anexos) com extremo rigor.
-                    Responda pontualmente às 16 questões abaixo. Use Markdown para formatar.
-
-                    1. Qual o nome do órgão contratante?
-                    2. Qual o objeto do edital? (Resumo completo)
-                    3. Qual o valor estimado para a realização dos serviços?
-                    4. Qual a plataforma onde será realizado o certame?
-                    5. Qual a data de realização do certame? (Inicie sua resposta EXATAMENTE com "DATA_CHAVE: DD/MM/YYYY". Se não houver sessão física, coloque a data limite de propostas neste formato).
-                    6. **CRONOGRAMA**: Datas e Prazos.
-                    7. **HABILITAÇÃO JURÍDICA/FISCAL**: Exigências.
-                    8. **FINANCEIRO**: Índices (LG, SG, LC) e valores.
-                    9. Quais as exigências para qualificação técnica deste certame? (Esmiuce com detalhes, incluindo apresentação de declarações e demais documentos exigidos)
-                    10. Elenque TODOS os profissionais exigidos pelo edital e também a experiência necessária.
-                    11. Não oculte nenhuma exigência técnica, por mais simples que pareça.
-                    12. É exigida algum tipo de garantia? Se sim, quais?
-                    13. Qual o entendimento do edital acerca de propostas com descontos acima de 25% do valor global?
-                    14. Qual o formato e o período destinado para a fase de lances?
-                    15. O que o edital versa sobre identificação da empresa no envio da documentação ou proposta?
-                    16. Analise os riscos envolvidos na participação da empresa nesse serviço.
-                    """
-                    resp = model.generate_content(files_ai + [prompt])
-                    st.session_state.analise_atual = resp.text
-                    
-                    title = extract_title(resp.text)
-                    new_doc_id = db.save_analysis_history(user['username'], title, resp.text)
-                    st.session_state.last_analysis_id = new_doc_id
-                    
-                    status.update(label="Pronto!", state="complete", expanded=False)
-                    for p in temps: os.remove(p)
-                    st.rerun()
+                    # O processamento roda nos workers; a página apenas acompanha o job. Edital já analisado
+                    # (mesmos arquivos, prompt e modelo) também vai para o job, que mostra o relatório do cache na
+                    # hora e faz a extração de texto e o índice do chat fora do script da página
+                    jobs.submit_job('analysis', user['username'],
+                                    {'prompt_version': ia.PROMPT_VERSION, 'mode': mode, 'slim': slim, 'charged': True},
+                                    files=[(up.name, up.getvalue()) for up in ups])
+                    started = True
                 except Exception as e:
+                    started = False
                     db.refund_credit_atomic(user['username'])
                     st.error(f"Erro: {e}. Crédito devolvido.")
+                if started: st.rerun()
     else:
         if st.session_state.last_analysis_id:
             st.info("Classifique este edital para organizá-lo no Histórico e Calendário:")
@@ -1008,42 +1099,41 @@ elif menu == "Análise de Editais":
                 render_status_controls(st.session_state.last_analysis_id, curr_item.get('status'), curr_item.get('note', ''))
             st.divider()
 
+        if st.session_state.get('prep_stats'):
+            st.caption(ia.format_savings(st.session_state.prep_stats))
         st.markdown(st.session_state.analise_atual)
+        render_viability_plan(st.session_state.viability_plan)
         st.divider()
         
         st.subheader("🚀 Cruzamento de Dados")
         if user['plan'] == 'free': st.info("🔒 Upgrade necessário.")
         else:
             if st.button("Verificar Minha Viabilidade"):
-                with st.spinner("Enviando documentos da empresa para a IA (Leitura Nativa/Visual)..."):
-                    c_files = db.get_all_company_files_as_bytes(user['username'])
+                with st.spinner("Preparando o acervo da empresa (resumos e trechos relevantes)..."):
+                    upload_box = st.empty()
+                    company_parts, company_stats = ia.prepare_company_context(
+                        user['username'], st.session_state.analise_atual, st.session_state.get('analise_dados'),
+                        on_progress=lambda sent, total, name: upload_box.caption(f"📤 {sent}/{total} digitalizado(s) enviados: {name}"))
+                    upload_box.empty()
                     
-                    if not c_files: 
+                    if not company_stats['docs']: 
                         st.warning("Sem documentos na pasta da empresa.")
                     else:
-                        local_paths = []
-                        company_ai_files = []
-                        
                         try:
                             # --- ALTERAÇÃO AQUI: Captura o nome da empresa ---
                             nome_empresa = user.get('company_name', 'Empresa Licitante')
 
-                            for n, d in c_files:
-                                with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as t:
-                                    t.write(d)
-                                    local_paths.append(t.name)
-                                
-                                ai_file = genai.upload_file(t.name, display_name=n)
-                                company_ai_files.append(ai_file)
+                            st.caption(ia.format_company_context(company_stats))
                             
-                            all_files = st.session_state.gemini_files_handles + company_ai_files
+                            all_files = st.session_state.gemini_files_handles + company_parts
                             
                             # --- ALTERAÇÃO AQUI: Prompt atualizado com o nome da empresa ---
                             prompt_cross = f"""
                             ATUE COMO AUDITOR SÊNIOR E ESPECIALISTA EM ANÁLISE DOCUMENTAL DE ENGENHARIA.
                             
                             CONTEXTO:
-                            Você possui acesso aos arquivos do EDITAL (primeiros arquivos) e aos arquivos da EMPRESA (últimos arquivos carregados).
+                            Você possui acesso aos arquivos do EDITAL (primeiros arquivos) e ao ACERVO DA EMPRESA (resumo de cada documento,
+                            trechos relevantes para este edital e, ao final, os documentos digitalizados em PDF).
                             Utilize visão computacional para ler documentos digitalizados/imagens.
                             
                             ⚠️ DADOS CRITICOS DA ANÁLISE:
@@ -1052,6 +1142,7 @@ elif menu == "Análise de Editais":
                             DIRETRIZES GERAIS:
                             1. LEITURA EXAUSTIVA: Analise TODOS os documentos fornecidos.
                             2. FLEXIBILIDADE TÉCNICA: Aceite serviços similares/correlatos (não exija literalidade).
+                            3. PRÉ-AVALIAÇÃO TÉCNICA: Havendo a pré-avaliação local dos atestados/CATs, use seus status e evidências como base e apenas redija o parecer.
                             
                             ESTRUTURA DA RESPOSTA OBRIGATÓRIA (Siga esta ordem):
                             
@@ -1077,33 +1168,39 @@ elif menu == "Análise de Editais":
                             5. **PARECER FINAL DE VIABILIDADE**
                             """
                             
-                            model = genai.GenerativeModel('gemini-pro-latest')
-                            resp = model.generate_content(all_files + [prompt_cross])
+                            resp_text = llm.get_backend().generate(all_files + [prompt_cross])
                             
-                            st.session_state.analise_atual += "\n\n---\n\n# 🛡️ VIABILIDADE (Análise IA Visual)\n" + resp.text
+                            st.session_state.analise_atual += "\n\n---\n\n# 🛡️ VIABILIDADE (Análise IA Visual)\n" + resp_text
+                            st.session_state.viability_plan = ia.format_company_plan(company_stats)
                             st.rerun()
                             
                         except Exception as e:
                             st.error(f"Erro no processamento IA: {e}")
-                        finally:
-                            for p in local_paths:
-                                if os.path.exists(p): os.remove(p)
         
         st.divider()
         st.subheader("💬 Chat")
         for r, t in st.session_state.chat_history:
             with st.chat_message(r): st.markdown(t)
+        chat_budget = db.get_chat_memory_budget(user['plan'])
         if q := st.chat_input("Dúvida?"):
+            prior_turns = list(st.session_state.chat_history)
             st.session_state.chat_history.append(("user", q))
             with st.chat_message("user"): st.markdown(q)
             with st.chat_message("assistant"):
-                with st.spinner("..."):
-                    try:
-                        m = genai.GenerativeModel('gemini-pro-latest')
-                        res = m.generate_content(st.session_state.gemini_files_handles + [f"Responda baseado no edital: {q}"])
-                        st.markdown(res.text)
-                        st.session_state.chat_history.append(("assistant", res.text))
-                    except: st.error("Erro IA.")
+                box = st.empty()
+                try:
+                    # Conversa gravada no item do histórico; arquivos e relatório ficam no cache de contexto
+                    answer = ""
+                    for piece in ia.chat_stream(user['username'], st.session_state.last_analysis_id, st.session_state.analise_atual,
+                                                prior_turns, q, handles=st.session_state.gemini_files_handles,
+                                                memory=st.session_state.chat_memory, budget=chat_budget):
+                        answer += piece
+                        box.markdown(answer + "▌")
+                    box.markdown(answer)
+                    st.session_state.chat_history.append(("assistant", answer))
+                except:
+                    st.session_state.chat_history.pop()  # Pergunta sem resposta não fica na conversa
+                    box.error("Erro IA.")
 
         st.divider()
         if st.button("📄 Baixar PDF Completo"):
@@ -1114,24 +1211,74 @@ elif menu == "Análise de Editais":
                     for r, t in st.session_state.chat_history:
                         content += f"<p class='chat-q'>{r.upper()}: {t}</p>"
                     content += "</div>"
-                pdf = convert_to_pdf(content)
+                pdf = get_report_pdf(content, user['username'], st.session_state.last_analysis_id)
                 if pdf: st.download_button("⬇️ Download PDF", data=pdf, file_name=f"Analise_{datetime.now().strftime('%Y%m%d')}.pdf", mime="application/pdf")
                 else: st.error("Erro PDF.")
 
 # 4. HISTÓRICO
 elif menu == "📜 Histórico":
     st.title("Biblioteca de Análises")
-    lst = db.get_user_history_list(user['username'])
+    # Nova busca ou exclusão volta à primeira página (os cursores guardados não valem mais)
+    reset_pages = lambda: st.session_state.update(hist_cursors=[None])
+    busca = st.text_input("🔎 Buscar nas análises", placeholder="Ex.: prefeitura pavimentação", key="hist_search",
+                          on_change=reset_pages).strip()
+    if 'hist_cursors' not in st.session_state: reset_pages()
+    if busca:
+        # Índice invertido local: só os itens encontrados são lidos do banco
+        lst, next_cursor = db.get_history_summaries_by_ids(user['username'], search_index.search(user['username'], busca)), None
+        st.caption(f"{len(lst)} análise(s) encontrada(s).")
+    else:
+        # Paginação por cursor: cada rerun lê só os campos de resumo de uma página
+        lst, next_cursor = db.get_user_history_page(user['username'], cursor=st.session_state.hist_cursors[-1])
+        if not lst and len(st.session_state.hist_cursors) > 1:
+            st.session_state.hist_cursors.pop(); st.rerun()  # Página esvaziada por exclusões
     
     if not lst: 
-        st.info("Vazio.")
+        st.info("Nenhuma análise encontrada." if busca else "Vazio.")
     else:
+        # Cruzamento em lote: roda na fila de jobs, com o acervo preparado uma única vez
+        bulk_jobs = jobs.get_user_jobs(user['username'], kind='viability_bulk')
+        if bulk_jobs:
+            bjob = bulk_jobs[0]
+            if bjob['status'] in jobs.ACTIVE:
+                st.info("⏳ Cruzamento em lote em andamento. Você pode continuar navegando.")
+                st.progress(min(max(bjob['progress'] or 0.0, 0.0), 1.0), text=bjob['message'] or "Na fila...")
+                c_upd, c_can = st.columns(2)
+                if c_upd.button("🔄 Atualizar andamento"): st.rerun()
+                if c_can.button("✖️ Cancelar Lote"):
+                    jobs.cancel_job(bjob['id']); st.rerun()
+            elif bjob['status'] == 'done':
+                res = bjob['result'] or {}
+                st.success(f"Cruzamento em lote concluído: {len(res.get('done', []))} edital(is) atualizados.")
+                titles = {i['id']: history_title(i) for i in lst}
+                for f in res.get('failed', []):
+                    st.error(f"❌ {titles.get(f['id'], f['id'])}: {f['error']}")
+                if st.button("OK", key="bulk_ok"):
+                    jobs.mark_job_seen(bjob['id']); st.rerun()
+            else:
+                st.error(f"Erro no cruzamento em lote: {bjob['error']}")
+                if st.button("OK", key="bulk_err_ok"):
+                    jobs.mark_job_seen(bjob['id']); st.rerun()
+
+        if user['plan'] != 'free':
+            with st.expander("🛡️ Cruzar Dados em Lote"):
+                st.caption("Selecione os editais desta página: os documentos da empresa são preparados uma vez e os cruzamentos rodam em paralelo.")
+                options = {i['id']: history_title(i) for i in lst}
+                default_ids = [i['id'] for i in lst if i.get('status') == 'green' and not i.get('has_viability')]
+                sel_ids = st.multiselect("Editais", list(options), default=default_ids, format_func=lambda k: options[k])
+                busy = any(j['status'] in jobs.ACTIVE for j in bulk_jobs)
+                if st.button(f"🚀 Cruzar {len(sel_ids)} edital(is)", disabled=busy or not sel_ids):
+                    jobs.submit_job('viability_bulk', user['username'],
+                                    {'ids': sel_ids, 'company_name': user.get('company_name', 'Empresa Licitante')},
+                                    timeout=jobs.JOB_TIMEOUT_SECONDS + 120 * len(sel_ids))  # ~2 min a mais por edital
+                    st.rerun()
+
         with st.expander("🗑️ Gerenciar / Excluir Vários"):
-            st.caption("Selecione os itens que deseja excluir permanentemente e clique no botão abaixo.")
+            st.caption("Selecione os itens desta página que deseja excluir permanentemente e clique no botão abaixo.")
             
             table_data = []
             for item in lst:
-                raw_t = extract_title(item['content'])
+                raw_t = history_title(item)
                 d_str = item['created_at'].strftime("%d/%m/%Y")
                 table_data.append({"id": item['id'], "Excluir": False, "Data": d_str, "Título": raw_t})
             
@@ -1150,59 +1297,27 @@ elif menu == "📜 Histórico":
             if st.button("🗑️ Excluir Selecionados", type="primary"):
                 selected_rows = edited_df[edited_df["Excluir"] == True]
                 if not selected_rows.empty:
-                    count_del = 0
                     with st.spinner("Excluindo itens..."):
-                        for index, row in selected_rows.iterrows():
-                            if db.delete_history_item(user['username'], row['id']): count_del += 1
+                        del_results = db.delete_history_items(user['username'], selected_rows['id'].tolist())
+                    count_del = sum(1 for ok in del_results.values() if ok)
+                    if count_del < len(del_results):
+                        st.error(f"{len(del_results) - count_del} análise(s) não puderam ser excluídas. Tente novamente.")
                     if count_del > 0:
+                        reset_pages()
                         st.success(f"{count_del} análises excluídas!"); time.sleep(1); st.rerun()
                 else: st.warning("Nenhum item selecionado.")
         
         st.divider()
 
     for item in lst:
-        chat_key = f"hist_chat_{item['id']}"
-        if chat_key not in st.session_state: st.session_state[chat_key] = []
-        
         dt_consulta = item['created_at'].strftime("%d/%m/%Y")
-        content_txt = item['content']
-        
-        orgao = "Órgão Indefinido"
-        try:
-            if "1." in content_txt and "2." in content_txt:
-                part_org = content_txt.split("1.")[1].split("2.")[0]
-                part_org = part_org.replace("Qual o nome do órgão contratante?", "").replace("Nome do órgão", "").strip()
-                orgao = part_org.replace("*", "").replace("#", "").strip()[:60]
-        except:
-            pass 
-        
-        objeto_edital = "Objeto Indefinido"
-        try:
-            if "2." in content_txt and "3." in content_txt:
-                raw_chunk = content_txt.split("2.")[1].split("3.")[0]
-                garbage = [
-                    "Qual o objeto do edital?", 
-                    "(Resumo completo)", 
-                    "Objeto:", 
-                    "**", 
-                    "##",
-                    "Resumo:",
-                    "Trata-se de"
-                ]
-                clean_chunk = raw_chunk
-                for g in garbage:
-                    clean_chunk = clean_chunk.replace(g, "")
-                clean_chunk = clean_chunk.strip().lstrip(":- ").strip()
-                if len(clean_chunk) > 3:
-                    objeto_edital = (clean_chunk[:150] + '...') if len(clean_chunk) > 150 else clean_chunk
-        except:
-            match_obj = re.search(r"objeto.*?[:\-\?]\s*(.*?)(?:\n|$)", content_txt, re.IGNORECASE)
-            if match_obj: objeto_edital = match_obj.group(1)[:50]
-
-        match_sessao = re.search(r"DATA_CHAVE:\s*(\d{2}/\d{2}/\d{4})", content_txt)
-        dt_sessao = match_sessao.group(1) if match_sessao else "Data Pendente"
-
-        full_display_title = f"{dt_consulta} | Edital | {orgao} | {objeto_edital} | {dt_sessao}"
+        # Só campos de resumo (gravados na análise): o texto é lido ao abrir o item
+        if item.get('summary_version') or item.get('orgao'):
+            objeto = item.get('objeto') or "Objeto Indefinido"
+            objeto_edital = (objeto[:150] + '...') if len(objeto) > 150 else objeto
+            full_display_title = f"{dt_consulta} | Edital | {(item.get('orgao') or 'Órgão Indefinido')[:60]} | {objeto_edital} | {session_date_str(item)}"
+        else:
+            full_display_title = f"{dt_consulta} | {item.get('title') or 'Edital'}"
         
         status = item.get('status')
         if status == 'red': full_display_title = f":red[{full_display_title}]"
@@ -1211,6 +1326,22 @@ elif menu == "📜 Histórico":
         
         with st.expander(full_display_title):
             render_status_controls(item['id'], status, item.get('note', ''))
+
+            open_key = f"hist_open_{item['id']}"
+            if not st.session_state.get(open_key):
+                if st.button("📖 Abrir análise", key=f"open_{item['id']}"):
+                    st.session_state[open_key] = True; st.rerun()
+                continue
+            full_item = db.get_history_item(user['username'], item['id'])
+            if not full_item:
+                st.error("Análise não encontrada."); continue
+            item = {'id': item['id'], **full_item}
+            content_txt = item['content']
+
+            chat_key = f"hist_chat_{item['id']}"
+            if chat_key not in st.session_state:
+                st.session_state[chat_key] = db.get_chat_messages(user['username'], item['id']) if item.get('chat_count') else []
+                st.session_state[f"hist_mem_{item['id']}"] = ia.new_chat_memory(item.get('chat_memory'))
             
             st.info("🧠 Inteligência Artificial")
             col_ia_btn, col_ia_info = st.columns([0.4, 0.6])
@@ -1223,95 +1354,71 @@ elif menu == "📜 Histórico":
                     if user['plan'] == 'free':
                         st.warning("Recurso exclusivo para assinantes.")
                     else:
-                        with st.spinner("Baixando documentos e analisando compatibilidade..."):
-                            c_files = db.get_all_company_files_as_bytes(user['username'])
-                            if not c_files:
-                                st.error("Você não tem documentos na pasta da empresa.")
-                            else:
-                                try:
-                                    # --- ALTERAÇÃO AQUI: Captura o nome da empresa ---
-                                    nome_empresa = user.get('company_name', 'Empresa Licitante')
-
-                                    temps = []
-                                    gemini_files = []
-                                    for n, d in c_files:
-                                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as t:
-                                            t.write(d); tp = t.name
-                                        temps.append(tp)
-                                        gemini_files.append(genai.upload_file(tp, display_name=n))
-                                    
-                                    # --- ALTERAÇÃO AQUI: Prompt atualizado ---
-                                    prompt_hist = f"""
-                                    ATUE COMO AUDITOR SÊNIOR DE ENGENHARIA. 
-                                    Compare os documentos anexados da empresa com o seguinte resumo de edital:
-                                    
-                                    --- INÍCIO RESUMO EDITAL ---
-                                    {content_txt}
-                                    --- FIM RESUMO EDITAL ---
-                                    
-                                    ⚠️ DADOS DA EMPRESA PARA VALIDAÇÃO:
-                                    Nome/Razão Social: "{nome_empresa}"
-
-                                    DIRETRIZES:
-                                    1. Analise TODOS os documentos.
-                                    2. Aplique FLEXIBILIDADE TÉCNICA (serviços similares são aceitos).
-                                    
-                                    TAREFA: Gere um Checklist de Viabilidade separado nas seguintes categorias OBRIGATÓRIAS:
-                                    
-                                    A) QUALIFICAÇÃO TÉCNICA OPERACIONAL (EMPRESA)
-                                    - Verifique se a EMPRESA "{nome_empresa}" (PJ) possui os atestados exigidos.
-                                    - Ignore atestados em nome de terceiros para esta qualificação.
-                                    - Item do Edital -> Documento da Empresa -> Veredito.
-                                    
-                                    B) QUALIFICAÇÃO TÉCNICA PROFISSIONAL (EQUIPE)
-                                    - Verifique se o PROFISSIONAL (PF) possui as CATs/Atestados exigidos.
-                                    - Item do Edital -> Documento do Profissional -> Veredito.
-                                    
-                                    C) DEMAIS HABILITAÇÕES (Jurídica, Fiscal, Financeira)
-                                    - Verifique as demais exigências.
-                                    """
-                                    model = genai.GenerativeModel('gemini-pro-latest')
-                                    resp = model.generate_content(gemini_files + [prompt_hist])
-                                    
-                                    new_content = content_txt + "\n\n---\n\n# 🛡️ VIABILIDADE (Gerada via Histórico)\n" + resp.text
-                                    db.db.collection('users').document(user['username']).collection('history').document(item['id']).update({
-                                        'content': new_content
-                                    })
-                                    
-                                    for tp in temps: os.remove(tp)
+                        with st.spinner("Preparando o acervo da empresa e analisando compatibilidade..."):
+                            try:
+                                # --- ALTERAÇÃO AQUI: Captura o nome da empresa ---
+                                nome_empresa = user.get('company_name', 'Empresa Licitante')
+                                company_docs = ia.load_company_docs(user['username'])
+                                if not company_docs[0]:
+                                    st.error("Você não tem documentos na pasta da empresa.")
+                                else:
+                                    _, company_stats = ia.run_viability(user['username'], item, nome_empresa, company_docs)
+                                    st.caption(ia.format_company_context(company_stats))
                                     st.success("Análise de viabilidade adicionada ao registro!")
                                     time.sleep(1.5); st.rerun()
                                     
-                                except Exception as e:
-                                    st.error(f"Erro na análise IA: {e}")
+                            except Exception as e:
+                                st.error(f"Erro na análise IA: {e}")
 
             st.divider()
             
             st.markdown(item['content'])
+            render_viability_plan(item.get('viability_plan'))
             
             c1, c2 = st.columns([0.8, 0.2])
             with c1:
-                pdf = convert_to_pdf(item['content'])
-                if pdf: st.download_button("📄 PDF", data=pdf, file_name=f"Relatorio_{item['id'][:6]}.pdf")
+                # Gerado só a pedido (e reaproveitado): renderizar todos os itens a cada rerun travava a página
+                if st.button("📄 Gerar PDF", key=f"pdf_{item['id']}"):
+                    with st.spinner("Gerando PDF..."):
+                        pdf = get_report_pdf(item['content'], user['username'], item['id'])
+                    if pdf: st.download_button("⬇️ Baixar PDF", data=pdf, file_name=f"Relatorio_{item['id'][:6]}.pdf", key=f"dl_{item['id']}")
+                    else: st.error("Erro PDF.")
             with c2:
                 if st.button("🗑️", key=f"d_{item['id']}"):
-                    db.delete_history_item(user['username'], item['id']); st.rerun()
+                    db.delete_history_item(user['username'], item['id']); reset_pages(); st.rerun()
             
             st.markdown("---")
             st.subheader("💬 Dúvidas (Histórico)")
             for r, t in st.session_state[chat_key]:
                 with st.chat_message(r): st.markdown(t)
             if q := st.chat_input("Pergunta sobre este edital...", key=f"in_{item['id']}"):
+                prior_turns = list(st.session_state[chat_key])
                 st.session_state[chat_key].append(("user", q))
                 with st.chat_message("user"): st.markdown(q)
                 with st.chat_message("assistant"):
-                    with st.spinner("..."):
-                        try:
-                            m = genai.GenerativeModel('gemini-pro-latest')
-                            res = m.generate_content(f"Contexto do Edital: {item['content']}\nPergunta do Usuário: {q}")
-                            st.markdown(res.text)
-                            st.session_state[chat_key].append(("assistant", res.text))
-                        except: st.error("Erro na resposta IA.")
+                    box = st.empty()
+                    try:
+                        answer = ""
+                        for piece in ia.chat_stream(user['username'], item['id'], item['content'], prior_turns, q,
+                                                    stored_cache=item.get('chat_cache'),
+                                                    memory=st.session_state[f"hist_mem_{item['id']}"],
+                                                    budget=db.get_chat_memory_budget(user['plan'])):
+                            answer += piece
+                            box.markdown(answer + "▌")
+                        box.markdown(answer)
+                        st.session_state[chat_key].append(("assistant", answer))
+                    except:
+                        st.session_state[chat_key].pop()  # Pergunta sem resposta não fica na conversa
+                        box.error("Erro na resposta IA.")
+
+    if not busca and (len(st.session_state.hist_cursors) > 1 or next_cursor is not None):
+        st.divider()
+        c_prev, c_page, c_next = st.columns([0.3, 0.4, 0.3])
+        if c_prev.button("⬅️ Mais recentes", disabled=len(st.session_state.hist_cursors) == 1):
+            st.session_state.hist_cursors.pop(); st.rerun()
+        c_page.caption(f"Página {len(st.session_state.hist_cursors)}")
+        if c_next.button("Mais antigas ➡️", disabled=next_cursor is None):
+            st.session_state.hist_cursors.append(next_cursor); st.rerun()
 
 # 5. CALENDÁRIO
 elif menu == "📅 Calendário":
@@ -1319,25 +1426,24 @@ elif menu == "📅 Calendário":
     st.caption("Apenas editais marcados como 'Apto' (Verde).")
     st.info("💡 Clique em uma barra verde para ver os detalhes abaixo.")
     
-    lst = db.get_user_history_list(user['username'])
+    lst = db.get_user_history_summaries(user['username'], status='green')
     events = []
     
     for item in lst:
         if item.get('status') == 'green':
-            full_title = extract_title(item['content'])
-            date_iso = extract_date_for_calendar(full_title)
+            full_title = history_title(item)
+            if item.get('session_date'): date_iso = item['session_date'].strftime("%Y-%m-%d")
+            else: date_iso = extract_date_for_calendar(full_title)
             
             if date_iso:
                 orgao_cal = "Órgão"
-                match_org = re.search(r"(?:1\.|órgão).*?[:\-\?]\s*(.*?)(?:\n|2\.|Qual|$)", item['content'], re.IGNORECASE)
-                if match_org: orgao_cal = match_org.group(1).replace("*", "").strip()[:30]
+                match_org = re.search(r"Edital (.*?) \|", full_title)
+                if item.get('orgao'): orgao_cal = item['orgao'][:30]
+                elif match_org: orgao_cal = match_org.group(1).strip()[:30]
 
                 obj_cal = "Geral"
-                match_obj = re.search(r"(?:2\.|objeto).*?[:\-\?]\s*(.*?)(?:\n|3\.|Qual|$)", item['content'], re.IGNORECASE | re.DOTALL)
-                if match_obj:
-                    raw_o = match_obj.group(1).replace("*", "").strip()
-                    raw_o = re.sub(r'[^\w\s]', '', raw_o)
-                    obj_cal = " ".join(raw_o.split()[:3])
+                if item.get('objeto'):
+                    obj_cal = " ".join(re.sub(r'[^\w\s]', '', item['objeto']).split()[:3])
                 
                 title_for_event = f"{orgao_cal} - {obj_cal}"
 
@@ -1347,7 +1453,7 @@ elif menu == "📅 Calendário":
                     "backgroundColor": "#28a745",
                     "borderColor": "#28a745",
                     "extendedProps": {
-                        "content": item['content'],
+                        "id": item['id'],
                         "original_title": full_title
                     }
                 })
@@ -1373,7 +1479,8 @@ elif menu == "📅 Calendário":
         
         title_clk = clicked_event.get("title", "Sem título")
         props = clicked_event.get("extendedProps", {})
-        content_view = props.get("content", "")
+        clicked_item = db.get_history_item(user['username'], props.get("id")) if props.get("id") else None
+        content_view = clicked_item['content'] if clicked_item else ""
         
         st.divider()
         st.subheader(f"📌 {title_clk}")
@@ -1381,9 +1488,12 @@ elif menu == "📅 Calendário":
         with st.expander("📄 Ver Análise Completa (Clique para expandir)"):
             st.markdown(content_view)
             st.divider()
-            pdf = convert_to_pdf(content_view)
-            if pdf: 
-                st.download_button("⬇️ Baixar PDF da Análise", data=pdf, file_name="analise_completa.pdf")
+            if st.button("📄 Gerar PDF da Análise"):
+                with st.spinner("Gerando PDF..."):
+                    pdf = get_report_pdf(content_view, user['username'], props.get("id"))
+                if pdf:
+                    st.download_button("⬇️ Baixar PDF da Análise", data=pdf, file_name="analise_completa.pdf")
+                else: st.error("Erro PDF.")
 
 # 6. ASSINATURA (ATUALIZADO PARA MERCADO PAGO)
 elif menu == "Assinatura":
@@ -0,0 +1,206 @@
+# --- ARQUIVO: catalogue.py ---
+# Catálogo estruturado de atestados e CATs (pasta "3. Qualificacao Tecnica") e comparação local com as
+# exigências técnicas do edital. A extração roda uma vez por documento (ia.py); a comparação é local e
+# determinística, e a IA só redige o parecer final a partir dela.
+import company_index
+import difflib
+import math
+import re
+from collections import Counter
+
+CATALOGUE_VERSION = "a1"  # Incremente ao mudar o esquema ou o prompt: os documentos são recatalogados
+CATALOGUE_SUB_ITEMS = ("Atestados Operacionais", "Atestados Profissionais")
+CATALOGUE_TEXT_CHARS = 60000   # Texto máximo de um documento enviado para catalogação
+
+SIMILARITY_MIN = 0.25          # Abaixo disso o serviço não é considerado correlato
+SIMILARITY_STRONG = 0.45       # A partir disso o serviço é considerado similar
+MAX_EVIDENCE = 3               # Serviços citados por exigência
+
+CATALOGUE_SCHEMA = {'type': 'OBJECT', 'properties': {
+    'tipo_documento': {'type': 'STRING', 'enum': ['atestado', 'cat', 'outro']},
+    'titular': {'type': 'STRING'},
+    'tipo_titular': {'type': 'STRING', 'enum': ['PJ', 'PF']},
+    'profissional': {'type': 'STRING'},
+    'contratante': {'type': 'STRING'},
+    'numero': {'type': 'STRING'},
+    'data_emissao': {'type': 'STRING'},
+    'periodo_execucao': {'type': 'STRING'},
+    'servicos': {'type': 'ARRAY', 'items': {'type': 'OBJECT', 'properties': {
+        'descricao': {'type': 'STRING'},
+        'quantidade': {'type': 'NUMBER'},
+        'unidade': {'type': 'STRING'},
+    }, 'required': ['descricao']}},
+}, 'required': ['tipo_documento', 'titular', 'tipo_titular', 'servicos']}
+
+CATALOGUE_PROMPT = """
+Extraia os dados deste atestado de capacidade técnica ou CAT (Certidão de Acervo Técnico).
+- titular: empresa (PJ) ou profissional (PF) em nome de quem o documento foi emitido; tipo_titular: PJ ou PF.
+- profissional: responsável técnico citado (nome), se houver.
+- contratante: órgão ou empresa para quem o serviço foi executado.
+- servicos: cada serviço executado com a quantidade numérica e a unidade exatamente como no documento
+  (ex.: 12500.5 e "m²"). Não some nem converta unidades. Sem quantidade, omita o campo.
+Datas no formato DD/MM/AAAA. Campos ausentes ficam vazios. Não invente dados.
+"""
+
+_UNITS = {
+    'm2': ['m2', 'm²', 'metro quadrado', 'metros quadrados'],
+    'm3': ['m3', 'm³', 'metro cubico', 'metros cubicos'],
+    'm': ['m', 'ml', 'metro', 'metros', 'metro linear', 'metros lineares'],
+    'km': ['km', 'quilometro', 'quilometros'],
+    't': ['t', 'ton', 'tonelada', 'toneladas'],
+    'kg': ['kg', 'quilo', 'quilos', 'quilograma', 'quilogramas'],
+    'un': ['un', 'und', 'unid', 'unidade', 'unidades', 'pc', 'peca', 'pecas'],
+    'h': ['h', 'hora', 'horas'],
+    'mes': ['mes', 'meses'],
+}
+_UNIT_ALIASES = {alias: unit for unit, aliases in _UNITS.items() for alias in aliases}
+_QUANTITY = re.compile(
+    r"(\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d+(?:,\d+)?)\s*"
+    r"(metros? quadrados?|metros? c[uú]bicos?|metros? lineares?|metros?|toneladas?|quil[oô]metros?|"
+    r"m²|m³|m2|m3|km|ml|m|ton|t|kg|unidades?|und|un|horas?|h|meses|m[eê]s)(?!\w)", re.IGNORECASE)
+
+def is_catalogued(meta):
+    """Documentos que entram no catálogo (atestados e CATs)."""
+    return meta.get('sub_item') in CATALOGUE_SUB_ITEMS
+
+def needs_extraction(meta):
+    return is_catalogued(meta) and meta.get('catalogue_version') != CATALOGUE_VERSION
+
+def normalize_unit(unit):
+    u = company_index.normalize(unit or "").strip(" .")
+    return _UNIT_ALIASES.get(u, u)
+
+def parse_number(text):
+    """'12.500,50' -> 12500.5 (formato brasileiro)."""
+    return float(text.replace(".", "").replace(",", "."))
+
+def parse_quantity(text):
+    """Primeira quantidade com unidade no texto: (número, unidade normalizada) ou (None, '')."""
+    m = _QUANTITY.search(text or "")
+    if not m: return None, ""
+    return parse_number(m.group(1)), normalize_unit(m.group(2))
+
+def technical_requirements(requirements, dados=None):
+    """
+    Exigências técnicas a comparar: [{descricao, quantidade, unidade, tipo}].
+    Usa dados['exigencias_tecnicas'] dos relatórios estruturados; nos antigos, as linhas dos itens 9 e 10.
+    """
+    if dados and dados.get('exigencias_tecnicas'):
+        return [{'descricao': r.get('descricao', ''), 'quantidade': r.get('quantidade'),
+                 'unidade': normalize_unit(r.get('unidade')), 'tipo': r.get('tipo') or 'operacional'}
+                for r in dados['exigencias_tecnicas'] if r.get('descricao')]
+    out = []
+    for item, text in requirements:
+        if item not in (9, 10) or len(company_index.tokenize(text)) < 3: continue
+        qty, unit = parse_quantity(text)
+        out.append({'descricao': text, 'quantidade': qty, 'unidade': unit,
+                    'tipo': 'profissional' if item == 10 else 'operacional'})
+    return out
+
+# --- COMPARAÇÃO LOCAL ---
+
+def _terms(text):
+    # Radical curto: "pavimentação"/"pavimentada" -> "pavime"
+    return [t[:6] for t in company_index.tokenize(text)]
+
+def _tfidf(docs_terms):
+    df = Counter(t for terms in docs_terms for t in set(terms))
+    n = len(docs_terms)
+    vectors = []
+    for terms in docs_terms:
+        tf = Counter(terms)
+        vec = {t: (1 + math.log(c)) * math.log(1 + n / df[t]) for t, c in tf.items()}
+        norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+        vectors.append({t: v / norm for t, v in vec.items()})
+    return vectors
+
+def similarity(vec_a, vec_b, text_a, text_b):
+    """Cosseno TF-IDF combinado com semelhança de caracteres (tolera grafias e abreviações)."""
+    cos = sum(v * vec_b.get(t, 0.0) for t, v in vec_a.items())
+    fuzzy = difflib.SequenceMatcher(None, company_index.normalize(text_a), company_index.normalize(text_b)).ratio()
+    return 0.75 * cos + 0.25 * fuzzy
+
+def _holder_ok(req, cat):
+    holder = cat.get('tipo_titular')
+    if not holder: return True
+    return holder == ('PF' if req['tipo'] == 'profissional' else 'PJ')
+
+def match_requirements(requirements, entries):
+    """
+    requirements: saída de technical_requirements; entries: [(metadados do documento, catálogo)].
+    Retorna, por exigência, status (atende / atende somando / quantidade insuficiente / similar sem
+    quantidade / não encontrado) e os serviços que servem de evidência.
+    """
+    services = []
+    for meta, cat in entries:
+        for svc in cat.get('servicos') or []:
+            if svc.get('descricao'):
+                services.append((meta, cat, svc))
+    vectors = _tfidf([_terms(r['descricao']) for r in requirements] + [_terms(s[2]['descricao']) for s in services])
+    req_vecs, svc_vecs = vectors[:len(requirements)], vectors[len(requirements):]
+
+    results = []
+    for req, rvec in zip(requirements, req_vecs):
+        candidates = []
+        for (meta, cat, svc), svec in zip(services, svc_vecs):
+            if not _holder_ok(req, cat): continue
+            sim = similarity(rvec, svec, req['descricao'], svc['descricao'])
+            if sim >= SIMILARITY_MIN:
+                candidates.append((sim, meta, cat, svc))
+        candidates.sort(key=lambda c: (-c[0], c[1].get('filename', '')))
+
+        needed, unit = req.get('quantidade'), req.get('unidade')
+        pool = [c for c in candidates if not unit or normalize_unit(c[3].get('unidade')) == unit] if needed else candidates
+        # Só serviços similares (>= SIMILARITY_STRONG) contam para a quantidade; os apenas correlatos
+        # ficam listados à parte como "possível", para conferência
+        similar = [c for c in pool if c[0] >= SIMILARITY_STRONG]
+        weak = [c for c in pool if c[0] < SIMILARITY_STRONG]
+        qty = lambda c: c[3].get('quantidade') or 0
+        best_single = max((qty(c) for c in similar), default=0)
+        total = sum(qty(c) for c in similar)
+        strong = bool(candidates) and candidates[0][0] >= SIMILARITY_STRONG
+
+        if not candidates:
+            status = 'não encontrado'
+        elif not needed:
+            status = 'atende' if strong else 'similar sem quantidade'
+        elif best_single >= needed:
+            status = 'atende'
+        elif total >= needed:
+            status = 'atende somando'
+        else:
+            status = 'quantidade insuficiente'
+
+        evidence = lambda cs: [{'arquivo': m.get('filename', ''), 'titular': c.get('titular', ''),
+                                'contratante': c.get('contratante', ''), 'servico': s['descricao'],
+                                'quantidade': s.get('quantidade'), 'unidade': s.get('unidade', ''),
+                                'similaridade': round(sim, 2)} for sim, m, c, s in cs[:MAX_EVIDENCE]]
+        results.append({
+            **req, 'status': status, 'best_single': best_single, 'total': total,
+            'evidencias': evidence(similar), 'possiveis': evidence(weak)
+        })
+    return results
+
+STATUS_ICONS = {'atende': '✅', 'atende somando': '⚠️', 'quantidade insuficiente': '⚠️',
+                'similar sem quantidade': '⚠️', 'não encontrado': '❌'}
+
+def _fmt_qty(value, unit):
+    if not value: return "—"
+    return f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".").rstrip("0").rstrip(",") + f" {unit}".rstrip()
+
+def format_matches(results):
+    """Texto da pré-avaliação enviado à IA (e exibido ao usuário)."""
+    if not results: return ""
+    lines = ["=== PRÉ-AVALIAÇÃO LOCAL DA QUALIFICAÇÃO TÉCNICA (CATÁLOGO DE ATESTADOS/CATs) ===",
+             "Comparação já feita entre as exigências técnicas e os atestados/CATs catalogados da empresa.",
+             "Use-a como base do parecer técnico; os atestados não são reenviados.",
+             "Serviços marcados como \"possível\" são apenas correlatos: não contam para a quantidade, confira-os."]
+    for r in results:
+        lines.append(f"\n{STATUS_ICONS[r['status']]} [{r['tipo'].upper()}] {r['descricao']} | exigido: "
+                     f"{_fmt_qty(r.get('quantidade'), r.get('unidade'))} | status: {r['status']}")
+        for label, evs in (("", r['evidencias']), ("possível: ", r.get('possiveis', []))):
+            for e in evs:
+                lines.append(f"   - {label}{e['arquivo']} ({e['titular'] or 'titular não identificado'}; "
+                             f"{e['contratante'] or '—'}): {e['servico']} — {_fmt_qty(e['quantidade'], e['unidade'])} "
+                             f"(similaridade {e['similaridade']})")
+    return "\n".join(lines)
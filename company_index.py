@@ -0,0 +1,194 @@
+# --- ARQUIVO: company_index.py ---
+# Índice do acervo da empresa: texto, páginas e um resumo curto de cada PDF, gerado uma única vez no upload.
+# No cruzamento cada exigência do edital é roteada para as subpastas do DOC_STRUCTURE que a atendem, e a IA
+# recebe os resumos dessas pastas e só os trechos relevantes, em vez de todos os PDFs da empresa.
+import pdf_tools
+import unicodedata
+import hashlib
+import math
+import re
+from collections import Counter
+
+# Alterar as regras abaixo muda o que fica gravado: incremente a versão para reindexar
+INDEX_VERSION = "c1"
+
+DIGEST_HEAD_CHARS = 300        # Início do documento no resumo
+DIGEST_KEY_LINES = 5           # Linhas com números/validades/registros no resumo
+CONTEXT_CHARS = 120000         # Tamanho máximo do contexto da empresa (~30 mil tokens)
+EXCERPT_CHARS = 2500           # Tamanho máximo de cada trecho (página)
+MIN_TEXT_COVERAGE = 0.5        # Abaixo disso o documento é tratado como digitalizado e vai como PDF
+MAX_FILES_PER_REQUIREMENT = 3  # Documentos com texto mais relevantes por exigência do edital
+
+# --- ESTRUTURA DE DOCUMENTOS ---
+DOC_STRUCTURE = {
+    "1. Habilitacao Juridica": ["Contrato Social", "CNPJ", "Documentos Sócios"],
+    "2. Habilitacao Fiscal": ["Federal", "Estadual", "Municipal", "FGTS", "Trabalhista"],
+    "3. Qualificacao Tecnica": ["Atestados Operacionais", "Atestados Profissionais", "Certidao de Registro no Conselho - Profissionais", "Certidao de Registro no Conselho - Empresa"],
+    "4. Habilitacao Financeira": ["Balanco Patrimonial", "Indices Financeiros", "Certidao Falencia"]
+}
+
+_JUR, _FIS, _TEC, _FIN = list(DOC_STRUCTURE)
+
+# Exigência do edital (texto sem acentos) -> subpastas que a atendem
+ROUTING_RULES = [
+    (r"contrato social|ato constitutivo|estatuto|registro comercial|requerimento de empresario", [(_JUR, "Contrato Social")]),
+    (r"cnpj|cadastro nacional", [(_JUR, "CNPJ")]),
+    (r"socio|administrador|documento de identidade|\bcpf\b|\brg\b", [(_JUR, "Documentos Sócios")]),
+    (r"federa(l|is)|receita|uniao|pgfn|divida ativa", [(_FIS, "Federal")]),
+    (r"estadua(l|is)|sefaz|icms", [(_FIS, "Estadual")]),
+    (r"municipa(l|is)|iss\b|prefeitura", [(_FIS, "Municipal")]),
+    (r"fgts|\bcrf\b|garantia do tempo", [(_FIS, "FGTS")]),
+    (r"trabalhist|cndt|justica do trabalho", [(_FIS, "Trabalhista")]),
+    (r"balanco|demonstrac|patrimonio liquido|capital social", [(_FIN, "Balanco Patrimonial")]),
+    (r"indice|liquidez|solvencia|endividamento", [(_FIN, "Indices Financeiros"), (_FIN, "Balanco Patrimonial")]),
+    (r"falencia|recuperacao judicial|concordata", [(_FIN, "Certidao Falencia")]),
+    (r"\bcat\b|acervo|profissional|responsavel tecnico|engenheir|arquitet", [(_TEC, "Atestados Profissionais"), (_TEC, "Certidao de Registro no Conselho - Profissionais")]),
+    (r"atestado|capacidade tecnica|operacional|execucao de|servicos? similar", [(_TEC, "Atestados Operacionais")]),
+    (r"crea|\bcau\b|conselho|registro", [(_TEC, "Certidao de Registro no Conselho - Empresa")]),
+]
+
+# Item do relatório -> subpastas usadas quando nenhuma regra reconhece a exigência
+ITEM_DEFAULT_FOLDERS = {
+    7: [(_JUR, t) for t in DOC_STRUCTURE[_JUR]] + [(_FIS, t) for t in DOC_STRUCTURE[_FIS]],
+    8: [(_FIN, t) for t in DOC_STRUCTURE[_FIN]],
+    9: [(_TEC, "Atestados Operacionais"), (_TEC, "Certidao de Registro no Conselho - Empresa")],
+    10: [(_TEC, "Atestados Profissionais"), (_TEC, "Certidao de Registro no Conselho - Profissionais")],
+}
+ALL_FOLDERS = [(sec, t) for sec, types in DOC_STRUCTURE.items() for t in types]
+
+_KEY_LINE = re.compile(r"(cnpj|crea|cau|cat\b|validade|vencimento|quantidade|\d[\d.,]*\s*(m²|m2|m³|m3|km|ton|t\b|kg|un\b|%))", re.IGNORECASE)
+_STOPWORDS = set("""
+a o e de da do das dos em no na nos nas um uma uns umas para por com sem ao aos que se ou como
+mais menos ser sao foi pelo pela pelos pelas sua seu suas seus este esta isso esse essa entre sobre
+qual quais item itens conforme deve devera edital empresa documento documentos
+""".split())
+
+def normalize(text):
+    """Minúsculas e sem acentos, para comparar termos em português."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+def tokenize(text):
+    return [t for t in re.findall(r"[a-z0-9]{3,}", normalize(text)) if t not in _STOPWORDS]
+
+def build_digest(filename, section, sub_item, pages, text_pages):
+    """Resumo extrativo: pasta, nome, páginas, início do texto e linhas com dados-chave."""
+    head = f"[{section} / {sub_item}] {filename} — {pages} pág."
+    text = "\n".join(t for _, t in text_pages)
+    if not text.strip():
+        return head + " — documento digitalizado (sem camada de texto)."
+    start = " ".join(text[:DIGEST_HEAD_CHARS * 2].split())[:DIGEST_HEAD_CHARS]
+    keys = []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if 10 <= len(line) <= 200 and _KEY_LINE.search(line) and line not in keys:
+            keys.append(line)
+            if len(keys) >= DIGEST_KEY_LINES: break
+    out = f"{head}\n{start}"
+    if keys:
+        out += "\n" + "\n".join(f"• {k}" for k in keys)
+    return out
+
+def build_document_index(data, filename, section, sub_item):
+    """
+    Indexa um PDF do acervo. Retorna (metadados para o Firestore, páginas de texto [[nº, texto]]).
+    PDFs ilegíveis localmente ficam indexados como digitalizados (vão como PDF no cruzamento).
+    """
+    split = pdf_tools.split_text_layer(data) or {'pages': 0, 'text_pages': [], 'scanned_pages': []}
+    text_pages = split['text_pages']
+    pages = split['pages']
+    coverage = len(text_pages) / pages if pages else 0.0
+    meta = {
+        'filename': filename,
+        'section': section,
+        'sub_item': sub_item,
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'size': len(data),
+        'pages': pages,
+        'text_pages': len(text_pages),
+        'scanned_pages': len(split['scanned_pages']),
+        'chars': sum(len(t) for _, t in text_pages),
+        'visual': coverage < MIN_TEXT_COVERAGE,
+        'digest': build_digest(filename, section, sub_item, pages, text_pages),
+        'version': INDEX_VERSION,
+    }
+    return meta, [[n, t] for n, t in text_pages]
+
+def rank_pages(docs, query):
+    """
+    docs: [(metadados, páginas [[nº, texto]])]. Pontua cada página pelos termos do edital (TF-IDF simples).
+    Retorna [(pontuação, metadados, nº da página, texto)] em ordem decrescente.
+    """
+    query_terms = set(tokenize(query))
+    if not query_terms: return []
+    units = []
+    df = Counter()
+    for meta, pages in docs:
+        for n, text in pages:
+            counts = Counter(t for t in tokenize(text) if t in query_terms)
+            units.append((meta, n, text, counts))
+            df.update(counts.keys())
+    total = max(len(units), 1)
+    scored = []
+    for meta, n, text, counts in units:
+        score = sum((1 + math.log(c)) * math.log(1 + total / df[t]) for t, c in counts.items())
+        if score > 0:
+            scored.append((score, meta, n, text))
+    scored.sort(key=lambda x: -x[0])
+    return scored
+
+def route_requirement(item, text):
+    """Subpastas do DOC_STRUCTURE que podem atender a uma exigência do item 7–10 do relatório (item 0 = todas)."""
+    if not item: return list(ALL_FOLDERS)
+    norm = normalize(text)
+    folders = []
+    for pattern, targets in ROUTING_RULES:
+        if re.search(pattern, norm):
+            folders.extend(f for f in targets if f not in folders)
+    return folders or list(ITEM_DEFAULT_FOLDERS.get(item, ALL_FOLDERS))
+
+def build_company_context(docs, requirements, budget=CONTEXT_CHARS):
+    """
+    Contexto textual da empresa com tamanho limitado.
+    requirements: [(item do relatório, texto da exigência)]; cada exigência é roteada para suas subpastas e
+    recebe as páginas mais relevantes dos documentos dessas pastas. Os resumos cobrem só as pastas roteadas.
+    Retorna (texto, plano [{item, requirement, folders, files}], metadados dos documentos usados).
+    """
+    requirements = requirements or [(0, "")]
+    plan, routed = [], set()
+    for item, req in requirements:
+        folders = route_requirement(item, req)
+        routed.update(folders)
+        candidates = [(m, p) for m, p in docs if (m.get('section'), m.get('sub_item')) in folders]
+        files, pages = [], []
+        for score, meta, n, text in rank_pages(candidates, req):
+            if meta['path'] not in files:
+                if len(files) >= MAX_FILES_PER_REQUIREMENT: continue
+                files.append(meta['path'])
+            pages.append((meta, n, text))
+        files += [m['path'] for m, _ in candidates if m.get('visual') and m['path'] not in files]
+        plan.append({'item': item, 'requirement': req, 'folders': folders, 'files': files, 'pages': pages})
+
+    used = [m for m, _ in docs if (m.get('section'), m.get('sub_item')) in routed]
+    digests = "\n\n".join(m['digest'] for m in used)
+    out = ["=== ACERVO DA EMPRESA: RESUMO DE CADA DOCUMENTO ===", digests[:budget // 2]]
+
+    # Reparte o espaço restante entre as exigências para que nenhuma fique sem trechos
+    per_req = (budget - len(out[1])) // max(len(plan), 1)
+    seen = set()
+    for step in plan:
+        left, chunks = per_req, []
+        for meta, n, text in step.pop('pages'):
+            if (meta['path'], n) in seen: continue
+            chunk = f"--- {meta['filename']} ({meta['sub_item']}) | PÁGINA {n} ---\n{text[:EXCERPT_CHARS]}"
+            if len(chunk) > left: continue
+            chunks.append(chunk)
+            seen.add((meta['path'], n))
+            left -= len(chunk)
+        step['excerpts'] = len(chunks)
+        if chunks:
+            label = f"EXIGÊNCIA: {step['requirement'][:200]}" if step['item'] else "TRECHOS RELEVANTES PARA ESTE EDITAL"
+            out.append(f"=== {label} ===")
+            out.extend(chunks)
+    sent = {p for step in plan for p in step['files']}
+    return "\n\n".join(out), plan, [m for m in used if m['path'] in sent or m.get('visual')]
@@ -18,9 +18,17 @@ import requests  # <--- E ESTE TAMBÉM
 import json
 import datetime
 import uuid
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- CONFIGURAÇÃO ---
 BUCKET_NAME = "urbano-licita.firebasestorage.app" 
+# Pasta local para fila de jobs e caches em disco
+LOCAL_DATA_DIR = os.environ.get("URBANO_DATA_DIR", os.path.join(tempfile.gettempdir(), "urbano"))
 
 # --- CONEXÃO COM O FIREBASE (SINGLETON) ---
 if not firebase_admin._apps:
@@ -227,6 +235,19 @@ def get_plan_limit(plan_type):
     }
     return limits.get(plan_type, 5)
 
+def get_chat_memory_budget(plan_type):
+    """Tokens de conversa (resumo + últimas mensagens) enviados à IA a cada pergunta do chat."""
+    budgets = {
+        'free': 2000,
+        'plano_15': 4000,
+        'plano_30': 4000,
+        'plano_60': 8000,
+        'plano_90': 8000,
+        'unlimited': 16000,
+        'unlimited_30': 16000,
+    }
+    return budgets.get(plan_type, 2000)
+
 def consume_credit_atomic(username):
     try:
         db.collection('users').document(username).update({'credits_used': firestore.Increment(1)})
@@ -244,45 +265,416 @@ def upload_file_to_storage(file_bytes, filename, user_folder, section, sub_item)
     try:
         path = f"{user_folder}/{section}/{sub_item}/{filename}"
         bucket.blob(path).upload_from_string(file_bytes, content_type='application/pdf')
-        return True
     except: return False
+    # Indexação única (texto, páginas, resumo) usada no cruzamento; falhar aqui não invalida o upload
+    index_company_file(file_bytes, path, user_folder, section, sub_item, filename)
+    return True
 
 def list_files_from_storage(user_folder, section, sub_item):
     try:
         blobs = bucket.list_blobs(prefix=f"{user_folder}/{section}/{sub_item}/")
-        return [b.name.split('/')[-1] for b in blobs if b.name.split('/')[-1]]
+        names = [b.name.split('/')[-1] for b in blobs]
+        return [n for n in names if n and not n.endswith(INDEX_SUFFIX)]
     except: return []
 
 def delete_file_from_storage(filename, user_folder, section, sub_item):
     try:
         path = f"{user_folder}/{section}/{sub_item}/{filename}"
         bucket.blob(path).delete()
+        delete_company_file_index(user_folder, path)
+        return True
+    except: return False
+
+def download_storage_file(path):
+    try:
+        local = cached_blob_file(path)
+        if local is None: return None
+        with open(local, "rb") as f:
+            return f.read()
+    except: return None
+
+# PDFs dos relatórios, guardados pelo hash do conteúdo (refeitos só quando o texto muda)
+def _rendered_pdf_path(username, doc_id, key):
+    """PDFs renderizados ficam sob o item do histórico: são apagados junto com ele (delete_history_items)."""
+    return f"_pdfs/{username}/{doc_id}/{key}.pdf"
+
+def get_rendered_pdf(username, doc_id, key):
+    return download_storage_file(_rendered_pdf_path(username, doc_id, key))
+
+def save_rendered_pdf(username, doc_id, key, data):
+    try:
+        bucket.blob(_rendered_pdf_path(username, doc_id, key)).upload_from_string(data, content_type='application/pdf')
         return True
     except: return False
 
-def get_all_company_files_as_bytes(username):
-    files_data = []
+def _rendered_pdf_blobs(username, doc_ids):
+    """Blobs de PDF dos itens informados (uma listagem para todos)."""
+    ids = set(doc_ids)
+    try:
+        return [b for b in bucket.list_blobs(prefix=f"_pdfs/{username}/") if b.name.split('/')[2] in ids]
+    except Exception: return []
+
+def list_company_pdf_paths(username):
+    try:
+        return [b.name for b in bucket.list_blobs(prefix=f"{username}/") if b.name.endswith(".pdf")]
+    except: return []
+
+# --- CACHE LOCAL DE ARQUIVOS DO STORAGE ---
+# Cópia em disco dos blobs, validada pela geração do blob (consulta só de metadados) e limitada por tamanho (LRU).
+
+BLOB_CACHE_DIR = os.path.join(LOCAL_DATA_DIR, "blob_cache")
+BLOB_CACHE_MAX_BYTES = int(os.environ.get("URBANO_BLOB_CACHE_MB", "1024")) * 1024 * 1024
+BLOB_CACHE_GRACE_SECONDS = 120  # Arquivos usados há menos tempo não são removidos (podem estar sendo lidos)
+
+_blob_cache_lock = threading.Lock()
+
+def _blob_cache_paths(path):
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(BLOB_CACHE_DIR, key + ".bin"), os.path.join(BLOB_CACHE_DIR, key + ".json")
+
+def _evict_blob_cache():
+    """Remove os arquivos usados há mais tempo até o cache caber em BLOB_CACHE_MAX_BYTES."""
+    with _blob_cache_lock:
+        entries = []
+        for name in os.listdir(BLOB_CACHE_DIR):
+            if name.endswith(".bin"):
+                try:
+                    st_ = os.stat(os.path.join(BLOB_CACHE_DIR, name))
+                    entries.append((st_.st_mtime, st_.st_size, name))
+                except FileNotFoundError:
+                    continue
+        total = sum(e[1] for e in entries)
+        now = time.time()
+        for mtime, size, name in sorted(entries):
+            if total <= BLOB_CACHE_MAX_BYTES: break
+            if now - mtime < BLOB_CACHE_GRACE_SECONDS: continue
+            for f in (name, name[:-4] + ".json"):
+                try: os.remove(os.path.join(BLOB_CACHE_DIR, f))
+                except FileNotFoundError: pass
+            total -= size
+
+def cached_blob_file(path):
+    """
+    Caminho local de uma cópia atualizada do blob, baixando só se a geração/md5 mudou.
+    Retorna None se o blob não existir mais no Storage.
+    """
+    os.makedirs(BLOB_CACHE_DIR, exist_ok=True)
+    data_file, meta_file = _blob_cache_paths(path)
+    blob = bucket.get_blob(path)  # Apenas metadados
+    if blob is None:
+        for f in (data_file, meta_file):
+            try: os.remove(f)
+            except FileNotFoundError: pass
+        return None
+
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get('generation') == blob.generation and meta.get('md5') == blob.md5_hash and os.path.exists(data_file):
+            os.utime(data_file)  # Marca o uso para o LRU
+            return data_file
+    except (FileNotFoundError, ValueError):
+        pass
+
+    tmp = f"{data_file}.{uuid.uuid4().hex}.tmp"
+    try:
+        blob.download_to_filename(tmp)
+        os.replace(tmp, data_file)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    with open(meta_file, "w") as f:
+        json.dump({'path': path, 'generation': blob.generation, 'md5': blob.md5_hash, 'size': blob.size}, f)
+    _evict_blob_cache()
+    return data_file
+
+# --- ÍNDICE DO ACERVO DA EMPRESA ---
+# Metadados e resumo em users/{usuario}/company_docs; o texto por página fica ao lado do PDF ({caminho}.index.json).
+
+INDEX_SUFFIX = ".index.json"
+
+def company_doc_key(path):
+    """Identificador estável de um blob do Storage (usado como id de documento no Firestore)."""
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+def index_company_file(file_bytes, path, user_folder, section, sub_item, filename):
+    # Importado aqui: company_index traz o pypdf, que os jobs agendados (scheduler.py) não instalam
+    import company_index
+    try:
+        meta, pages = company_index.build_document_index(file_bytes, filename, section, sub_item)
+        meta['path'] = path
+        meta['indexed_at'] = datetime.datetime.now()
+        bucket.blob(path + INDEX_SUFFIX).upload_from_string(
+            json.dumps({'version': meta['version'], 'pages': pages}, ensure_ascii=False),
+            content_type='application/json'
+        )
+        db.collection('users').document(user_folder).collection('company_docs')\
+          .document(company_doc_key(path)).set(meta)
+        return meta, pages
+    except Exception as e:
+        print(f"Erro ao indexar {path}: {e}")
+        return None
+
+def get_company_index(username):
+    """Metadados (com resumo) de todos os documentos indexados do usuário."""
     try:
-        blobs = bucket.list_blobs(prefix=f"{username}/")
-        for blob in blobs:
-            if blob.name.endswith(".pdf"):
-                name = blob.name.split('/')[-1]
-                data = blob.download_as_bytes()
-                files_data.append((name, data))
-        return files_data
+        docs = db.collection('users').document(username).collection('company_docs').stream()
+        return [d.to_dict() for d in docs]
     except: return []
 
+def get_company_file_pages(path):
+    """Páginas de texto [[nº, texto]] gravadas na indexação, ou None."""
+    try:
+        return json.loads(download_storage_file(path + INDEX_SUFFIX))['pages']
+    except: return None
+
+def save_company_doc_catalogue(username, path, catalogue, version):
+    """Dados estruturados de um atestado/CAT (catalogue.py), gravados junto ao índice do documento."""
+    try:
+        db.collection('users').document(username).collection('company_docs').document(company_doc_key(path))\
+          .update({'catalogue': catalogue, 'catalogue_version': version})
+        return True
+    except: return False
+
+def delete_company_file_index(username, path):
+    try:
+        db.collection('users').document(username).collection('company_docs').document(company_doc_key(path)).delete()
+        bucket.blob(path + INDEX_SUFFIX).delete()
+        return True
+    except: return False
+
+DOWNLOAD_WORKERS = 8  # Downloads simultâneos do Storage
+STORAGE_BATCH_LIMIT = 100  # Operações por requisição em lote do Storage (limite da API: 100)
+
+def iter_storage_files(paths, max_workers=DOWNLOAD_WORKERS):
+    """
+    Baixa os blobs em paralelo para o cache em disco e gera (índice em paths, caminho, arquivo local ou None)
+    à medida que cada download termina, para o chamador processar um arquivo enquanto os outros baixam.
+    Os arquivos pertencem ao cache: leia, mas não apague nem altere.
+    """
+    if not paths: return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as ex:
+        futures = {ex.submit(cached_blob_file, p): i for i, p in enumerate(paths)}
+        for fut in as_completed(futures):
+            i, local = futures[fut], None
+            try:
+                local = fut.result()
+            except Exception as e:
+                print(f"Erro ao baixar {paths[i]}: {e}")
+            yield i, paths[i], local
+
+# --- CACHE DE ARQUIVOS DO GEMINI (POR SHA-256) ---
+# Compartilhado entre sessões e usuários: os arquivos do Gemini pertencem à API Key do app.
+
+def get_gemini_file_cache(sha256):
+    try:
+        doc = db.collection('gemini_files').document(sha256).get()
+        return doc.to_dict() if doc.exists else None
+    except: return None
+
+def save_gemini_file_cache(sha256, data):
+    try:
+        db.collection('gemini_files').document(sha256).set(data)
+        return True
+    except: return False
+
+def delete_gemini_file_cache(sha256):
+    try:
+        db.collection('gemini_files').document(sha256).delete()
+        return True
+    except: return False
+
+# --- CACHE DE RESULTADOS DE ANÁLISE ---
+# Chave: hashes dos PDFs + versão do prompt + modelo (ver ia.analysis_cache_key).
+
+def get_analysis_cache(key):
+    try:
+        doc = db.collection('analysis_cache').document(key).get()
+        return doc.to_dict() if doc.exists else None
+    except: return None
+
+def save_analysis_cache(key, data):
+    try:
+        db.collection('analysis_cache').document(key).set({**data, 'hits': 0, 'created_at': datetime.datetime.now()})
+        return True
+    except: return False
+
+def register_analysis_cache_hit(key):
+    try:
+        db.collection('analysis_cache').document(key).update({'hits': firestore.Increment(1), 'last_hit_at': datetime.datetime.now()})
+    except: pass
+
 # --- HISTÓRICO E STATUS ---
 
-def save_analysis_history(username, title, full_text):
+# --- ESCRITAS EM LOTE ---
+FIRESTORE_BATCH_LIMIT = 500  # Máximo de operações por write batch do Firestore
+
+def commit_batched(groups):
+    """
+    groups: [(chave, [(operação, referência, campos)])], operação 'delete', 'update' ou 'set' (merge).
+    Agrupa as operações em write batches de até FIRESTORE_BATCH_LIMIT, sem separar as de uma chave
+    (a não ser que sozinhas passem do limite). Retorna {chave: True se todas as suas operações foram gravadas}.
+    """
+    results = {}
+    state = {'batch': db.batch(), 'size': 0, 'keys': set()}
+    def _flush():
+        try:
+            state['batch'].commit()
+            ok = True
+        except Exception as e:
+            print(f"Erro ao gravar lote ({state['size']} operações): {e}")
+            ok = False
+        for key in state['keys']:
+            results[key] = results.get(key, True) and ok
+        state.update(batch=db.batch(), size=0, keys=set())
+
+    for key, ops in groups:
+        if state['size'] and state['size'] + len(ops) > FIRESTORE_BATCH_LIMIT: _flush()
+        for kind, ref, fields in ops:
+            if state['size'] == FIRESTORE_BATCH_LIMIT: _flush()
+            if kind == 'delete': state['batch'].delete(ref)
+            elif kind == 'update': state['batch'].update(ref, fields)
+            else: state['batch'].set(ref, fields, merge=True)
+            state['size'] += 1
+            state['keys'].add(key)
+    if state['size']: _flush()
+    return results
+
+# --- GANCHOS DO HISTÓRICO ---
+# Funções avisadas a cada gravação/exclusão de item: func(username, doc_id, campos gravados ou None se excluído).
+# Usado pelo índice de busca (search_index.py) para se manter atualizado sem reler a coleção.
+_history_hooks = []
+
+def register_history_hook(func):
+    if func not in _history_hooks: _history_hooks.append(func)
+
+def _notify_history(username, doc_id, fields):
+    for func in _history_hooks:
+        try: func(username, doc_id, fields)
+        except Exception as e: print(f"Erro no gancho do histórico ({doc_id}): {e}")
+
+# --- CAMPOS DE RESUMO DO HISTÓRICO ---
+# Gravados junto com a análise: listagens, calendário e avisos leem só estes campos, sem reler o texto.
+SUMMARY_VERSION = 2         # Incremente ao mudar derive_summary_fields: a migração refaz os itens
+VIABILITY_MARKER = "# 🛡️ VIABILIDADE"  # Cabeçalho do parecer de viabilidade dentro do conteúdo (ia.VIABILITY_HEADER)
+
+_OBJETO_GARBAGE = ["Qual o objeto do edital?", "(Resumo completo)", "Objeto:", "**", "##", "Resumo:", "Trata-se de"]
+
+def _orgao_from_text(title, content):
+    match = re.match(r"Edital (.*?) \|", title or "")
+    if match and match.group(1).strip() != "Órgão Indefinido": return match.group(1).strip()
+    if "1." in content and "2." in content:
+        part = content.split("1.")[1].split("2.")[0]
+        part = part.replace("Qual o nome do órgão contratante?", "").replace("Nome do órgão", "")
+        part = part.replace("*", "").replace("#", "").strip()
+        if part: return part
+    return ""
+
+def _objeto_from_text(content):
+    if "2." in content and "3." in content:
+        chunk = content.split("2.")[1].split("3.")[0]
+        for g in _OBJETO_GARBAGE:
+            chunk = chunk.replace(g, "")
+        chunk = chunk.strip().lstrip(":- ").strip()
+        if len(chunk) > 3: return chunk
+    match = re.search(r"objeto.*?[:\-\?]\s*(.*?)(?:\n|$)", content, re.IGNORECASE)
+    return match.group(1).strip() if match else ""
+
+def _session_date(text):
+    match = re.search(r"(\d{2})/(\d{2})/(\d{4})", text or "")
+    if not match: return None
+    try: return datetime.datetime(int(match.group(3)), int(match.group(2)), int(match.group(1)))
+    except ValueError: return None
+
+def derive_summary_fields(title, content, dados=None):
+    """
+    Órgão, objeto, data da sessão (timestamp), hora e plataforma do item (vazios quando não identificados)
+    e se o conteúdo já tem o parecer de viabilidade.
+    """
+    dados = dados or {}
+    content = content or ""
+    date_text = dados.get('data_sessao')
+    if not date_text:
+        match = re.search(r"DATA_CHAVE:\s*(\d{2}/\d{2}/\d{4})", content)
+        date_text = match.group(1) if match else title
+    hora, plataforma = dados.get('hora_sessao') or "", dados.get('plataforma') or ""
+    if not dados:
+        details = extract_details_from_text(content)
+        hora = details['hora'] if "Estimar" not in details['hora'] else ""
+        plataforma = details['plataforma'] if details['plataforma'] != "Verificar no Edital" else ""
+    return {
+        'orgao': (dados.get('orgao') or _orgao_from_text(title, content))[:200],
+        'objeto': (dados.get('objeto') or _objeto_from_text(content))[:500],
+        'session_date': _session_date(date_text),
+        'hora': hora[:20],
+        'plataforma': plataforma[:100],
+        'has_viability': VIABILITY_MARKER in content,
+        'summary_version': SUMMARY_VERSION,
+    }
+
+BACKFILL_READ_CHUNK = 100   # Itens desatualizados lidos por vez (get_all) na migração
+
+def backfill_history_summaries(usernames=None, on_progress=None):
+    """
+    Migração: grava os campos de resumo nos itens antigos (ou de versão anterior), em write batches.
+    Primeiro lê só summary_version de cada item; o texto é lido apenas dos itens desatualizados.
+    usernames: None = todos os usuários. on_progress(usuários processados, total, itens atualizados).
+    """
+    if usernames is None:
+        usernames = [u.id for u in db.collection('users').stream()]
+    result = {'users': 0, 'updated': 0, 'skipped': 0, 'errors': 0}
+    for n, username in enumerate(usernames, 1):
+        try:
+            history = db.collection('users').document(username).collection('history')
+            stale = []
+            for doc in history.select(['summary_version']).stream():
+                if (doc.to_dict() or {}).get('summary_version') == SUMMARY_VERSION:
+                    result['skipped'] += 1
+                else:
+                    stale.append(doc.reference)
+            failed = False
+            for start in range(0, len(stale), BACKFILL_READ_CHUNK):
+                pending = {}
+                for snap in db.get_all(stale[start:start + BACKFILL_READ_CHUNK], field_paths=['title', 'content', 'dados']):
+                    if not snap.exists: continue
+                    data = snap.to_dict() or {}
+                    pending[snap.id] = (snap.reference, derive_summary_fields(data.get('title'), data.get('content'), data.get('dados')))
+                saved = commit_batched([(doc_id, [('update', ref, fields)]) for doc_id, (ref, fields) in pending.items()])
+                for doc_id, ok in saved.items():
+                    if not ok: continue
+                    result['updated'] += 1
+                    _notify_history(username, doc_id, pending[doc_id][1])
+                failed = failed or not all(saved.values())
+            if failed: result['errors'] += 1
+        except Exception as e:
+            print(f"Erro na migração do histórico de {username}: {e}")
+            result['errors'] += 1
+        result['users'] = n
+        if on_progress: on_progress(n, len(usernames), result['updated'])
+    return result
+
+def new_history_id(username):
+    """Id para um item do histórico ainda não gravado (permite gravar anexos antes do item)."""
+    return db.collection('users').document(username).collection('history').document().id
+
+def save_analysis_history(username, title, full_text, dados=None, doc_id=None, extra=None):
+    """
+    dados: campos estruturados do relatório (órgão, objeto, datas, exigências...), quando houver.
+    doc_id: id reservado com new_history_id (None = gera um). extra: campos adicionais do item.
+    """
     try:
-        _, doc_ref = db.collection('users').document(username).collection('history').add({
+        item = {
             'title': title, 
             'content': full_text, 
-            'created_at': datetime.datetime.now(),
+            'dados': dados,
+            'created_at': datetime.datetime.now(datetime.timezone.utc),
             'status': None, 
-            'note': ''      
-        })
+            'note': '',
+            **derive_summary_fields(title, full_text, dados),
+            **(extra or {})
+        }
+        doc_ref = db.collection('users').document(username).collection('history').document(doc_id)
+        doc_ref.set(item)
+        _notify_history(username, doc_ref.id, item)
         return doc_ref.id
     except: return None
 
@@ -295,13 +687,61 @@ def update_analysis_status(username, doc_id, status, note):
         return True
     except: return False
 
-def get_user_history_list(username):
+# Campos lidos nas listagens do histórico; o texto da análise só é lido ao abrir o item (get_history_item)
+HISTORY_SUMMARY_FIELDS = ['title', 'status', 'note', 'created_at', 'has_viability', 'chat_count',
+                          'orgao', 'objeto', 'session_date', 'hora', 'plataforma', 'summary_version']
+HISTORY_PAGE_SIZE = 20
+
+def get_user_history_page(username, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Uma página do histórico (mais recentes primeiro), só com os campos de resumo.
+    cursor: (created_at, id) do último item da página anterior (None = primeira página); o id desempata itens
+    gravados no mesmo instante, que seriam pulados na virada da página.
+    Retorna (itens, cursor da próxima página ou None se esta for a última).
+    """
     try:
-        docs = db.collection('users').document(username).collection('history')\
-                 .order_by('created_at', direction=firestore.Query.DESCENDING).stream()
-        return [{'id': d.id, **d.to_dict()} for d in docs]
+        query = db.collection('users').document(username).collection('history')\
+                  .select(HISTORY_SUMMARY_FIELDS)\
+                  .order_by('created_at', direction=firestore.Query.DESCENDING)\
+                  .order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+        if cursor is not None:
+            query = query.start_after({'created_at': cursor[0], firestore.FieldPath.document_id(): cursor[1]})
+        docs = list(query.limit(limit + 1).stream())  # Um a mais só para saber se há próxima página
+        items = [{'id': d.id, **d.to_dict()} for d in docs[:limit]]
+        return items, ((items[-1]['created_at'], items[-1]['id']) if len(docs) > limit else None)
+    except: return [], None
+
+def get_user_history_summaries(username, status=None):
+    """Campos de resumo de todos os itens (opcionalmente só de um status), sem o texto das análises."""
+    try:
+        query = db.collection('users').document(username).collection('history').select(HISTORY_SUMMARY_FIELDS)
+        if status is not None:
+            query = query.where('status', '==', status)
+        return [{'id': d.id, **d.to_dict()} for d in query.stream()]
+    except: return []
+
+def get_history_summaries_by_ids(username, doc_ids):
+    """Campos de resumo dos itens pedidos, na ordem de doc_ids (itens inexistentes são omitidos)."""
+    try:
+        history = db.collection('users').document(username).collection('history')
+        snaps = {s.id: s for s in db.get_all([history.document(i) for i in doc_ids], field_paths=HISTORY_SUMMARY_FIELDS)}
+        return [{'id': i, **snaps[i].to_dict()} for i in doc_ids if i in snaps and snaps[i].exists]
     except: return []
 
+def get_user_history_texts(username, since=None):
+    """
+    Texto pesquisável dos itens, para o índice de busca local.
+    since: só os itens criados depois desse momento (sincronização incremental); None = todos.
+    """
+    try:
+        query = db.collection('users').document(username).collection('history')\
+                  .select(['title', 'orgao', 'objeto', 'content', 'created_at'])
+        if since is not None:
+            query = query.where('created_at', '>', since)
+        docs = query.stream()
+        return [{'id': d.id, **d.to_dict()} for d in docs]
+    except: return None  # Diferente de lista vazia: o índice não é marcado como pronto
+
 def get_history_item(username, doc_id):
     try:
         doc = db.collection('users').document(username).collection('history').document(doc_id).get()
@@ -310,12 +750,92 @@ def get_history_item(username, doc_id):
         return None
     except: return None
 
-def delete_history_item(username, doc_id):
+def update_history_fields(username, doc_id, fields):
+    try:
+        db.collection('users').document(username).collection('history').document(doc_id).update(fields)
+        _notify_history(username, doc_id, fields)
+        return True
+    except: return False
+
+# --- CONVERSAS (CHAT) POR ITEM DO HISTÓRICO ---
+
+def _edital_index_path(username, doc_id):
+    return f"_indexes/{username}/{doc_id}.json.gz"
+
+def save_edital_index(username, doc_id, data):
+    """Índice de busca do edital (retrieval.py), guardado no Storage ao lado do item do histórico."""
+    try:
+        bucket.blob(_edital_index_path(username, doc_id)).upload_from_string(data, content_type='application/gzip')
+        return True
+    except: return False
+
+def load_edital_index(username, doc_id):
+    return download_storage_file(_edital_index_path(username, doc_id))
+
+def delete_edital_index(username, doc_id):
+    try:
+        bucket.blob(_edital_index_path(username, doc_id)).delete()
+        return True
+    except: return False
+
+def get_chat_messages(username, doc_id):
+    """Mensagens do chat do item, em ordem: [(papel, texto)]."""
     try:
-        db.collection('users').document(username).collection('history').document(doc_id).delete()
+        docs = db.collection('users').document(username).collection('history').document(doc_id)\
+                 .collection('chat').order_by('created_at').stream()
+        return [(d.get('role'), d.get('text')) for d in docs]
+    except: return []
+
+def add_chat_messages(username, doc_id, messages):
+    """Grava uma troca completa (pergunta e resposta) de uma vez e atualiza o contador do item."""
+    try:
+        item_ref = db.collection('users').document(username).collection('history').document(doc_id)
+        batch = db.batch()
+        now = datetime.datetime.now()
+        for i, (role, text) in enumerate(messages):
+            batch.set(item_ref.collection('chat').document(), {
+                'role': role, 'text': text, 'created_at': now + datetime.timedelta(microseconds=i)
+            })
+        batch.update(item_ref, {'chat_count': firestore.Increment(len(messages))})
+        batch.commit()
         return True
     except: return False
 
+def delete_history_items(username, doc_ids):
+    """
+    Exclui vários itens do histórico (com as conversas, o índice do chat e os PDFs gerados) em write batches.
+    Retorna {doc_id: True/False}.
+    """
+    try:
+        history = db.collection('users').document(username).collection('history')
+        refs = [history.document(i) for i in doc_ids]
+        snaps = {s.id: (s.to_dict() or {}) for s in db.get_all(refs, field_paths=['chat_count', 'chat_index']) if s.exists}
+        # O Firestore não apaga subcoleções junto com o documento: só itens com conversa são listados, em paralelo
+        with_chat = [ref for ref in refs if snaps.get(ref.id, {}).get('chat_count')]
+        list_chat = lambda ref: [('delete', m.reference, None) for m in ref.collection('chat').select([]).stream()]
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_WORKERS, len(with_chat)))) as ex:
+            chat_ops = dict(zip([r.id for r in with_chat], ex.map(list_chat, with_chat)))
+        results = commit_batched([(ref.id, chat_ops.get(ref.id, []) + [('delete', ref, None)]) for ref in refs])
+    except Exception as e:
+        print(f"Erro ao excluir itens do histórico: {e}")
+        return {i: False for i in doc_ids}
+
+    deleted = [i for i, ok in results.items() if ok]
+    # Índices só dos itens que têm um (campo chat_index) e PDFs renderizados: uma requisição em lote
+    blobs = [bucket.blob(_edital_index_path(username, i)) for i in deleted if snaps.get(i, {}).get('chat_index')]
+    blobs += _rendered_pdf_blobs(username, deleted)
+    for start in range(0, len(blobs), STORAGE_BATCH_LIMIT):
+        try:
+            with bucket.client.batch():
+                for blob in blobs[start:start + STORAGE_BATCH_LIMIT]: blob.delete()
+        except Exception as e:
+            print(f"Erro ao apagar arquivos dos itens excluídos: {e}")  # Sobras no Storage não afetam o histórico
+    for doc_id in deleted: _notify_history(username, doc_id, None)
+    return results
+
+def delete_history_item(username, doc_id):
+    return delete_history_items(username, [doc_id]).get(doc_id, False)
+
 # --- FUNÇÕES ADMIN ---
 
 def admin_get_users_stats():
@@ -357,6 +877,11 @@ def admin_set_credits_used(username, new_amount):
         return True
     except: return False
     
+def admin_update_users(changes):
+    """Atualização em lote de usuários: {username: campos}. Retorna {username: True/False}."""
+    users = db.collection('users')
+    return commit_batched([(u, [('update', users.document(u), fields)]) for u, fields in changes.items()])
+
 def admin_ban_user(username, reason):
     """Marca o usuário como excluído e salva o motivo."""
     try:
@@ -450,8 +975,12 @@ def check_deadlines_and_notify():
                 data = doc.to_dict()
                 title = data.get('title', 'Sem Título')
                 full_content = data.get('content', '')
+                dados = data.get('dados') or {}
                 
-                match_date = re.search(r"(\d{2})/(\d{2})/(\d{4})", title)
+                # Itens com campos de resumo dispensam o texto; os antigos dependem dos dados ou do título
+                if data.get('session_date'): date_text = data['session_date'].strftime("%d/%m/%Y")
+                else: date_text = dados.get('data_sessao') or title
+                match_date = re.search(r"(\d{2})/(\d{2})/(\d{4})", date_text)
                 if match_date:
                     event_date_str = f"{match_date.group(3)}-{match_date.group(2)}-{match_date.group(1)}"
                     event_date = pd.to_datetime(event_date_str).date()
@@ -463,7 +992,22 @@ def check_deadlines_and_notify():
                         orgao = parts[0].replace("Edital", "").strip() if len(parts) > 1 else title[:30]
                         objeto = parts[1].strip() if len(parts) > 1 else "Ver Detalhes"
                         
-                        extracted = extract_details_from_text(full_content)
+                        if data.get('summary_version'):
+                            orgao = data.get('orgao') or orgao
+                            objeto = (data.get('objeto') or objeto)[:150]
+                            extracted = {
+                                "plataforma": data.get('plataforma') or "Verificar no Edital",
+                                "hora": data.get('hora') or "09:00 (Estimar)"
+                            }
+                        elif dados:
+                            orgao = dados.get('orgao') or orgao
+                            objeto = (dados.get('objeto') or objeto)[:150]
+                            extracted = {
+                                "plataforma": dados.get('plataforma') or "Verificar no Edital",
+                                "hora": dados.get('hora_sessao') or "09:00 (Estimar)"
+                            }
+                        else:
+                            extracted = extract_details_from_text(full_content)
                         
                         pending_bids.append({
                             "orgao": orgao,
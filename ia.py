@@ -0,0 +1,1207 @@
+# --- ARQUIVO: ia.py ---
+# Funções de apoio à Inteligência Artificial usadas pelo app.py (o modelo em si fica em llm.py).
+import database as db
+import llm
+import jobs
+import pdf_tools
+import company_index
+import catalogue
+import retrieval
+import hashlib
+import itertools
+import datetime
+import tempfile
+import threading
+import time
+import json
+import re
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+# --- PROMPTS VERSIONADOS ---
+# Ao alterar o texto de um prompt, crie uma nova versão em vez de editar a existente.
+
+PROMPT_VERSION = "v2"
+
+ANALYSIS_PROMPTS = {
+    "v1": """
+                    ATUE COMO AUDITOR SÊNIOR DE ENGENHARIA.
+                    Analise TODOS os documentos fornecidos (Edital e Anexos) com extremo rigor.
+                    Responda pontualmente às 16 questões abaixo. Use Markdown para formatar.
+
+                    1. Qual o nome do órgão contratante?
+                    2. Qual o objeto do edital? (Resumo completo)
+                    3. Qual o valor estimado para a realização dos serviços?
+                    4. Qual a plataforma onde será realizado o certame?
+                    5. Qual a data de realização do certame? (Inicie sua resposta EXATAMENTE com "DATA_CHAVE: DD/MM/YYYY". Se não houver sessão física, coloque a data limite de propostas neste formato).
+                    6. **CRONOGRAMA**: Datas e Prazos.
+                    7. **HABILITAÇÃO JURÍDICA/FISCAL**: Exigências.
+                    8. **FINANCEIRO**: Índices (LG, SG, LC) e valores.
+                    9. Quais as exigências para qualificação técnica deste certame? (Esmiuce com detalhes, incluindo apresentação de declarações e demais documentos exigidos)
+                    10. Elenque TODOS os profissionais exigidos pelo edital e também a experiência necessária.
+                    11. Não oculte nenhuma exigência técnica, por mais simples que pareça.
+                    12. É exigida algum tipo de garantia? Se sim, quais?
+                    13. Qual o entendimento do edital acerca de propostas com descontos acima de 25% do valor global?
+                    14. Qual o formato e o período destinado para a fase de lances?
+                    15. O que o edital versa sobre identificação da empresa no envio da documentação ou proposta?
+                    16. Analise os riscos envolvidos na participação da empresa nesse serviço.
+                    """,
+    # v2: mesmas questões, resposta em JSON (ver REPORT_FIELDS); o Markdown é gerado por render_report_markdown
+    "v2": """
+                    ATUE COMO AUDITOR SÊNIOR DE ENGENHARIA.
+                    Analise TODOS os documentos fornecidos (Edital e Anexos) com extremo rigor.
+                    Responda pontualmente às questões abaixo preenchendo o JSON do esquema fornecido (campos indicados entre colchetes).
+                    Datas no formato DD/MM/AAAA e horários no formato HH:MM. Use "" ou [] quando a informação não constar nos documentos.
+
+                    1. Qual o nome do órgão contratante? [orgao]
+                    2. Qual o objeto do edital? Resumo completo. [objeto]
+                    3. Qual o valor estimado para a realização dos serviços? [valor_estimado]
+                    4. Qual a plataforma onde será realizado o certame? [plataforma]
+                    5. Qual a data e o horário de realização do certame? Se não houver sessão física, use a data limite de propostas. [data_sessao, hora_sessao]
+                    6. CRONOGRAMA: Datas e Prazos. [cronograma]
+                    7. HABILITAÇÃO JURÍDICA/FISCAL: Exigências. [habilitacao_juridica_fiscal]
+                    8. FINANCEIRO: Índices (LG, SG, LC) e valores. [financeiro]
+                    9. Quais as exigências para qualificação técnica deste certame? Esmiuce com detalhes, incluindo declarações e demais documentos exigidos. Liste também cada serviço/parcela de relevância com quantidade e unidade. [qualificacao_tecnica, exigencias_tecnicas]
+                    10. Elenque TODOS os profissionais exigidos pelo edital e também a experiência necessária. [profissionais]
+                    11. Não oculte nenhuma exigência técnica, por mais simples que pareça. [outras_exigencias_tecnicas]
+                    12. É exigida algum tipo de garantia? Se sim, quais? [garantias]
+                    13. Qual o entendimento do edital acerca de propostas com descontos acima de 25% do valor global? [descontos_acima_25]
+                    14. Qual o formato e o período destinado para a fase de lances? [fase_de_lances]
+                    15. O que o edital versa sobre identificação da empresa no envio da documentação ou proposta? [identificacao_empresa]
+                    16. Analise os riscos envolvidos na participação da empresa nesse serviço. [riscos]
+                    """
+}
+
+# Versões cuja resposta é JSON estruturado
+STRUCTURED_PROMPTS = {"v2"}
+
+# --- EXECUÇÃO EM SEÇÕES PARALELAS ---
+# 'sectional' divide as 16 questões em grupos independentes, gerados ao mesmo tempo sobre os mesmos
+# arquivos e unidos na ordem original (mesma numeração: extract_title e DATA_CHAVE continuam funcionando).
+# 'single' mantém uma única chamada com o prompt completo.
+# Cada seção reenvia os arquivos inteiros (~4x os tokens de entrada): 'sectional' é opcional, 'single' é o padrão.
+
+ANALYSIS_MODE = os.environ.get("URBANO_ANALYSIS_MODE", "single")
+
+SECTION_GROUPS = [
+    ("Identificação e Datas", [1, 2, 3, 4, 5, 6]),
+    ("Habilitação", [7, 8]),
+    ("Qualificação Técnica", [9, 10, 11]),
+    ("Garantias, Lances e Riscos", [12, 13, 14, 15, 16]),
+]
+
+SECTION_PROMPT_HEADER = """
+ATUE COMO AUDITOR SÊNIOR DE ENGENHARIA.
+Analise TODOS os documentos fornecidos (Edital e Anexos) com extremo rigor.
+Responda pontualmente APENAS às questões abaixo, mantendo exatamente a numeração indicada. Use Markdown para formatar.
+As demais questões do relatório são respondidas separadamente: não escreva introdução, conclusão geral nem outras questões.
+
+"""
+
+SECTION_PROMPT_HEADER_JSON = """
+ATUE COMO AUDITOR SÊNIOR DE ENGENHARIA.
+Analise TODOS os documentos fornecidos (Edital e Anexos) com extremo rigor.
+Responda pontualmente APENAS às questões abaixo preenchendo o JSON do esquema fornecido (campos indicados entre colchetes).
+Datas no formato DD/MM/AAAA e horários no formato HH:MM. Use "" ou [] quando a informação não constar nos documentos.
+
+"""
+
+def get_prompt_questions(prompt_version):
+    """Questões numeradas do prompt completo: {número: texto}."""
+    found = re.findall(r"^\s*(\d+)\.\s+(.*)$", ANALYSIS_PROMPTS[prompt_version], re.MULTILINE)
+    return {int(n): q.strip() for n, q in found}
+
+def build_section_prompt(prompt_version, numbers):
+    questions = get_prompt_questions(prompt_version)
+    header = SECTION_PROMPT_HEADER_JSON if prompt_version in STRUCTURED_PROMPTS else SECTION_PROMPT_HEADER
+    return header + "\n".join(f"{n}. {questions[n]}" for n in numbers)
+
+def merge_sections(texts):
+    """Une as respostas dos grupos na ordem das questões (determinístico)."""
+    return "\n\n".join(t.strip() for t in texts if t and t.strip())
+
+# --- RELATÓRIO ESTRUTURADO (JSON) ---
+# O modelo devolve os campos abaixo; o histórico guarda o dict em 'dados' e o Markdown é gerado a partir dele.
+
+_STR = {'type': 'STRING'}
+_LIST = {'type': 'ARRAY', 'items': {'type': 'STRING'}}
+
+FIELD_SCHEMAS = {
+    'orgao': _STR, 'objeto': _STR, 'valor_estimado': _STR, 'plataforma': _STR,
+    'data_sessao': _STR, 'hora_sessao': _STR,
+    'cronograma': _LIST, 'habilitacao_juridica_fiscal': _LIST, 'financeiro': _LIST,
+    'qualificacao_tecnica': _LIST,
+    'exigencias_tecnicas': {'type': 'ARRAY', 'items': {'type': 'OBJECT', 'properties': {
+        'descricao': _STR,
+        'quantidade': {'type': 'NUMBER'},
+        'unidade': _STR,
+        'tipo': {'type': 'STRING', 'enum': ['operacional', 'profissional']}
+    }, 'required': ['descricao', 'tipo']}},
+    'profissionais': _LIST, 'outras_exigencias_tecnicas': _LIST,
+    'garantias': _STR, 'descontos_acima_25': _STR, 'fase_de_lances': _STR,
+    'identificacao_empresa': _STR, 'riscos': _LIST,
+}
+
+# Questão -> (rótulo no relatório, campos)
+REPORT_FIELDS = {
+    1: ("Órgão contratante", ['orgao']),
+    2: ("Objeto", ['objeto']),
+    3: ("Valor estimado", ['valor_estimado']),
+    4: ("Plataforma", ['plataforma']),
+    5: ("Data do certame", ['data_sessao', 'hora_sessao']),
+    6: ("CRONOGRAMA", ['cronograma']),
+    7: ("HABILITAÇÃO JURÍDICA/FISCAL", ['habilitacao_juridica_fiscal']),
+    8: ("FINANCEIRO", ['financeiro']),
+    9: ("QUALIFICAÇÃO TÉCNICA", ['qualificacao_tecnica', 'exigencias_tecnicas']),
+    10: ("PROFISSIONAIS EXIGIDOS", ['profissionais']),
+    11: ("DEMAIS EXIGÊNCIAS TÉCNICAS", ['outras_exigencias_tecnicas']),
+    12: ("GARANTIAS", ['garantias']),
+    13: ("DESCONTOS ACIMA DE 25%", ['descontos_acima_25']),
+    14: ("FASE DE LANCES", ['fase_de_lances']),
+    15: ("IDENTIFICAÇÃO DA EMPRESA", ['identificacao_empresa']),
+    16: ("RISCOS", ['riscos']),
+}
+
+def build_report_schema(numbers=None):
+    """Esquema JSON (formato do Gemini) com os campos das questões informadas."""
+    numbers = numbers or sorted(REPORT_FIELDS)
+    fields = [f for n in numbers for f in REPORT_FIELDS[n][1]]
+    return {'type': 'OBJECT', 'properties': {f: FIELD_SCHEMAS[f] for f in fields}, 'required': fields}
+
+def parse_report_json(text):
+    """Converte a resposta do modelo em dict. Retorna None se não for JSON válido."""
+    raw = text.strip()
+    if raw.startswith("```"):
+        raw = re.sub(r"^```(?:json)?\s*|\s*```$", "", raw)
+    try:
+        data = json.loads(raw)
+        return data if isinstance(data, dict) else None
+    except ValueError:
+        return None
+
+_CLOSERS = {'{': '}', '[': ']'}
+
+def parse_partial_report_json(text):
+    """
+    JSON ainda em streaming -> dict com o que já chegou (strings abertas ficam truncadas), ou None.
+    Fecha as aspas e chaves pendentes; se o fim estiver no meio de uma chave, recua até a última vírgula.
+    """
+    raw = text.lstrip()
+    if raw.startswith("```"):
+        raw = re.sub(r"^```(?:json)?\s*", "", raw)
+    stack, in_string, escape, cuts = [], False, False, []
+    for i, c in enumerate(raw):
+        if in_string:
+            if escape: escape = False
+            elif c == '\\': escape = True
+            elif c == '"': in_string = False
+        elif c == '"': in_string = True
+        elif c in _CLOSERS: stack.append(_CLOSERS[c])
+        elif c in '}]' and stack: stack.pop()
+        elif c == ',': cuts.append((i, "".join(reversed(stack))))
+    tail = raw[:len(raw) - 1] if escape else raw
+    candidates = [tail + ('"' if in_string else '') + "".join(reversed(stack))]
+    candidates += [raw[:i] + closers for i, closers in reversed(cuts[-2:])]
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+            return data if isinstance(data, dict) else None
+        except ValueError:
+            continue
+    return None
+
+def _render_list(items):
+    return "\n".join(f"   - {i}" for i in items if str(i).strip()) or "   - Não informado no edital."
+
+def _render_requirement(req):
+    qtd = req.get('quantidade')
+    qtd_txt = f" — {qtd:g} {req.get('unidade', '')}".rstrip() if isinstance(qtd, (int, float)) else ""
+    return f"{req.get('descricao', '')}{qtd_txt} ({req.get('tipo', 'operacional')})"
+
+def render_report_markdown(dados, numbers=None):
+    """Relatório no layout das 16 questões (mantém DATA_CHAVE na questão 5 para os parsers antigos)."""
+    blocks = []
+    for n in (numbers or sorted(REPORT_FIELDS)):
+        label, fields = REPORT_FIELDS[n]
+        if n == 5:
+            data = dados.get('data_sessao') or "Data Pendente"
+            hora = dados.get('hora_sessao')
+            blocks.append(f"{n}. **{label}:** DATA_CHAVE: {data}" + (f" às {hora}" if hora else ""))
+            continue
+        if n == 9:
+            body = _render_list(dados.get('qualificacao_tecnica', []))
+            reqs = dados.get('exigencias_tecnicas') or []
+            if reqs:
+                body += "\n\n   **Parcelas de relevância:**\n" + _render_list([_render_requirement(r) for r in reqs])
+            blocks.append(f"{n}. **{label}:**\n{body}")
+            continue
+        value = dados.get(fields[0])
+        if isinstance(value, list):
+            blocks.append(f"{n}. **{label}:**\n{_render_list(value)}")
+        else:
+            blocks.append(f"{n}. **{label}:** {value or 'Não informado no edital.'}")
+    return "\n\n".join(blocks)
+
+def title_from_data(dados):
+    orgao = (dados.get('orgao') or "Órgão Indefinido").strip()
+    data_sessao = dados.get('data_sessao') or "Data Pendente"
+    return f"Edital {orgao} | {data_sessao}"
+
+# --- LEITURA DO RELATÓRIO ---
+
+ROUTED_ITEMS = (7, 8, 9, 10)        # Itens de habilitação usados para escolher os documentos da empresa
+MAX_REQUIREMENTS_PER_ITEM = 6       # Exigências além disso são agrupadas na última
+
+def report_requirements(content, dados=None):
+    """Exigências dos itens 7–10 do relatório: [(item, texto)]. Vazio se o relatório não tiver esses itens."""
+    per_item = {}
+    if dados:
+        for n in ROUTED_ITEMS:
+            for field in REPORT_FIELDS[n][1]:
+                for value in dados.get(field) or []:
+                    text = _render_requirement(value) if isinstance(value, dict) else str(value)
+                    if text.strip(): per_item.setdefault(n, []).append(text.strip())
+    if not per_item:
+        body = content.split("# 🛡️ VIABILIDADE")[0]
+        parts = re.split(r"(?m)^(?:\*\*)?(\d{1,2})\.\s", body)
+        for num, text in zip(parts[1::2], parts[2::2]):
+            if int(num) not in ROUTED_ITEMS: continue
+            lines = [" ".join(l.strip(" -*•#\t").split()) for l in text.splitlines()]
+            per_item.setdefault(int(num), []).extend(l for l in lines if len(l) > 15)
+
+    reqs = []
+    for n, lines in sorted(per_item.items()):
+        head, tail = lines[:MAX_REQUIREMENTS_PER_ITEM - 1], lines[MAX_REQUIREMENTS_PER_ITEM - 1:]
+        if tail: head.append(" ; ".join(tail))
+        reqs.extend((n, l) for l in head)
+    return reqs
+
+def extract_title(text):
+    try:
+        orgao = "Órgão Indefinido"
+        match_orgao = re.search(r"(?:1\.|órgão).*?[:\-\?]\s*(.*?)(?:\n|2\.|Qual|$)", text, re.IGNORECASE)
+        if match_orgao: 
+            orgao = match_orgao.group(1).replace("*", "").strip()
+
+        data_sessao = "Data Pendente"
+        match_data_tag = re.search(r"DATA_CHAVE:\s*(\d{2}/\d{2}/\d{4})", text)
+        
+        if match_data_tag:
+            data_sessao = match_data_tag.group(1)
+        else:
+            match_q5 = re.search(r"5\.(.*?)(?:6\.|CRONOGRAMA|\n\n|$)", text, re.DOTALL | re.IGNORECASE)
+            if match_q5:
+                match_generic = re.search(r"(\d{2}/\d{2}/\d{4})", match_q5.group(1))
+                if match_generic: data_sessao = match_generic.group(1)
+
+        return f"Edital {orgao} | {data_sessao}"
+    except:
+        return f"Edital Processado em {datetime.datetime.now().strftime('%d/%m/%Y')}"
+
+# --- CACHE DE ARQUIVOS ENVIADOS AO GEMINI ---
+# Os arquivos enviados ao Gemini ficam disponíveis por 48h.
+# Guardamos o handle de cada PDF pelo SHA-256 dos bytes para não reenviar o mesmo arquivo.
+
+FILE_TTL = datetime.timedelta(hours=47)           # Usado se a API não informar a expiração
+FILE_REUSE_MARGIN = datetime.timedelta(hours=1)   # Validade mínima restante para reaproveitar
+
+UPLOAD_WORKERS = 4                                # Envios simultâneos ao Gemini
+
+_file_handles = {}  # sha256 -> (handle, expires_at) | memória do processo (todas as sessões)
+_file_lock = threading.Lock()
+
+def _now_utc():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def file_sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _still_valid(expires_at):
+    if not expires_at: return False
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    return expires_at - FILE_REUSE_MARGIN > _now_utc()
+
+def _file_state(handle):
+    state = getattr(handle, 'state', None)
+    return getattr(state, 'name', str(state or ''))
+
+def _handle_key(sha):
+    """Handles de backends diferentes (ex.: fake de benchmark) não se misturam no cache."""
+    backend = llm.get_backend()
+    return sha if backend.name == 'gemini' else f"{backend.name}-{sha}"
+
+def _fetch_cached_handle(sha):
+    """Procura um handle vivo na memória e no Firestore. Retorna None se precisar reenviar."""
+    sha = _handle_key(sha)
+    with _file_lock:
+        mem = _file_handles.get(sha)
+    if mem and _still_valid(mem[1]):
+        return mem[0]
+
+    rec = db.get_gemini_file_cache(sha)
+    if not rec or not _still_valid(rec.get('expires_at')):
+        return None
+    try:
+        # Confirma que o arquivo ainda existe no Gemini (pode ter sido apagado antes de expirar)
+        handle = llm.get_backend().get_file(rec['name'])
+        if _file_state(handle) == 'FAILED':
+            raise ValueError("Arquivo com falha no Gemini")
+    except Exception:
+        db.delete_gemini_file_cache(sha)
+        return None
+
+    with _file_lock:
+        _file_handles[sha] = (handle, rec['expires_at'])
+    return handle
+
+def upload_document(data, display_name, mime_type="application/pdf", cache_key=None):
+    """
+    Envia um arquivo ao Gemini, reaproveitando o handle já existente para os mesmos bytes.
+    cache_key substitui o SHA-256 dos bytes para arquivos derivados (ex.: texto extraído de um PDF).
+    """
+    sha = cache_key or file_sha256(data)
+    handle = _fetch_cached_handle(sha)
+    if handle is not None:
+        return handle
+
+    suffix = ".txt" if mime_type == "text/plain" else ".pdf"
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        tmp.write(data); tmp_path = tmp.name
+    try:
+        handle = llm.get_backend().upload(tmp_path, display_name, mime_type)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    sha = _handle_key(sha)
+    expires_at = getattr(handle, 'expiration_time', None) or (_now_utc() + FILE_TTL)
+    with _file_lock:
+        _file_handles[sha] = (handle, expires_at)
+    db.save_gemini_file_cache(sha, {
+        'name': handle.name,
+        'uri': getattr(handle, 'uri', ''),
+        'display_name': display_name,
+        'size_bytes': len(data),
+        'expires_at': expires_at,
+        'created_at': _now_utc()
+    })
+    return handle
+
+def upload_parallel(files, on_progress=None, max_workers=UPLOAD_WORKERS):
+    """
+    Envia vários arquivos ao mesmo tempo (limitado a max_workers).
+    files: lista ou gerador de (nome, bytes) ou (nome, bytes, mime_type, cache_key). Com gerador, cada arquivo
+    sobe assim que é gerado e só 2 x max_workers ficam na memória ao mesmo tempo.
+    on_progress(nome, erro) é chamado na thread de quem chamou, então pode escrever no st.status com segurança.
+    Retorna (handles na ordem original, lista de (nome, erro)). Falhas não descartam os que subiram.
+    """
+    results, errors, pending = {}, [], {}
+
+    def _collect(done):
+        for fut in done:
+            i, name = pending.pop(fut)
+            err = None
+            try:
+                results[i] = fut.result()
+            except Exception as e:
+                err = str(e)
+                errors.append((name, err))
+            if on_progress: on_progress(name, err)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for i, item in enumerate(files):
+            pending[ex.submit(upload_document, item[1], item[0], *item[2:])] = (i, item[0])
+            if len(pending) >= 2 * max_workers:
+                _collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        _collect(as_completed(list(pending)))
+    return [results[i] for i in sorted(results) if results[i] is not None], errors
+
+# --- PRÉ-PROCESSAMENTO (CAMADA DE TEXTO) ---
+# PDFs nascidos digitais vão como texto compacto; só as páginas digitalizadas vão como PDF (visual).
+
+SLIM_PDFS = os.environ.get("URBANO_SLIM_PDFS", "1") != "0"  # Padrão do enxugamento de digitalizações
+
+_prep_cache = {}  # (sha256, slim) -> (partes, estatísticas) | evita reprocessar o mesmo PDF no processo
+_PREP_CACHE_MAX_BYTES = 128 * 1024 * 1024  # As partes guardam bytes (digitalizações inteiras): limite pelo tamanho
+_prep_cache_bytes = 0
+
+def _parts_size(result):
+    return sum(len(part[1]) for part in result[0])
+
+def prepare_document(name, data, slim=SLIM_PDFS):
+    """Retorna (partes para upload [(nome, bytes, mime, chave)], estatísticas de economia)."""
+    global _prep_cache_bytes
+    sha = file_sha256(data)
+    with _file_lock:
+        hit = _prep_cache.get((sha, slim))
+    if hit: return hit
+
+    tag = pdf_tools.prep_tag(slim)
+    split = pdf_tools.split_text_layer(data, slim=slim)
+    if split is None:
+        # PDF ilegível localmente: envia o original, como antes
+        result = ([(name, data, "application/pdf", sha)],
+                  pdf_tools.estimate_savings(len(data), 0, "", data, []))
+    else:
+        parts = []
+        text = pdf_tools.format_text_pages(name, split['text_pages'])
+        if text:
+            parts.append((f"{name} (texto).txt", text.encode('utf-8'), "text/plain", f"{sha}-texto-{tag}"))
+        if split['scanned_pdf'] is not None:
+            scan_key = sha if split['scanned_pdf'] is data else f"{sha}-scan-{tag}"
+            parts.append((f"{name} (páginas digitalizadas)" if text else name, split['scanned_pdf'], "application/pdf", scan_key))
+        result = (parts, pdf_tools.estimate_savings(len(data), split['pages'], text, split['scanned_pdf'], split['scanned_pages']))
+
+    size = _parts_size(result)
+    with _file_lock:
+        if size <= _PREP_CACHE_MAX_BYTES // 4 and (sha, slim) not in _prep_cache:  # Arquivos enormes não entram
+            while _prep_cache and _prep_cache_bytes + size > _PREP_CACHE_MAX_BYTES:
+                _prep_cache_bytes -= _parts_size(_prep_cache.pop(next(iter(_prep_cache))))
+            _prep_cache[(sha, slim)] = result
+            _prep_cache_bytes += size
+    return result
+
+def sum_stats(stats_list):
+    total = {}
+    for st_ in stats_list:
+        for k, v in st_.items():
+            total[k] = total.get(k, 0) + v
+    return total
+
+def format_savings(stats):
+    """Resumo legível da economia obtida com o pré-processamento."""
+    if not stats or not stats.get('original_bytes'): return ""
+    mb = lambda b: b / (1024 * 1024)
+    return (f"📉 Pré-processamento: {mb(stats['original_bytes']):.1f} MB → {mb(stats['sent_bytes']):.1f} MB | "
+            f"~{stats['original_tokens']:,} → ~{stats['sent_tokens']:,} tokens | "
+            f"{stats['text_pages']} pág. como texto, {stats['scanned_pages']} digitalizada(s)").replace(",", ".")
+
+def prepare_and_upload(files, on_progress=None, slim=SLIM_PDFS):
+    """
+    Extrai a camada de texto de cada PDF e envia ao Gemini apenas texto + páginas digitalizadas.
+    files: lista ou gerador de (nome, bytes); cada arquivo começa a subir assim que é preparado.
+    Retorna (handles, erros, estatísticas somadas).
+    """
+    stats = []
+    def _parts():
+        for name, data in files:
+            parts, st_ = prepare_document(name, data, slim)
+            stats.append(st_)
+            yield from parts
+    handles, errors = upload_parallel(_parts(), on_progress=on_progress)
+    return handles, errors, sum_stats(stats)
+
+# --- PRÉ-CHECAGEM (TAMANHO, TOKENS, TEMPO E CUSTO) ---
+# Referências aproximadas para a estimativa mostrada antes de consumir o crédito.
+
+UPLOAD_BYTES_PER_SECOND = 2 * 1024 * 1024
+INPUT_TOKENS_PER_SECOND = 20000     # Leitura do contexto pelo modelo
+OUTPUT_TOKENS_PER_SECOND = 60
+REPORT_OUTPUT_TOKENS = 4000         # Tamanho típico do relatório completo
+PRICE_INPUT_PER_MTOK = 1.25         # US$ por milhão de tokens (tabela do Gemini Pro)
+PRICE_OUTPUT_PER_MTOK = 10.0
+MAX_CONTEXT_TOKENS = 1000000
+
+def estimate_job(stats, mode=ANALYSIS_MODE):
+    """Tempo (s) e custo (US$) estimados a partir das estatísticas de prepare_document somadas."""
+    calls = len(SECTION_GROUPS) if mode == 'sectional' else 1
+    input_tokens = stats.get('sent_tokens', 0) * calls  # Cada seção relê todos os documentos
+    # Seções rodam em paralelo: o tempo segue a mais longa, o custo soma todas
+    seconds = (stats.get('sent_bytes', 0) / UPLOAD_BYTES_PER_SECOND
+               + stats.get('sent_tokens', 0) / INPUT_TOKENS_PER_SECOND
+               + REPORT_OUTPUT_TOKENS / calls / OUTPUT_TOKENS_PER_SECOND)
+    cost = (input_tokens * PRICE_INPUT_PER_MTOK + REPORT_OUTPUT_TOKENS * PRICE_OUTPUT_PER_MTOK) / 1e6
+    return {'seconds': seconds, 'cost_usd': cost, 'input_tokens': input_tokens}
+
+_inspect_cache = {}  # sha256 -> inspect_pdf | a página refaz a pré-checagem a cada interação
+_INSPECT_CACHE_MAX = 200
+
+def inspect_document(data):
+    sha = file_sha256(data)
+    with _file_lock:
+        if sha in _inspect_cache: return _inspect_cache[sha]
+    info = pdf_tools.inspect_pdf(data)
+    with _file_lock:
+        if len(_inspect_cache) >= _INSPECT_CACHE_MAX:
+            _inspect_cache.pop(next(iter(_inspect_cache)))
+        _inspect_cache[sha] = info
+    return info
+
+def preflight(files, slim=SLIM_PDFS, mode=ANALYSIS_MODE):
+    """
+    Pré-checagem local e barata antes do envio: páginas, imagens pesadas, tokens, tempo e custo estimados.
+    Só inspeciona a estrutura dos PDFs (em cache por arquivo); a extração de texto e o enxugamento ficam no job.
+    Retorna dict com files [{name, pages, heavy_images, ...}], stats somadas, estimate e warnings.
+    """
+    rows, stats, warnings = [], [], []
+    for name, data in files:
+        info = inspect_document(data)
+        if info is None or info['encrypted']:
+            warnings.append(f"'{name}' está protegido ou corrompido: será enviado sem otimização.")
+        st_ = pdf_tools.estimate_from_inspection(len(data), info, slim)
+        stats.append(st_)
+        rows.append({'name': name, 'pages': st_['pages'], 'scanned_pages': st_['scanned_pages'],
+                     'heavy_images': (info or {}).get('heavy_images', 0),
+                     'original_bytes': st_['original_bytes'], 'sent_bytes': st_['sent_bytes'],
+                     'sent_tokens': st_['sent_tokens']})
+    total = sum_stats(stats)
+    heavy = sum(r['heavy_images'] for r in rows)
+    if heavy and not slim:
+        warnings.append(f"{heavy} imagem(ns) pesada(s) encontradas: ative a otimização para reduzir o envio.")
+    if total.get('sent_tokens', 0) > MAX_CONTEXT_TOKENS:
+        warnings.append("O conjunto excede a janela de contexto do modelo: remova anexos que não sejam essenciais.")
+    return {'files': rows, 'stats': total, 'estimate': estimate_job(total, mode), 'warnings': warnings}
+
+def format_preflight(pre):
+    """Resumo de uma linha da pré-checagem."""
+    st_, est = pre['stats'], pre['estimate']
+    if not st_: return ""
+    mb = lambda b: b / (1024 * 1024)
+    minutes, seconds = divmod(int(est['seconds']) + 1, 60)
+    return (f"📋 {st_['pages']} pág. ({st_['scanned_pages']} digitalizadas) | "
+            f"{mb(st_['original_bytes']):.1f} MB → {mb(st_['sent_bytes']):.1f} MB | "
+            f"~{st_['sent_tokens']:,} tokens | ⏱️ ~{minutes}min{seconds:02d}s | "
+            f"💲 ~US$ {est['cost_usd']:.2f}").replace(",", ".")
+
+# --- GERAÇÃO EM STREAMING ---
+
+def generate_streaming(parts, on_text=None, json_schema=None):
+    """Gera a resposta em streaming, chamando on_text(texto_acumulado) a cada pedaço recebido."""
+    text = ""
+    for piece in llm.get_backend().stream(parts, json_schema=json_schema):
+        text += piece
+        if on_text: on_text(text)
+    return text
+
+def _partial_report(dados, numbers=None):
+    """Markdown das questões que já começaram a chegar no JSON em streaming."""
+    present = [n for n in (numbers or sorted(REPORT_FIELDS)) if REPORT_FIELDS[n][1][0] in dados]
+    return render_report_markdown(dados, present) if present else ""
+
+def _generate_structured(parts, prompt, numbers=None, on_text=None):
+    """on_text recebe o Markdown parcial, renderizado do JSON incompleto a cada pedaço recebido."""
+    def _partial(raw):
+        partial = parse_partial_report_json(raw)
+        if partial: on_text(_partial_report(partial, numbers))
+    raw = generate_streaming(parts + [prompt], on_text=_partial if on_text else None,
+                             json_schema=build_report_schema(numbers))
+    dados = parse_report_json(raw)
+    if dados is None:
+        raise RuntimeError("A IA não devolveu um relatório estruturado válido")
+    return dados
+
+def generate_sectional(parts, prompt_version=PROMPT_VERSION, on_text=None):
+    """
+    Gera cada grupo de SECTION_GROUPS em paralelo e devolve (relatório unido, dados estruturados ou None).
+    on_text recebe o relatório parcial já na ordem final; é chamado a partir das threads dos grupos.
+    Em prompts estruturados o JSON incompleto de cada grupo é renderizado conforme chega.
+    """
+    structured = prompt_version in STRUCTURED_PROMPTS
+    texts = [""] * len(SECTION_GROUPS)
+    lock = threading.Lock()
+
+    def _run_group(i, numbers):
+        def _partial(text):
+            with lock:
+                texts[i] = text
+                merged = merge_sections(texts)
+            if on_text: on_text(merged)
+        prompt = build_section_prompt(prompt_version, numbers)
+        if not structured:
+            return generate_streaming(parts + [prompt], on_text=_partial)
+        dados = _generate_structured(parts, prompt, numbers, on_text=_partial)
+        _partial(render_report_markdown(dados, numbers))
+        return dados
+
+    with ThreadPoolExecutor(max_workers=len(SECTION_GROUPS)) as ex:
+        futures = [ex.submit(_run_group, i, numbers) for i, (_, numbers) in enumerate(SECTION_GROUPS)]
+        results = [f.result() for f in futures]
+
+    if not structured:
+        return merge_sections(results), None
+    dados = {}
+    for part in results:
+        dados.update(part)
+    return render_report_markdown(dados), dados
+
+def generate_report(parts, prompt_version=PROMPT_VERSION, mode=ANALYSIS_MODE, on_text=None):
+    """Retorna (relatório em Markdown, dados estruturados ou None)."""
+    if mode == 'sectional':
+        return generate_sectional(parts, prompt_version, on_text=on_text)
+    prompt = ANALYSIS_PROMPTS[prompt_version]
+    if prompt_version in STRUCTURED_PROMPTS:
+        dados = _generate_structured(parts, prompt, on_text=on_text)
+        text = render_report_markdown(dados)
+        if on_text: on_text(text)
+        return text, dados
+    return generate_streaming(parts + [prompt], on_text=on_text), None
+
+# --- CACHE DE RESULTADOS ---
+# O mesmo edital (mesmos bytes) com o mesmo prompt e modelo gera o mesmo relatório:
+# reaproveitamos o texto e apenas gravamos uma nova entrada no histórico do usuário.
+
+def analysis_cache_key(file_hashes, prompt_version=PROMPT_VERSION, model_name=None, mode=ANALYSIS_MODE, slim=SLIM_PDFS):
+    model_name = model_name or llm.get_backend().model_name
+    raw = "|".join(sorted(file_hashes)) + f"|{prompt_version}|{model_name}|{pdf_tools.prep_tag(slim)}|{mode}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def get_cached_analysis(files, prompt_version=PROMPT_VERSION, mode=ANALYSIS_MODE, slim=SLIM_PDFS):
+    """files: lista de (nome, bytes). Retorna (chave, registro do cache ou None)."""
+    key = analysis_cache_key([file_sha256(d) for _, d in files], prompt_version, mode=mode, slim=slim)
+    return key, db.get_analysis_cache(key)
+
+def get_cached_file_handles(files, slim=SLIM_PDFS):
+    """Handles ainda vivos no Gemini para os PDFs informados (sem reenviar nada)."""
+    handles = []
+    for name, data in files:
+        parts, _ = prepare_document(name, data, slim)
+        for part in parts:
+            handle = _fetch_cached_handle(part[3])
+            if handle is not None: handles.append(handle)
+    return handles
+
+def save_analysis_to_history(username, title, content, dados=None, files=None, slim=SLIM_PDFS, commit=None):
+    """
+    Indexa o edital e grava o item no histórico como última etapa (o item só existe se tudo antes deu certo).
+    commit: jobs.JobContext.commit, quando executado num job (a gravação não é mais cancelada nem expirada).
+    """
+    doc_id = db.new_history_id(username)
+    chat_index = _safe_build_edital_index(username, doc_id, files, slim) if files else None
+    def _save():
+        saved = db.save_analysis_history(username, title, content, dados=dados, doc_id=doc_id,
+                                         extra={'chat_index': chat_index} if chat_index else None)
+        if not saved:
+            raise RuntimeError("Não foi possível salvar a análise no histórico")
+        return saved
+    try:
+        return commit(_save) if commit else _save()
+    except BaseException:
+        if chat_index: db.delete_edital_index(username, doc_id)
+        raise
+
+def save_cached_analysis_to_history(username, key, cached, files=None, slim=SLIM_PDFS, commit=None):
+    doc_id = save_analysis_to_history(username, cached['title'], cached['content'], cached.get('dados'),
+                                      files, slim, commit=commit)
+    db.register_analysis_cache_hit(key)
+    return doc_id
+
+def _safe_build_edital_index(username, doc_id, files, slim):
+    """Metadados do índice gravado ({'version', 'chunks'}) ou None (sem índice: o chat usa o relatório)."""
+    try:
+        return build_edital_index(username, doc_id, files, slim)
+    except Exception as e:
+        print(f"Erro ao indexar o edital {doc_id}: {e}")  # O chat segue funcionando com o relatório
+        return None
+
+def get_file_handles(names):
+    """Recupera os handles do Gemini pelos nomes (ex.: 'files/abc'), ignorando os que já expiraram."""
+    handles = []
+    for name in names:
+        try:
+            handles.append(llm.get_backend().get_file(name))
+        except Exception:
+            pass
+    return handles
+
+# --- ACERVO DA EMPRESA (CRUZAMENTO) ---
+
+COMPANY_FETCH_WORKERS = 8   # Leituras simultâneas do índice no Storage
+
+def _load_company_doc(username, path, meta):
+    """(metadados, páginas) de um documento; indexa na hora os enviados antes do índice existir."""
+    pages = db.get_company_file_pages(path) if meta else None
+    if pages is not None:
+        return meta, pages, False
+    data = db.download_storage_file(path)
+    if data is None:
+        return None, None, False
+    parts = path.split('/', 3)
+    section, sub_item, filename = parts[1:4] if len(parts) == 4 else ("", "", parts[-1])
+    indexed = db.index_company_file(data, path, username, section, sub_item, filename)
+    if indexed is None:
+        meta, pages = company_index.build_document_index(data, filename, section, sub_item)
+        meta['path'] = path
+        return meta, pages, True
+    return indexed[0], indexed[1], True
+
+def _extract_catalogue(username, meta, pages):
+    """Cataloga um atestado/CAT uma única vez (a IA lê o texto, ou o PDF se for digitalizado)."""
+    if meta.get('visual'):
+        data = db.download_storage_file(meta['path'])
+        if data is None: return None
+        parts, errors, _ = prepare_and_upload([(meta['filename'], data)])
+        if errors: return None
+    else:
+        parts = [pdf_tools.format_text_pages(meta['filename'], pages)[:catalogue.CATALOGUE_TEXT_CHARS]]
+    raw = llm.get_backend().generate(parts + [catalogue.CATALOGUE_PROMPT], json_schema=catalogue.CATALOGUE_SCHEMA)
+    data = parse_report_json(raw)
+    if data is None: return None
+    db.save_company_doc_catalogue(username, meta['path'], data, catalogue.CATALOGUE_VERSION)
+    meta['catalogue'], meta['catalogue_version'] = data, catalogue.CATALOGUE_VERSION
+    return data
+
+def build_catalogue(username, docs):
+    """Garante o catálogo dos atestados/CATs; extrai em paralelo só os ainda não catalogados."""
+    pending = [(m, p) for m, p in docs if catalogue.needs_extraction(m)]
+    if pending:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as ex:
+            futures = [ex.submit(_extract_catalogue, username, m, p) for m, p in pending]
+            for fut in as_completed(futures):
+                try: fut.result()
+                except Exception as e: print(f"Erro ao catalogar: {e}")
+    return [(m, m['catalogue']) for m, _ in docs
+            if catalogue.is_catalogued(m) and m.get('catalogue_version') == catalogue.CATALOGUE_VERSION]
+
+def load_company_docs(username):
+    """Índice do acervo [(metadados, páginas)] com os atestados/CATs já catalogados. Retorna (docs, nº indexados agora)."""
+    index = {m.get('path'): m for m in db.get_company_index(username)
+             if m.get('version') == company_index.INDEX_VERSION}
+    paths = db.list_company_pdf_paths(username)
+    docs, indexed_now = [], 0
+    with ThreadPoolExecutor(max_workers=COMPANY_FETCH_WORKERS) as ex:
+        for meta, pages, fresh in ex.map(lambda p: _load_company_doc(username, p, index.get(p)), paths):
+            if meta is None: continue
+            docs.append((meta, pages))
+            indexed_now += fresh
+    build_catalogue(username, [(m, p) for m, p in docs if catalogue.is_catalogued(m)])
+    return docs, indexed_now
+
+def prepare_company_context(username, report_text, dados=None, company_docs=None, on_progress=None):
+    """
+    Contexto da empresa para o cruzamento. As exigências dos itens 7–10 do relatório escolhem as subpastas do
+    acervo e os documentos mais relevantes; vão os resumos dessas pastas e os trechos de cada exigência como texto,
+    e só os documentos digitalizados escolhidos vão como PDF.
+    company_docs: resultado de load_company_docs, para reaproveitar o acervo entre vários editais.
+    on_progress(enviados, total, nome): a cada digitalizado enviado (baixados e enviados em fluxo, um a um).
+    Retorna (partes para a IA, estatísticas com o plano de envio).
+    """
+    docs, indexed_now = company_docs or load_company_docs(username)
+    requirements = report_requirements(report_text, dados) or [(0, report_text)]
+
+    # Atestados/CATs catalogados são comparados localmente; os que falharem na catalogação seguem como trechos
+    entries = [(m, m['catalogue']) for m, _ in docs
+               if catalogue.is_catalogued(m) and m.get('catalogue_version') == catalogue.CATALOGUE_VERSION]
+    catalogued = {m['path'] for m, _ in entries}
+    matches = catalogue.match_requirements(catalogue.technical_requirements(requirements, dados), entries)
+    context, plan, used = company_index.build_company_context(
+        [(m, p) for m, p in docs if m['path'] not in catalogued], requirements)
+    if entries:
+        context = catalogue.format_matches(matches) + "\n\n" + context
+    visual_docs = [meta for meta in used if meta.get('visual')]
+    visual, sent = [], []
+    def _downloaded():
+        for i, _, local in db.iter_storage_files([m['path'] for m in visual_docs]):
+            if local is None: continue
+            with open(local, "rb") as f:
+                data = f.read()
+            visual.append(visual_docs[i]['filename'])
+            yield visual_docs[i]['filename'], data
+    def _uploaded(name, err):
+        sent.append(name)
+        if on_progress: on_progress(len(sent), len(visual_docs), name)
+    handles, errors, _ = prepare_and_upload(_downloaded(), on_progress=_uploaded) if visual_docs else ([], [], {})
+
+    names = {m['path']: m['filename'] for m, _ in docs}
+    # Os catalogados ficam fora do roteamento: o plano mostra, em cada exigência, os que foram comparados
+    # localmente (pela descrição exata; senão, todos os do item: 10 para profissionais, 9 para o resto)
+    compared = {}
+    for m in matches:
+        files = [e['arquivo'] for e in m['evidencias'] + m['possiveis']]
+        for key in (m['descricao'], 10 if m['tipo'] == 'profissional' else 9):
+            compared.setdefault(key, []).extend(files)
+    stats = {'docs': len(docs), 'sent_docs': len(used), 'excerpts': sum(p['excerpts'] for p in plan),
+             'context_chars': len(context), 'visual_docs': len(visual), 'indexed_now': indexed_now,
+             'errors': [n for n, _ in errors], 'catalogued': len(entries), 'matches': matches,
+             'plan': [{'item': p['item'], 'requirement': p['requirement'],
+                       'folders': [f"{sec} / {sub}" for sec, sub in p['folders']],
+                       'files': [names.get(f, f) for f in p['files']],
+                       'catalogue': list(dict.fromkeys(compared.get(p['requirement']) or compared.get(p['item'], [])))}
+                      for p in plan]}
+    return [context] + handles, stats
+
+def format_company_context(stats):
+    if not stats or not stats.get('docs'): return ""
+    out = (f"📚 Acervo: {stats.get('sent_docs', stats['docs'])} de {stats['docs']} documento(s) selecionados, "
+           f"{stats['excerpts']} trecho(s) relevantes "
+           f"(~{stats['context_chars'] // pdf_tools.CHARS_PER_TOKEN:,} tokens)").replace(",", ".")
+    if stats.get('catalogued'):
+        out += f" | 🏗️ {stats['catalogued']} atestado(s)/CAT(s) comparados localmente"
+    if stats['visual_docs']:
+        out += f" | {stats['visual_docs']} digitalizado(s) enviado(s) como PDF"
+    if stats.get('errors'):
+        out += " | ⚠️ Falha no envio: " + ", ".join(stats['errors'])
+    return out
+
+def format_company_plan(stats):
+    """Markdown com o que foi enviado à IA para cada exigência (campo 'viability_plan' do item, só exibido na tela)."""
+    if not stats or not stats.get('plan'): return ""
+    lines = []
+    if stats.get('matches'):
+        lines.append("#### 🏗️ Pré-avaliação dos atestados/CATs (comparação local)")
+        for m in stats['matches']:
+            ev = m['evidencias'][0]['arquivo'] if m['evidencias'] else "—"
+            line = f"- {catalogue.STATUS_ICONS[m['status']]} **{m['descricao'][:120]}** → {m['status']} ({ev})"
+            if m.get('possiveis'):
+                line += " | possível: " + ", ".join(dict.fromkeys(e['arquivo'] for e in m['possiveis']))
+            lines.append(line)
+    lines.append("#### 📦 Documentos da empresa enviados à IA")
+    for step in stats['plan']:
+        label = f"Item {step['item']}: {step['requirement'][:120]}" if step['item'] else "Edital completo"
+        parts = [", ".join(step['files'])] if step['files'] else []
+        if step.get('catalogue'):
+            parts.append("atestados/CATs comparados localmente: " + ", ".join(step['catalogue']))
+        files = " | ".join(parts) or "nenhum documento com conteúdo relacionado"
+        lines.append(f"- **{label}** → {'; '.join(step['folders'])} → {files}")
+    return "\n".join(lines)
+
+# --- BUSCA NO EDITAL (CHAT) ---
+
+_edital_indexes = {}  # doc_id -> índice BM25 (None = item sem índice)
+_EDITAL_INDEX_MAX = 20
+
+def _remember_index(doc_id, index):
+    with _file_lock:
+        if len(_edital_indexes) >= _EDITAL_INDEX_MAX:
+            _edital_indexes.pop(next(iter(_edital_indexes)))
+        _edital_indexes[doc_id] = index
+
+def build_edital_index(username, doc_id, files, slim=SLIM_PDFS):
+    """
+    Cria e grava o índice de busca do edital a partir da camada de texto já extraída na análise.
+    Retorna os metadados para o campo 'chat_index' do item, ou None se nada foi gravado.
+    """
+    pages = []
+    for name, data in files:
+        parts, _ = prepare_document(name, data, slim)
+        for _, part_data, mime, _ in parts:
+            if mime == "text/plain":
+                pages.extend(retrieval.pages_from_formatted(part_data.decode('utf-8')))
+    index = retrieval.build_index(retrieval.chunk_pages(pages))
+    if not index['chunks']:
+        return None  # Edital só com páginas digitalizadas: o chat usa o relatório
+    if not db.save_edital_index(username, doc_id, retrieval.dumps(index)):
+        return None
+    _remember_index(doc_id, index)
+    return {'version': retrieval.INDEX_VERSION, 'chunks': len(index['chunks'])}
+
+def get_edital_index(username, doc_id):
+    with _file_lock:
+        if doc_id in _edital_indexes: return _edital_indexes[doc_id]
+    data = db.load_edital_index(username, doc_id)
+    index = retrieval.loads(data) if data else None
+    _remember_index(doc_id, index)
+    return index
+
+# --- CHAT POR EDITAL ---
+# O contexto (arquivos do edital + relatório) vai para o cache do provedor uma vez; cada pergunta paga só o turno novo.
+# Sem cache no provedor, cada pergunta leva apenas o relatório (contexto local reduzido) em vez dos arquivos.
+
+CHAT_CACHE_TTL_SECONDS = 60 * 60
+CHAT_CACHE_MARGIN_SECONDS = 120     # Não reaproveita caches que expiram antes disso
+CHAT_CACHE_RETRY_SECONDS = 15 * 60  # Após falha ao criar o cache, o mesmo contexto segue sem cache por esse tempo
+CHAT_INSTRUCTIONS = "Você é um auditor de licitações. Responda às perguntas com base no edital e no relatório abaixo, citando itens e páginas quando possível."
+
+_chat_contexts = {}  # doc_id -> {'key', 'cache', 'expires'}
+_chat_cache_failures = {}  # chave do contexto -> momento da última falha em create_cache
+_CHAT_CACHE_FAILURES_MAX = 200
+
+def _chat_context_key(report_text, handles):
+    raw = report_text + "|" + "|".join(sorted(getattr(h, 'name', str(h)) for h in handles or []))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def _local_chat_parts(report_text):
+    return [f"{CHAT_INSTRUCTIONS}\n\n=== RELATÓRIO DO EDITAL ===\n{report_text}"]
+
+def get_chat_cache(username, doc_id, report_text, handles=None, stored=None):
+    """
+    Nome do cache de contexto do chat no provedor (criado na primeira pergunta e gravado no item), ou None.
+    stored: campo 'chat_cache' do item do histórico, quando já carregado.
+    """
+    key = _chat_context_key(report_text, handles)
+    now = time.time()
+    for rec in (_chat_contexts.get(doc_id), stored):
+        if rec and rec.get('key') == key and rec.get('expires', 0) - CHAT_CACHE_MARGIN_SECONDS > now:
+            _chat_contexts[doc_id] = rec
+            return rec['cache']
+
+    if now - _chat_cache_failures.get(key, 0) < CHAT_CACHE_RETRY_SECONDS:
+        return None  # Falhou há pouco (ex.: contexto abaixo do mínimo do provedor): não tenta a cada pergunta
+    parts = list(handles or []) + _local_chat_parts(report_text)
+    name = llm.get_backend().create_cache(parts, CHAT_CACHE_TTL_SECONDS)
+    if name is None:
+        with _file_lock:
+            if len(_chat_cache_failures) >= _CHAT_CACHE_FAILURES_MAX:
+                _chat_cache_failures.pop(next(iter(_chat_cache_failures)))
+            _chat_cache_failures[key] = now
+        return None
+    _chat_cache_failures.pop(key, None)
+    rec = {'key': key, 'cache': name, 'expires': now + CHAT_CACHE_TTL_SECONDS}
+    _chat_contexts[doc_id] = rec
+    if doc_id: db.update_history_fields(username, doc_id, {'chat_cache': rec})
+    return name
+
+# --- MEMÓRIA DO CHAT ---
+
+CHAT_MEMORY_TURNS = 6       # Últimas mensagens enviadas literalmente (3 perguntas e respostas)
+CHAT_MEMORY_MIN_TURNS = 2   # Mesmo acima do orçamento, a última troca vai literal (encurtada se preciso)
+CHAT_SUMMARY_PROMPT = """
+Atualize o resumo de uma conversa sobre um edital de licitação. Mantenha fatos, números, datas, itens e páginas
+citados, as dúvidas do usuário e as conclusões. Escreva em português, em tópicos curtos, com no máximo {words} palavras.
+
+RESUMO ATUAL:
+{summary}
+
+NOVAS MENSAGENS:
+{turns}
+"""
+
+def _tokens(text):
+    return len(text) // llm.CHARS_PER_TOKEN
+
+def new_chat_memory(stored=None):
+    """Estado da memória: resumo das mensagens antigas e quantas mensagens do histórico ele já cobre."""
+    stored = stored or {}
+    return {'summary': stored.get('summary', ''), 'folded': stored.get('folded', 0)}
+
+def _summarize_turns(summary, turns, max_tokens):
+    text = "\n".join(f"{'USUÁRIO' if r == 'user' else 'ASSISTENTE'}: {t}" for r, t in turns)
+    prompt = CHAT_SUMMARY_PROMPT.format(words=max(max_tokens * 3 // 4, 50), summary=summary or "(vazio)", turns=text)
+    try:
+        out = llm.get_backend().generate([prompt]).strip()
+    except Exception as e:
+        print(f"Erro ao resumir a conversa: {e}")
+        out = f"{summary}\n{text}".strip()  # Sem resumo da IA: guarda o texto, cortado abaixo
+    return out[-max_tokens * llm.CHARS_PER_TOKEN:]
+
+def chat_memory_turns(memory, history, budget):
+    """
+    Turnos enviados à IA: resumo das mensagens antigas + as últimas mensagens literais, dentro de budget tokens.
+    As mensagens que saem da janela são incorporadas ao resumo (memory é atualizado).
+    Retorna (turnos [(papel, texto)], se memory mudou).
+    """
+    changed = False
+    if memory['folded'] > len(history):  # Conversa reiniciada
+        memory.update(summary='', folded=0)
+        changed = True
+    recent = history[memory['folded']:]
+    size = lambda msgs: _tokens(memory['summary']) + sum(_tokens(t) for _, t in msgs)
+
+    # Dobra em pares (pergunta + resposta) para manter a alternância de papéis
+    cut = 0
+    while len(recent) - cut > CHAT_MEMORY_MIN_TURNS and (len(recent) - cut > CHAT_MEMORY_TURNS or size(recent[cut:]) > budget):
+        cut += 2
+    cut = min(cut, max(len(recent) - CHAT_MEMORY_MIN_TURNS, 0))
+    if cut:
+        memory['summary'] = _summarize_turns(memory['summary'], recent[:cut], budget // 4)
+        memory['folded'] += cut
+        recent = recent[cut:]
+        changed = True
+
+    # Mensagens muito longas: encurta as literais para caber no que sobra do orçamento
+    left = budget - _tokens(memory['summary'])
+    if recent and size(recent) > budget:
+        per_msg = max(left // len(recent), 100) * llm.CHARS_PER_TOKEN
+        recent = [(r, t if len(t) <= per_msg else t[:per_msg] + " [...]") for r, t in recent]
+
+    turns = list(recent)
+    if memory['summary']:
+        turns = [("user", f"RESUMO DA CONVERSA ATÉ AQUI:\n{memory['summary']}"), ("assistant", "Entendido.")] + turns
+    return turns, changed
+
+def chat_stream(username, doc_id, report_text, history, message, handles=None, stored_cache=None,
+                memory=None, budget=None):
+    """
+    Responde uma pergunta da conversa do edital em pedaços de texto, conforme chegam da IA.
+    A troca é gravada no histórico do item só quando a resposta termina sem erro.
+    history: turnos anteriores [(papel, texto)], sem a pergunta atual. Vai para a IA resumido pela memória
+    (memory, de new_chat_memory, e budget em tokens, de db.get_chat_memory_budget). O resumo é feito numa cópia
+    e só passa para memory (e para o item) depois que a troca for gravada: uma falha não deixa a pergunta sem
+    resposta dentro do resumo.
+    """
+    backend = llm.get_backend()
+    if memory is None: memory = new_chat_memory()
+    folded = dict(memory)
+    history, memory_changed = chat_memory_turns(folded, history, budget or db.get_chat_memory_budget(None))
+    # Com o índice do edital, vão só os trechos relevantes à pergunta em vez da camada de texto inteira;
+    # as páginas digitalizadas não estão no índice e seguem como arquivo
+    index = get_edital_index(username, doc_id) if doc_id else None
+    hits = retrieval.search(index, message) if index else []
+    if index: handles = [h for h in handles or [] if getattr(h, 'mime_type', None) != "text/plain"]
+    prompt = message
+    if hits:
+        prompt = (f"TRECHOS DO EDITAL (cite arquivo e página ao usá-los):\n{retrieval.format_results(hits)}"
+                  f"\n\nPERGUNTA: {message}")
+
+    def _open(parts, cache_name):
+        pieces = backend.chat_stream(parts, history, prompt, cache_name=cache_name)
+        first = next(pieces, "")  # Falhas de cache/conexão aparecem antes do primeiro pedaço
+        return itertools.chain([first], pieces)
+
+    cache = get_chat_cache(username, doc_id, report_text, handles, stored_cache)
+    pieces = None
+    if cache:
+        try:
+            pieces = _open([], cache)
+        except Exception:
+            _chat_contexts.pop(doc_id, None)  # Cache expirado/removido no provedor: segue com o contexto local
+    if pieces is None:
+        pieces = _open(_local_chat_parts(report_text), None)
+    answer = ""
+    for piece in pieces:
+        if piece:
+            answer += piece
+            yield piece
+    if doc_id and not db.add_chat_messages(username, doc_id, [("user", message), ("assistant", answer)]):
+        return  # Troca não gravada: a memória continua como estava
+    memory.update(folded)
+    if doc_id and memory_changed: db.update_history_fields(username, doc_id, {'chat_memory': dict(memory)})
+
+# --- VIABILIDADE (EDITAL x EMPRESA) ---
+
+VIABILITY_WORKERS = 3   # Editais cruzados ao mesmo tempo no modo em lote
+VIABILITY_HEADER = "\n\n---\n\n# 🛡️ VIABILIDADE (Gerada via Histórico)\n"
+
+def build_viability_prompt(report_text, company_name):
+    return f"""
+    ATUE COMO AUDITOR SÊNIOR DE ENGENHARIA. 
+    Compare o acervo da empresa (resumos, trechos relevantes e digitalizações anexadas) com o seguinte resumo de edital:
+    
+    --- INÍCIO RESUMO EDITAL ---
+    {report_text}
+    --- FIM RESUMO EDITAL ---
+    
+    ⚠️ DADOS DA EMPRESA PARA VALIDAÇÃO:
+    Nome/Razão Social: "{company_name}"
+
+    DIRETRIZES:
+    1. Analise TODOS os documentos.
+    2. Aplique FLEXIBILIDADE TÉCNICA (serviços similares são aceitos).
+    3. Havendo a PRÉ-AVALIAÇÃO LOCAL dos atestados/CATs, use seus status e evidências como base e apenas redija o parecer.
+    
+    TAREFA: Gere um Checklist de Viabilidade separado nas seguintes categorias OBRIGATÓRIAS:
+    
+    A) QUALIFICAÇÃO TÉCNICA OPERACIONAL (EMPRESA)
+    - Verifique se a EMPRESA "{company_name}" (PJ) possui os atestados exigidos.
+    - Ignore atestados em nome de terceiros para esta qualificação.
+    - Item do Edital -> Documento da Empresa -> Veredito.
+    
+    B) QUALIFICAÇÃO TÉCNICA PROFISSIONAL (EQUIPE)
+    - Verifique se o PROFISSIONAL (PF) possui as CATs/Atestados exigidos.
+    - Item do Edital -> Documento do Profissional -> Veredito.
+    
+    C) DEMAIS HABILITAÇÕES (Jurídica, Fiscal, Financeira)
+    - Verifique as demais exigências.
+    """
+
+def run_viability(username, item, company_name, company_docs=None, on_progress=None):
+    """
+    Cruza um item do histórico com o acervo e grava o parecer no próprio item. Retorna (conteúdo novo, estatísticas).
+    O plano de envio fica em 'viability_plan', fora do conteúdo (que vai para o PDF, o chat e a busca).
+    """
+    # Refazer o cruzamento substitui o parecer anterior em vez de empilhar outro
+    report_text = item['content'].split(VIABILITY_HEADER)[0]
+    parts, stats = prepare_company_context(username, report_text, item.get('dados'), company_docs, on_progress)
+    resp_text = llm.get_backend().generate(parts + [build_viability_prompt(report_text, company_name)])
+    new_content = report_text + VIABILITY_HEADER + resp_text
+    if not db.update_history_fields(username, item['id'], {'content': new_content, 'has_viability': True,
+                                                           'viability_plan': format_company_plan(stats)}):
+        raise RuntimeError("Não foi possível salvar o parecer no histórico")
+    return new_content, stats
+
+def run_bulk_viability_job(ctx):
+    """Cruzamento de vários itens do histórico: acervo preparado uma vez, editais em paralelo (VIABILITY_WORKERS)."""
+    ids = ctx.payload.get('ids', [])
+    company_name = ctx.payload.get('company_name') or 'Empresa Licitante'
+    ctx.progress(0.02, "Preparando o acervo da empresa...")
+    company_docs = load_company_docs(ctx.username)
+    if not company_docs[0]:
+        raise RuntimeError("Você não tem documentos na pasta da empresa")
+
+    done, failed = [], []
+    def _one(doc_id):
+        item = db.get_history_item(ctx.username, doc_id)
+        if not item: raise RuntimeError("Item não encontrado no histórico")
+        item['id'] = doc_id
+        def _uploads(sent, total, name):
+            # Threads do pool só atualizam a mensagem; o cancelamento é tratado no laço principal
+            ctx.note(f"📤 {sent}/{total} digitalizado(s) da empresa enviados: {name}")
+        run_viability(ctx.username, item, company_name, company_docs, on_progress=_uploads)
+        return title_from_data(item['dados']) if item.get('dados') else extract_title(item['content'])
+
+    ctx.progress(0.1, f"Cruzando {len(ids)} editais...")
+    with ThreadPoolExecutor(max_workers=max(1, min(VIABILITY_WORKERS, len(ids)))) as ex:
+        futures = {ex.submit(_one, doc_id): doc_id for doc_id in ids}
+        pending = set(futures)
+        try:
+            while pending:
+                finished, pending = wait(pending, timeout=jobs.POLL_SECONDS, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    doc_id = futures[fut]
+                    try:
+                        done.append({'id': doc_id, 'title': fut.result()})
+                        icon = "✅"
+                    except Exception as e:
+                        failed.append({'id': doc_id, 'error': str(e)})
+                        icon = "❌"
+                    n = len(done) + len(failed)
+                    ctx.progress(0.1 + 0.9 * n / len(ids), f"{icon} {n}/{len(ids)} editais processados")
+                if not finished:
+                    ctx.check()
+        except (jobs.JobCancelled, jobs.JobTimeout):
+            for f in pending: f.cancel()  # Os que já começaram terminam e são gravados normalmente
+            raise
+    return {'done': done, 'failed': failed}
+
+# --- JOB DE ANÁLISE (executado pelos workers de jobs.py) ---
+
+def run_analysis_job(ctx):
+    """Envio dos arquivos -> geração do relatório -> título -> histórico."""
+    prompt_version = ctx.payload.get('prompt_version', PROMPT_VERSION)
+    mode = ctx.payload.get('mode', ANALYSIS_MODE)
+    slim = ctx.payload.get('slim', SLIM_PDFS)
+    files = ctx.read_files()
+
+    cache_key, cached = get_cached_analysis(files, prompt_version, mode, slim)
+    if cached:
+        ctx.set_partial(cached['content'], force=True)
+        handles = get_cached_file_handles(files, slim)
+        doc_id = save_cached_analysis_to_history(ctx.username, cache_key, cached, files, slim, commit=ctx.commit)
+        return {'doc_id': doc_id, 'title': cached['title'], 'file_names': [h.name for h in handles], 'cached': True}
+
+    ctx.progress(0.05, f"Extraindo texto e enviando {len(files)} arquivos...")
+    sent = []
+    def _on_upload(name, err):
+        sent.append(name)
+        icon = "❌" if err else "✅"
+        ctx.progress(0.05 + 0.35 * min(len(sent) / max(len(files), 1), 1.0), f"{icon} {name}")
+
+    handles, errors, prep_stats = prepare_and_upload(files, on_progress=_on_upload, slim=slim)
+    if errors:
+        falhas = ", ".join(n for n, _ in errors)
+        raise RuntimeError(f"Falha no envio de {len(errors)} arquivo(s): {falhas}. "
+                           f"Os {len(handles)} já enviados ficam em cache para a próxima tentativa")
+
+    ctx.progress(0.45, "Gerando Relatório Detalhado... " + format_savings(prep_stats))
+    full_text, dados = generate_report(handles, prompt_version, mode, on_text=ctx.set_partial)
+    ctx.set_partial(full_text, force=True)
+
+    ctx.progress(0.95, "Indexando o edital para o chat e salvando no histórico...")
+    title = title_from_data(dados) if dados else extract_title(full_text)
+    db.save_analysis_cache(cache_key, {
+        'title': title, 'content': full_text, 'dados': dados,
+        'prompt_version': prompt_version, 'model': llm.get_backend().model_name, 'mode': mode
+    })
+    # Gravação no histórico por último: depois dela o job não pode mais falhar (nem devolver o crédito)
+    doc_id = save_analysis_to_history(ctx.username, title, full_text, dados, files, slim, commit=ctx.commit)
+    return {'doc_id': doc_id, 'title': title, 'file_names': [h.name for h in handles], 'prep_stats': prep_stats}
+
+# --- JOB DE MIGRAÇÃO DOS CAMPOS DE RESUMO (painel admin) ---
+
+def run_summary_backfill_job(ctx):
+    def _progress(done, total, updated):
+        ctx.progress(done / max(total, 1), f"{done}/{total} usuários | {updated} itens atualizados")
+    return db.backfill_history_summaries(ctx.payload.get('usernames'), on_progress=_progress)
+
+jobs.register_handler('analysis', run_analysis_job)
+jobs.register_handler('viability_bulk', run_bulk_viability_job)
+jobs.register_handler('summary_backfill', run_summary_backfill_job, background=True)  # Horas: fora dos WORKERS
@@ -0,0 +1,339 @@
+# --- ARQUIVO: jobs.py ---
+# Fila de tarefas de IA (SQLite local), independente da execução do script do Streamlit.
+# A página apenas cria o job e acompanha o andamento; os workers fazem o trabalho pesado.
+# Os workers podem rodar dentro do processo do Streamlit (start_workers) ou à parte (worker.py).
+import database as db
+import sqlite3
+import threading
+import traceback
+import shutil
+import json
+import time
+import uuid
+import os
+from contextlib import contextmanager
+
+DB_PATH = os.path.join(db.LOCAL_DATA_DIR, "jobs.sqlite3")
+FILES_DIR = os.path.join(db.LOCAL_DATA_DIR, "job_files")
+
+WORKERS = 2                   # Jobs simultâneos por processo
+BACKGROUND_WORKERS = 1        # Workers só dos jobs longos de manutenção (register_handler(background=True))
+JOB_TIMEOUT_SECONDS = 15 * 60 # Tempo máximo de um job em execução
+POLL_SECONDS = 1.0            # Intervalo de busca por novos jobs
+PARTIAL_SECONDS = 1.0         # Intervalo mínimo entre gravações do texto parcial
+KEEP_DAYS = 7                 # Jobs finalizados mais antigos que isso são apagados
+QUEUE_TIMEOUT_SECONDS = 60 * 60  # Jobs na fila há mais tempo que isso (nenhum worker ativo) são encerrados
+SAVE_GRACE_SECONDS = 5 * 60   # Jobs parados na gravação do resultado por mais tempo que isso são encerrados
+
+# 'saving': o handler está gravando o resultado (ctx.commit); não é mais cancelado, expirado nem reembolsado
+ACTIVE = ('queued', 'running', 'saving')
+
+_handlers = {}
+_background_kinds = set()     # Não ocupam os WORKERS que atendem as análises dos usuários
+_init_lock = threading.Lock()
+_initialized = False
+
+class JobCancelled(Exception):
+    pass
+
+class JobTimeout(Exception):
+    pass
+
+# --- BANCO LOCAL ---
+
+def _connect():
+    global _initialized
+    if not _initialized:
+        os.makedirs(db.LOCAL_DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        username TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        progress REAL DEFAULT 0,
+                        message TEXT DEFAULT '',
+                        partial TEXT DEFAULT '',
+                        payload TEXT DEFAULT '{}',
+                        result TEXT,
+                        error TEXT,
+                        cancel_requested INTEGER DEFAULT 0,
+                        seen INTEGER DEFAULT 0,
+                        refunded INTEGER DEFAULT 0,
+                        timeout REAL,
+                        created_at REAL,
+                        started_at REAL,
+                        updated_at REAL,
+                        finished_at REAL
+                    )""")
+                # Bancos criados antes da coluna 'refunded'
+                cols = [r['name'] for r in conn.execute("PRAGMA table_info(jobs)")]
+                if 'refunded' not in cols:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN refunded INTEGER DEFAULT 0")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (username, created_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+                _initialized = True
+    return conn
+
+@contextmanager
+def _db():
+    conn = _connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def _row_to_job(row):
+    if row is None: return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'] or '{}')
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+def _job_dir(job_id):
+    return os.path.join(FILES_DIR, job_id)
+
+# --- API USADA PELA PÁGINA ---
+
+def submit_job(kind, username, payload, files=None, timeout=JOB_TIMEOUT_SECONDS):
+    """
+    Cria um job na fila. files: lista de (nome, bytes) gravados em disco para o worker.
+    payload['charged'] = True indica que um crédito foi consumido (devolvido em caso de falha).
+    """
+    job_id = uuid.uuid4().hex
+    if files:
+        os.makedirs(_job_dir(job_id), exist_ok=True)
+        names = []
+        for i, (name, data) in enumerate(files):
+            fname = f"{i:03d}.pdf"
+            with open(os.path.join(_job_dir(job_id), fname), "wb") as f:
+                f.write(data)
+            names.append([fname, name])
+        payload = {**payload, 'files': names}
+    now = time.time()
+    with _db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, username, status, payload, timeout, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, kind, username, json.dumps(payload), timeout, now, now)
+        )
+    return job_id
+
+def get_job(job_id):
+    with _db() as conn:
+        return _row_to_job(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+def get_user_jobs(username, kind=None, unseen_only=True):
+    """Jobs do usuário (mais recentes primeiro). Por padrão, só os que a página ainda não exibiu."""
+    sql = "SELECT * FROM jobs WHERE username = ?"
+    args = [username]
+    if kind:
+        sql += " AND kind = ?"; args.append(kind)
+    if unseen_only:
+        sql += " AND seen = 0"
+    sql += " ORDER BY created_at DESC"
+    with _db() as conn:
+        return [_row_to_job(r) for r in conn.execute(sql, args).fetchall()]
+
+def mark_job_seen(job_id):
+    with _db() as conn:
+        conn.execute("UPDATE jobs SET seen = 1 WHERE id = ?", (job_id,))
+
+def cancel_job(job_id):
+    """Pede o cancelamento. Jobs ainda na fila são encerrados na hora; os em execução param no próximo checkpoint."""
+    with _db() as conn:
+        conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+    _finish(job_id, 'cancelled', error="Cancelado pelo usuário.", only_from=('queued',))
+
+# --- CONTROLE DE ESTADO ---
+
+def _update(job_id, **fields):
+    fields['updated_at'] = time.time()
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    with _db() as conn:
+        conn.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+
+def _finish(job_id, status, result=None, error=None, only_from=ACTIVE, refund=True):
+    """
+    Finaliza o job uma única vez. Em falha/cancelamento/timeout devolve o crédito consumido (se refund)
+    e marca refunded = 1, que a página usa para dizer se o crédito voltou.
+    """
+    now = time.time()
+    marks = ",".join("?" * len(only_from))
+    with _db() as conn:
+        cur = conn.execute(
+            f"UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, updated_at = ? WHERE id = ? AND status IN ({marks})",
+            (status, json.dumps(result) if result is not None else None, error, now, now, job_id, *only_from)
+        )
+        changed = cur.rowcount == 1
+    if not changed:
+        return False
+
+    job = get_job(job_id)
+    if refund and status != 'done' and job['payload'].get('charged'):
+        db.refund_credit_atomic(job['username'])
+        with _db() as conn:
+            conn.execute("UPDATE jobs SET refunded = 1 WHERE id = ?", (job_id,))
+    shutil.rmtree(_job_dir(job_id), ignore_errors=True)
+    return True
+
+def _claim_next(background=False):
+    """
+    Pega o job mais antigo da fila de forma atômica (vários workers/processos).
+    background: True = só jobs de manutenção; False = todos os outros.
+    """
+    kinds = sorted(_background_kinds)
+    if background and not kinds:
+        return None
+    marks = ",".join("?" * len(kinds))
+    kind_filter = f" AND kind {'IN' if background else 'NOT IN'} ({marks})" if kinds else ""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            f"SELECT * FROM jobs WHERE status = 'queued' AND cancel_requested = 0{kind_filter} ORDER BY created_at LIMIT 1",
+            kinds
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        now = time.time()
+        conn.execute("UPDATE jobs SET status = 'running', started_at = ?, updated_at = ? WHERE id = ?", (now, now, row['id']))
+        conn.execute("COMMIT")
+        return get_job(row['id'])
+    except Exception:
+        if conn.in_transaction: conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def expire_stale_jobs():
+    """Encerra jobs presos (worker morto, estouro de tempo ou fila sem worker) e apaga jobs antigos."""
+    now = time.time()
+    with _db() as conn:
+        running = conn.execute(
+            "SELECT id FROM jobs WHERE status = 'running' AND started_at + timeout + 60 < ?", (now,)
+        ).fetchall()
+        queued = conn.execute(
+            "SELECT id FROM jobs WHERE status = 'queued' AND created_at < ?", (now - QUEUE_TIMEOUT_SECONDS,)
+        ).fetchall()
+        saving = conn.execute(
+            "SELECT id FROM jobs WHERE status = 'saving' AND updated_at < ?", (now - SAVE_GRACE_SECONDS,)
+        ).fetchall()
+        conn.execute("DELETE FROM jobs WHERE status NOT IN ('queued', 'running', 'saving') AND finished_at < ?", (now - KEEP_DAYS * 86400,))
+    for r in running:
+        _finish(r['id'], 'failed', error="Tempo limite excedido.", only_from=('running',))
+    for r in queued:
+        _finish(r['id'], 'failed', error="Nenhum worker disponível para processar o pedido.", only_from=('queued',))
+    for r in saving:
+        # O resultado pode ter sido gravado: sem reembolso automático
+        _finish(r['id'], 'failed', error="Interrompido ao gravar o resultado. Confira o Histórico.",
+                only_from=('saving',), refund=False)
+
+# --- EXECUÇÃO ---
+
+class JobContext:
+    """Entregue ao handler: dados do job, leitura dos arquivos e atualização de progresso."""
+
+    def __init__(self, job):
+        self.job_id = job['id']
+        self.username = job['username']
+        self.payload = job['payload']
+        self.deadline = (job['started_at'] or time.time()) + (job['timeout'] or JOB_TIMEOUT_SECONDS)
+        self._last_partial = 0.0
+
+    def read_files(self):
+        """Lista de (nome original, bytes) enviados com o job."""
+        out = []
+        for fname, name in self.payload.get('files', []):
+            with open(os.path.join(_job_dir(self.job_id), fname), "rb") as f:
+                out.append((name, f.read()))
+        return out
+
+    def check(self):
+        """Interrompe o handler se o job foi cancelado ou passou do tempo limite."""
+        job = get_job(self.job_id)
+        if job is None or job['cancel_requested']:
+            raise JobCancelled()
+        if time.time() > self.deadline:
+            raise JobTimeout()
+
+    def progress(self, value, message):
+        _update(self.job_id, progress=float(value), message=message)
+        self.check()
+
+    def note(self, message):
+        """Só atualiza a mensagem, sem checar cancelamento: seguro em threads auxiliares do handler."""
+        _update(self.job_id, message=message)
+
+    def commit(self, save):
+        """
+        Última etapa do handler: confere cancelamento/prazo e marca o job como 'saving' (atomicamente) antes de
+        chamar save(), que grava o resultado. Depois disso o job não é mais expirado nem tem o crédito devolvido
+        por tempo; se save() falhar, o job falha normalmente. Retorna o valor de save().
+        """
+        self.check()
+        with _db() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'saving', updated_at = ? WHERE id = ? AND status = 'running' AND cancel_requested = 0",
+                (time.time(), self.job_id))
+        if cur.rowcount != 1:
+            raise JobCancelled()  # Cancelado ou expirado entre a checagem e a gravação
+        return save()
+
+    def set_partial(self, text, force=False):
+        if force or time.time() - self._last_partial >= PARTIAL_SECONDS:
+            _update(self.job_id, partial=text)
+            self._last_partial = time.time()
+            self.check()
+
+def register_handler(kind, func, background=False):
+    """
+    Associa um tipo de job à função que o executa: func(ctx) -> resultado (JSON).
+    background: job longo de manutenção, atendido só pelos BACKGROUND_WORKERS.
+    """
+    _handlers[kind] = func
+    if background: _background_kinds.add(kind)
+
+def run_job(job):
+    ctx = JobContext(job)
+    handler = _handlers.get(job['kind'])
+    try:
+        if handler is None:
+            raise RuntimeError(f"Tipo de job desconhecido: {job['kind']}")
+        result = handler(ctx)
+        _finish(job['id'], 'done', result=result)
+    except JobCancelled:
+        _finish(job['id'], 'cancelled', error="Cancelado pelo usuário.")
+    except JobTimeout:
+        _finish(job['id'], 'failed', error="Tempo limite excedido.")
+    except Exception as e:
+        traceback.print_exc()
+        _finish(job['id'], 'failed', error=str(e))
+
+def _worker_loop(stop_event, background=False):
+    while not stop_event.is_set():
+        try:
+            job = _claim_next(background)
+            if job is None:
+                expire_stale_jobs()
+                stop_event.wait(POLL_SECONDS)
+                continue
+            run_job(job)
+        except Exception:
+            traceback.print_exc()
+            stop_event.wait(POLL_SECONDS)
+
+def start_workers(n=WORKERS, background=BACKGROUND_WORKERS):
+    """Inicia n threads de worker e mais background para os jobs de manutenção. Retorna o evento para pará-las."""
+    stop_event = threading.Event()
+    for i in range(n):
+        threading.Thread(target=_worker_loop, args=(stop_event,), name=f"urbano-job-worker-{i}", daemon=True).start()
+    for i in range(background):
+        threading.Thread(target=_worker_loop, args=(stop_event, True), name=f"urbano-job-background-{i}", daemon=True).start()
+    return stop_event
@@ -0,0 +1,268 @@
+# --- ARQUIVO: llm.py ---
+# Backends de modelo de linguagem. Todo acesso à IA (upload, geração, streaming e chat) passa por aqui.
+# URBANO_LLM_BACKEND=gemini (padrão) usa a API do Google; URBANO_LLM_BACKEND=fake usa respostas
+# simuladas, com latência e tamanho configuráveis, para medir o overhead do app e fazer testes de carga.
+import google.generativeai as genai
+from google.generativeai import caching
+import datetime
+import threading
+import json
+import time
+import uuid
+import re
+import os
+
+DEFAULT_MODEL = 'gemini-pro-latest'
+CHARS_PER_TOKEN = 4
+
+class _Usage:
+    """Contador de tokens acumulado pelo backend (somado entre threads)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.data = {'calls': 0, 'input_tokens': 0, 'output_tokens': 0}
+
+    def add(self, input_tokens=0, output_tokens=0):
+        with self._lock:
+            self.data['calls'] += 1
+            self.data['input_tokens'] += input_tokens or 0
+            self.data['output_tokens'] += output_tokens or 0
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.data)
+
+# --- GEMINI ---
+
+class GeminiBackend:
+    name = 'gemini'
+
+    def __init__(self, model_name=DEFAULT_MODEL):
+        self.model_name = model_name
+        self.usage = _Usage()
+
+    def _model(self, json_schema=None):
+        config = None
+        if json_schema:
+            config = {'response_mime_type': 'application/json', 'response_schema': json_schema}
+        return genai.GenerativeModel(self.model_name, generation_config=config)
+
+    def _track(self, response):
+        meta = getattr(response, 'usage_metadata', None)
+        if meta:
+            self.usage.add(getattr(meta, 'prompt_token_count', 0), getattr(meta, 'candidates_token_count', 0))
+
+    def upload(self, path, display_name, mime_type="application/pdf"):
+        return genai.upload_file(path, display_name=display_name, mime_type=mime_type)
+
+    def get_file(self, name):
+        return genai.get_file(name)
+
+    def generate(self, parts, json_schema=None):
+        """json_schema (formato do Gemini) força a resposta em JSON com esses campos."""
+        resp = self._model(json_schema).generate_content(parts)
+        self._track(resp)
+        return resp.text
+
+    def _pieces(self, resp):
+        for chunk in resp:
+            try:
+                piece = chunk.text
+            except ValueError:
+                piece = ""  # Pedaço sem texto (ex.: apenas metadados de segurança)
+            if piece:
+                yield piece
+        self._track(resp)
+
+    def stream(self, parts, json_schema=None):
+        """Gera em streaming, produzindo os pedaços de texto conforme chegam."""
+        yield from self._pieces(self._model(json_schema).generate_content(parts, stream=True))
+
+    def create_cache(self, parts, ttl_seconds):
+        """
+        Guarda o contexto (documentos/relatório) no cache do provedor, cobrado uma vez só.
+        Retorna o nome do cache, ou None se o modelo ou o tamanho do conteúdo não permitirem.
+        """
+        try:
+            model = self.model_name if self.model_name.startswith('models/') else f"models/{self.model_name}"
+            cache = caching.CachedContent.create(
+                model=model, contents=[{'role': 'user', 'parts': list(parts)}],
+                ttl=datetime.timedelta(seconds=ttl_seconds)
+            )
+            return cache.name
+        except Exception:
+            return None
+
+    def _start_chat(self, context_parts, history, cache_name):
+        turns = [{'role': 'user' if r == 'user' else 'model', 'parts': [t]} for r, t in history]
+        if cache_name:
+            model = genai.GenerativeModel.from_cached_content(cached_content=caching.CachedContent.get(cache_name))
+        else:
+            model = self._model()
+            if context_parts:
+                turns = [{'role': 'user', 'parts': list(context_parts)},
+                         {'role': 'model', 'parts': ["Documentos recebidos."]}] + turns
+        return model.start_chat(history=turns)
+
+    def chat(self, context_parts, history, message, cache_name=None):
+        """
+        history: [(papel, texto)] com papel 'user' ou 'assistant'. context_parts vai no início da conversa.
+        Com cache_name o contexto vem do cache do provedor e context_parts é ignorado.
+        """
+        resp = self._start_chat(context_parts, history, cache_name).send_message(message)
+        self._track(resp)
+        return resp.text
+
+    def chat_stream(self, context_parts, history, message, cache_name=None):
+        """Como chat, produzindo a resposta em pedaços conforme chegam."""
+        yield from self._pieces(self._start_chat(context_parts, history, cache_name).send_message(message, stream=True))
+
+# --- FAKE (BENCHMARK / TESTES DE CARGA) ---
+
+class FakeFile:
+    """Imita o handle retornado por genai.upload_file."""
+
+    def __init__(self, display_name, mime_type, size):
+        self.name = f"files/fake-{uuid.uuid4().hex[:12]}"
+        self.uri = f"fake://{self.name}"
+        self.display_name = display_name
+        self.mime_type = mime_type
+        self.size_bytes = size
+        self.state = type('State', (), {'name': 'ACTIVE'})()
+        self.expiration_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48)
+
+class FakeBackend:
+    name = 'fake'
+
+    def __init__(self, latency=None, tokens_per_second=None, report_tokens=None, chat_tokens=None, upload_seconds=None):
+        env = os.environ.get
+        self.model_name = 'fake'
+        self.latency = float(latency if latency is not None else env("URBANO_FAKE_LATENCY", "0.5"))
+        self.tokens_per_second = float(tokens_per_second if tokens_per_second is not None else env("URBANO_FAKE_TPS", "400"))
+        self.report_tokens = int(report_tokens if report_tokens is not None else env("URBANO_FAKE_REPORT_TOKENS", "3000"))
+        self.chat_tokens = int(chat_tokens if chat_tokens is not None else env("URBANO_FAKE_CHAT_TOKENS", "200"))
+        self.upload_seconds = float(upload_seconds if upload_seconds is not None else env("URBANO_FAKE_UPLOAD_SECONDS", "0.2"))
+        self.usage = _Usage()
+        self._files = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def upload(self, path, display_name, mime_type="application/pdf"):
+        time.sleep(self.upload_seconds)
+        f = FakeFile(display_name, mime_type, os.path.getsize(path))
+        with self._lock:
+            self._files[f.name] = f
+        return f
+
+    def get_file(self, name):
+        with self._lock:
+            if name not in self._files:
+                raise KeyError(f"Arquivo inexistente no backend fake: {name}")
+            return self._files[name]
+
+    def _input_tokens(self, parts):
+        total = 0
+        for p in parts:
+            total += (len(p) if isinstance(p, str) else getattr(p, 'size_bytes', 0)) // CHARS_PER_TOKEN
+        return total
+
+    def _canned_text(self, parts):
+        """Relatório simulado respondendo às questões numeradas do prompt, ou uma resposta curta."""
+        prompt = next((p for p in reversed(parts) if isinstance(p, str)), "")
+        numbers = [int(n) for n in re.findall(r"^\s*(\d+)\.\s", prompt, re.MULTILINE)]
+        if not numbers:
+            return self._filler("Resposta simulada (backend fake).", self.chat_tokens)
+        per_question = max(self.report_tokens // 16, 10)
+        session = (datetime.date.today() + datetime.timedelta(days=10)).strftime("%d/%m/%Y")
+        fixed = {
+            1: "Prefeitura Municipal de Exemplo",
+            2: "Contratação de empresa de engenharia para pavimentação de vias urbanas.",
+            3: "R$ 1.234.567,89",
+            4: "Portal de Compras Públicas",
+            5: f"DATA_CHAVE: {session} às 09:00",
+        }
+        blocks = [f"{n}. {self._filler(fixed.get(n, 'Resposta simulada.'), per_question)}" for n in numbers]
+        return "\n\n".join(blocks)
+
+    def _filler(self, head, tokens):
+        words = max(tokens - len(head) // CHARS_PER_TOKEN, 0)
+        return head + ("" if not words else "\n" + " ".join(["lorem"] * words))
+
+    def _emit(self, text):
+        time.sleep(self.latency)
+        step = 40 * CHARS_PER_TOKEN  # ~40 tokens por pedaço
+        for i in range(0, len(text), step):
+            piece = text[i:i + step]
+            time.sleep(len(piece) / CHARS_PER_TOKEN / self.tokens_per_second)
+            yield piece
+
+    def _canned_json(self, schema, field=''):
+        """Objeto simulado que segue o esquema JSON pedido."""
+        kind = schema.get('type', 'STRING').upper()
+        if kind == 'OBJECT':
+            return {k: self._canned_json(v, k) for k, v in schema.get('properties', {}).items()}
+        if kind == 'ARRAY':
+            return [self._canned_json(schema.get('items', {}), field) for _ in range(3)]
+        if kind == 'NUMBER':
+            return 1000
+        if 'enum' in schema:
+            return schema['enum'][0]
+        fixed = {
+            'orgao': "Prefeitura Municipal de Exemplo",
+            'objeto': "Contratação de empresa de engenharia para pavimentação de vias urbanas.",
+            'valor_estimado': "R$ 1.234.567,89",
+            'plataforma': "Portal de Compras Públicas",
+            'data_sessao': (datetime.date.today() + datetime.timedelta(days=10)).strftime("%d/%m/%Y"),
+            'hora_sessao': "09:00",
+            'unidade': "m²",
+        }
+        return fixed.get(field) or self._filler("Resposta simulada.", max(self.report_tokens // 60, 5)).replace("\n", " ")
+
+    def generate(self, parts, json_schema=None):
+        return "".join(self.stream(parts, json_schema))
+
+    def stream(self, parts, json_schema=None):
+        text = json.dumps(self._canned_json(json_schema), ensure_ascii=False) if json_schema else self._canned_text(parts)
+        yield from self._emit(text)
+        self.usage.add(self._input_tokens(parts), len(text) // CHARS_PER_TOKEN)
+
+    def create_cache(self, parts, ttl_seconds):
+        name = f"cachedContents/fake-{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._caches[name] = (list(parts), time.time() + ttl_seconds)
+        return name
+
+    def chat(self, context_parts, history, message, cache_name=None):
+        return "".join(self.chat_stream(context_parts, history, message, cache_name))
+
+    def chat_stream(self, context_parts, history, message, cache_name=None):
+        turns = [t for _, t in history] + [message]
+        if cache_name:
+            with self._lock:
+                cached = self._caches.get(cache_name)
+            if cached is None or cached[1] < time.time():
+                raise KeyError(f"Cache inexistente ou expirado no backend fake: {cache_name}")
+            # Contexto em cache não entra na contagem de tokens de entrada (como no provedor)
+            text = self._canned_text(turns)
+            yield from self._emit(text)
+            self.usage.add(self._input_tokens(turns), len(text) // CHARS_PER_TOKEN)
+            return
+        yield from self.stream(list(context_parts or []) + turns)
+
+# --- SELEÇÃO ---
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """Backend configurado por URBANO_LLM_BACKEND (uma instância por processo)."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                kind = os.environ.get("URBANO_LLM_BACKEND", "gemini")
+                if kind == 'fake':
+                    _backend = FakeBackend()
+                else:
+                    _backend = GeminiBackend(os.environ.get("URBANO_LLM_MODEL", DEFAULT_MODEL))
+    return _backend
@@ -0,0 +1,233 @@
+# --- ARQUIVO: pdf_tools.py ---
+# Pré-processamento local de PDFs antes do envio à IA.
+from pypdf import PdfReader, PdfWriter
+from io import BytesIO
+
+# Alterar qualquer regra abaixo muda o que a IA recebe: incremente a versão (entra na chave do cache de análises)
+PREP_VERSION = "t2"
+
+MIN_PAGE_CHARS = 200        # Abaixo disso a página é tratada como digitalizada/imagem
+TOKENS_PER_PDF_PAGE = 258   # Custo de imagem que o Gemini cobra por página de PDF, além do texto
+CHARS_PER_TOKEN = 4         # Estimativa para português
+EST_TEXT_CHARS_PER_PAGE = 3000  # Média de uma página de edital com texto (pré-checagem, sem extrair o texto)
+
+# Enxugamento de digitalizações
+SLIM_MAX_DPI = 150                      # Suficiente para a IA ler carimbos e tabelas escaneadas
+SLIM_JPEG_QUALITY = 70
+HEAVY_IMAGE_BYTES = 1024 * 1024         # Imagem embutida acima disso é considerada pesada
+HEAVY_IMAGE_DPI = 220
+
+def prep_tag(slim):
+    """Versão do pré-processamento usada nas chaves de cache (com ou sem enxugamento)."""
+    return f"{PREP_VERSION}-slim" if slim else PREP_VERSION
+
+def estimate_text_tokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+def split_text_layer(data, slim=False):
+    """
+    Separa as páginas de um PDF em texto (camada de texto utilizável) e digitalizadas.
+    Retorna dict com:
+      pages: total de páginas
+      text_pages: [(nº da página, texto)]
+      scanned_pages: [nº da página]
+      scanned_pdf: bytes de um PDF só com as páginas digitalizadas (ou None)
+    Com slim=True as páginas digitalizadas passam por slim_pdf antes de sair.
+    Retorna None se o PDF não puder ser lido (criptografado, corrompido...).
+    """
+    try:
+        reader = PdfReader(BytesIO(data))
+        if reader.is_encrypted:
+            return None
+        text_pages, scanned = [], []
+        for i, page in enumerate(reader.pages):
+            try:
+                txt = page.extract_text() or ""
+            except Exception:
+                txt = ""
+            if len(txt.strip()) >= MIN_PAGE_CHARS:
+                text_pages.append((i + 1, txt.strip()))
+            else:
+                scanned.append(i)
+
+        scanned_pdf = None
+        if scanned and text_pages:
+            writer = PdfWriter()
+            for i in scanned:
+                writer.add_page(reader.pages[i])
+            writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+            buf = BytesIO()
+            writer.write(buf)
+            scanned_pdf = buf.getvalue()
+        elif scanned:
+            scanned_pdf = data  # Nada aproveitável como texto: envia o original
+
+        if scanned_pdf is not None and slim:
+            scanned_pdf = slim_pdf(scanned_pdf)
+
+        return {
+            'pages': len(reader.pages),
+            'text_pages': text_pages,
+            'scanned_pages': [i + 1 for i in scanned],
+            'scanned_pdf': scanned_pdf
+        }
+    except Exception:
+        return None
+
+def _page_width_inches(page):
+    try:
+        return max(float(page.mediabox.width) / 72, 1.0)
+    except Exception:
+        return 8.27  # A4
+
+def _stream_size(obj):
+    """
+    Tamanho do stream da imagem: /Length quando o pypdf o mantém; senão get_data() (JPEG/JPEG2000/CCITT
+    voltam ainda codificados, com o tamanho real no arquivo; Flate volta descomprimido, superestimando).
+    """
+    length = obj.get("/Length")
+    if isinstance(length, int) and length > 0:
+        return int(length)
+    return len(obj.get_data() or b"")
+
+def _iter_page_images(page):
+    """(referência, largura px, altura px, bytes do stream) das imagens da página, sem decodificá-las."""
+    try:
+        xobjects = page["/Resources"]["/XObject"].get_object()
+    except Exception:
+        return
+    for name in xobjects:
+        ref = xobjects.raw_get(name)
+        try:
+            obj = ref.get_object()
+            if obj.get("/Subtype") != "/Image":
+                continue
+            yield (getattr(ref, "idnum", id(obj)), int(obj.get("/Width", 0)), int(obj.get("/Height", 0)),
+                   _stream_size(obj))
+        except Exception:
+            continue
+
+def _page_has_fonts(page):
+    try:
+        return bool(page["/Resources"].get("/Font"))
+    except Exception:
+        return False
+
+def inspect_pdf(data):
+    """
+    Pré-checagem barata (sem extrair texto nem decodificar imagens).
+    Retorna dict com pages, images (imagens distintas), image_bytes, heavy_images, encrypted e
+    scanned_pages / scanned_image_bytes (páginas sem fontes, que não terão camada de texto).
+    scanned_slim_bytes estima o tamanho dessas imagens depois do slim_pdf (reduzidas a SLIM_MAX_DPI).
+    Retorna None se o PDF não puder ser lido.
+    """
+    try:
+        reader = PdfReader(BytesIO(data))
+        if reader.is_encrypted:
+            return {'pages': 0, 'images': 0, 'image_bytes': 0, 'heavy_images': 0, 'encrypted': True,
+                    'scanned_pages': 0, 'scanned_image_bytes': 0, 'scanned_slim_bytes': 0}
+        seen, image_bytes, heavy, scanned, scanned_bytes, slim_bytes = set(), 0, 0, 0, 0, 0
+        for page in reader.pages:
+            width_in = _page_width_inches(page)
+            has_text = _page_has_fonts(page)
+            if not has_text: scanned += 1
+            for ref, w, _, size in _iter_page_images(page):
+                if not has_text:
+                    scanned_bytes += size
+                    # Os bytes caem com o quadrado da redução de resolução
+                    dpi = w / width_in
+                    slim_bytes += int(size * min(1.0, SLIM_MAX_DPI / dpi) ** 2) if dpi > 0 else size
+                if ref in seen:
+                    continue
+                seen.add(ref)
+                image_bytes += size
+                if size > HEAVY_IMAGE_BYTES or w / width_in > HEAVY_IMAGE_DPI:
+                    heavy += 1
+        return {'pages': len(reader.pages), 'images': len(seen), 'image_bytes': image_bytes,
+                'heavy_images': heavy, 'encrypted': False,
+                'scanned_pages': scanned, 'scanned_image_bytes': scanned_bytes,
+                'scanned_slim_bytes': slim_bytes}
+    except Exception:
+        return None
+
+def estimate_from_inspection(original_bytes, info, slim=False):
+    """
+    Mesmas chaves de estimate_savings, a partir de inspect_pdf (sem extrair texto nem enxugar imagens).
+    slim=True estima as páginas digitalizadas já reduzidas pelo slim_pdf.
+    PDF ilegível (info None ou criptografado) é estimado como enviado inteiro.
+    """
+    if not info or info['encrypted']:
+        pages = (info or {}).get('pages', 0)
+        return {'original_bytes': original_bytes, 'sent_bytes': original_bytes,
+                'original_tokens': pages * TOKENS_PER_PDF_PAGE, 'sent_tokens': pages * TOKENS_PER_PDF_PAGE,
+                'pages': pages, 'text_pages': 0, 'scanned_pages': pages}
+    text_pages = info['pages'] - info['scanned_pages']
+    text_chars = text_pages * EST_TEXT_CHARS_PER_PAGE
+    text_tokens = text_chars // CHARS_PER_TOKEN
+    scanned_bytes = info['scanned_image_bytes']
+    if slim:
+        scanned_bytes = info.get('scanned_slim_bytes', scanned_bytes)
+    return {
+        'original_bytes': original_bytes,
+        'sent_bytes': text_chars + (min(scanned_bytes, original_bytes) if info['scanned_pages'] else 0),
+        'original_tokens': info['pages'] * TOKENS_PER_PDF_PAGE + text_tokens,
+        'sent_tokens': text_tokens + info['scanned_pages'] * TOKENS_PER_PDF_PAGE,
+        'pages': info['pages'],
+        'text_pages': text_pages,
+        'scanned_pages': info['scanned_pages']
+    }
+
+def slim_pdf(data, max_dpi=SLIM_MAX_DPI, quality=SLIM_JPEG_QUALITY):
+    """
+    Reduz a resolução das imagens acima de max_dpi (recomprimindo em JPEG) e remove objetos duplicados.
+    Devolve o original se nada ficar menor ou se o PDF/imagem não puder ser processado.
+    """
+    try:
+        from PIL import Image
+        writer = PdfWriter(clone_from=PdfReader(BytesIO(data)))
+        done = set()
+        for page in writer.pages:
+            width_in = _page_width_inches(page)
+            for img in page.images:
+                ref = getattr(img.indirect_reference, "idnum", None)
+                if ref in done:
+                    continue
+                done.add(ref)
+                try:
+                    pil = img.image
+                    dpi = pil.width / width_in
+                    # Bitonais (fax/CCITT) já são compactas e piorariam em JPEG; transparência se perderia
+                    if dpi <= max_dpi or pil.mode in ("1", "RGBA", "LA", "P"):
+                        continue
+                    scale = max_dpi / dpi
+                    small = pil.resize((max(int(pil.width * scale), 1), max(int(pil.height * scale), 1)), Image.LANCZOS)
+                    if small.mode not in ("RGB", "L"):
+                        small = small.convert("RGB")
+                    img.replace(small, quality=quality)
+                except Exception:
+                    continue
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+        buf = BytesIO()
+        writer.write(buf)
+        out = buf.getvalue()
+        return out if len(out) < len(data) else data
+    except Exception:
+        return data
+
+def format_text_pages(name, text_pages):
+    """Texto compacto enviado à IA, com marcação de arquivo e página para citações."""
+    blocks = [f"=== ARQUIVO: {name} | PÁGINA {n} ===\n{txt}" for n, txt in text_pages]
+    return "\n\n".join(blocks)
+
+def estimate_savings(original_bytes, pages, text, scanned_pdf, scanned_pages):
+    """Bytes e tokens estimados: envio do PDF inteiro vs texto + páginas digitalizadas."""
+    text_tokens = estimate_text_tokens(text)
+    return {
+        'original_bytes': original_bytes,
+        'sent_bytes': len(text.encode('utf-8')) + (len(scanned_pdf) if scanned_pdf else 0),
+        'original_tokens': pages * TOKENS_PER_PDF_PAGE + text_tokens,
+        'sent_tokens': text_tokens + len(scanned_pages) * TOKENS_PER_PDF_PAGE,
+        'pages': pages,
+        'text_pages': pages - len(scanned_pages),
+        'scanned_pages': len(scanned_pages)
+    }
@@ -0,0 +1,92 @@
+# --- ARQUIVO: retrieval.py ---
+# Índice de busca local (BM25) de cada edital, em trechos com referência de arquivo e página.
+# Criado na análise e gravado no Storage; no chat só os trechos mais relevantes vão para a IA.
+import company_index
+import gzip
+import json
+import math
+import re
+from collections import Counter
+
+INDEX_VERSION = "r1"
+
+CHUNK_CHARS = 1200     # Tamanho alvo de cada trecho
+CHUNK_OVERLAP = 200    # Sobreposição para não cortar uma cláusula entre dois trechos
+TOP_K = 6
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_PAGE_HEADER = re.compile(r"^=== ARQUIVO: (.*?) \| PÁGINA (\d+) ===$", re.MULTILINE)
+
+def terms(text):
+    # Radical curto para juntar flexões ("garantia"/"garantias", "prazo"/"prazos")
+    return [t[:7] for t in company_index.tokenize(text)]
+
+def pages_from_formatted(text):
+    """Inverso de pdf_tools.format_text_pages: [(arquivo, nº da página, texto)]."""
+    marks = list(_PAGE_HEADER.finditer(text))
+    out = []
+    for i, m in enumerate(marks):
+        end = marks[i + 1].start() if i + 1 < len(marks) else len(text)
+        out.append((m.group(1), int(m.group(2)), text[m.end():end].strip()))
+    return out
+
+def chunk_pages(pages):
+    """Divide cada página em trechos de ~CHUNK_CHARS, quebrando em parágrafo/linha quando possível."""
+    chunks = []
+    for name, page, text in pages:
+        start = 0
+        while start < len(text):
+            end = min(start + CHUNK_CHARS, len(text))
+            if end < len(text):
+                cut = max(text.rfind("\n\n", start, end), text.rfind("\n", start, end))
+                if cut > start + CHUNK_CHARS // 2: end = cut
+            piece = text[start:end].strip()
+            if piece:
+                chunks.append({'file': name, 'page': page, 'text': piece})
+            if end >= len(text): break
+            start = max(end - CHUNK_OVERLAP, start + 1)
+    return chunks
+
+def build_index(chunks):
+    """Índice BM25 pronto para uso: termos de cada trecho já contados (carregar não exige retokenizar)."""
+    tfs = [dict(Counter(terms(c['text']))) for c in chunks]
+    lengths = [sum(tf.values()) for tf in tfs]
+    df = Counter(t for tf in tfs for t in tf)
+    return {
+        'version': INDEX_VERSION,
+        'chunks': chunks,
+        'tf': tfs,
+        'df': dict(df),
+        'avgdl': (sum(lengths) / len(lengths)) if lengths else 0.0,
+        'lengths': lengths,
+    }
+
+def dumps(index):
+    return gzip.compress(json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+def loads(data):
+    index = json.loads(gzip.decompress(data))
+    return index if index.get('version') == INDEX_VERSION else None
+
+def search(index, query, k=TOP_K):
+    """Os k trechos mais relevantes para a pergunta: [(pontuação, trecho)]."""
+    q = set(terms(query))
+    if not q or not index or not index['chunks']: return []
+    n = len(index['chunks'])
+    avgdl = index['avgdl'] or 1.0
+    idf = {t: math.log(1 + (n - index['df'].get(t, 0) + 0.5) / (index['df'].get(t, 0) + 0.5)) for t in q}
+    scored = []
+    for chunk, tf, dl in zip(index['chunks'], index['tf'], index['lengths']):
+        score = 0.0
+        for t in q:
+            f = tf.get(t)
+            if f:
+                score += idf[t] * f * (BM25_K1 + 1) / (f + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+        if score > 0:
+            scored.append((score, chunk))
+    scored.sort(key=lambda x: -x[0])
+    return scored[:k]
+
+def format_results(results):
+    return "\n\n".join(f"--- {c['file']} | PÁGINA {c['page']} ---\n{c['text']}" for _, c in results)
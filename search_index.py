@@ -0,0 +1,235 @@
+# --- ARQUIVO: search_index.py ---
+# Busca textual na biblioteca de análises: índice invertido local (SQLite) por usuário, sobre título, órgão,
+# objeto e texto de cada análise. Atualizado a cada gravação/exclusão no histórico (gancho do database.py).
+# A coleção é lida inteira na primeira busca do usuário neste servidor e a cada REBUILD_SECONDS; entre uma e
+# outra, cada busca traz do Firestore os itens criados depois da última leitura (gravados por outra réplica
+# ou por um worker.py em outra máquina).
+import database as db
+import company_index
+import datetime
+import sqlite3
+import threading
+import math
+import time
+import os
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+DB_PATH = os.path.join(db.LOCAL_DATA_DIR, "search.sqlite3")
+INDEX_VERSION = "s1"   # Incremente ao mudar a tokenização ou os campos: os índices são refeitos
+
+FIELD_WEIGHTS = {'title': 3.0, 'orgao': 3.0, 'objeto': 2.0, 'content': 1.0}
+STEM_CHARS = 7         # Radical: "pavimentação"/"pavimentada" -> "pavimen"
+MAX_RESULTS = 30
+BM25_K1 = 1.2
+BM25_B = 0.75
+SYNC_SECONDS = 10             # Intervalo mínimo entre sincronizações incrementais do mesmo usuário
+REBUILD_SECONDS = 6 * 60 * 60 # Releitura completa: alterações e exclusões feitas fora deste servidor
+
+# Plural -> singular (texto já sem acentos)
+_PLURALS = [("coes", "cao"), ("soes", "sao"), ("oes", "ao"), ("aes", "ao"), ("ais", "al"), ("eis", "el"),
+            ("ois", "ol"), ("ns", "m"), ("res", "r"), ("zes", "z"), ("s", "")]
+
+_init_lock = threading.Lock()
+_initialized = False
+_user_locks = {}      # username -> Lock: uma leitura do Firestore (rebuild/sync) por usuário por vez
+_pending = {}         # username -> eventos do gancho recebidos durante essa leitura (aplicados depois dela)
+_pending_lock = threading.Lock()
+_last_sync = {}       # username -> time.time() da última sincronização incremental
+
+def stem(token):
+    if any(c.isdigit() for c in token): return token  # Números, CNPJs e códigos: só busca exata
+    for suffix, repl in _PLURALS:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            token = token[:-len(suffix)] + repl
+            break
+    return token[:STEM_CHARS]
+
+def terms(text):
+    """Termos pesquisáveis: minúsculas, sem acentos e sem stopwords, reduzidos ao radical."""
+    return [stem(t) for t in company_index.tokenize(text or "")]
+
+# --- BANCO LOCAL ---
+
+def _connect():
+    global _initialized
+    if not _initialized:
+        os.makedirs(db.LOCAL_DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, built_at REAL)")
+                # Maior created_at lido do Firestore: a sincronização busca só o que veio depois
+                conn.execute("CREATE TABLE IF NOT EXISTS synced (username TEXT PRIMARY KEY, until REAL)")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS docs (
+                        username TEXT, doc_id TEXT, created_at REAL, length REAL DEFAULT 0,
+                        PRIMARY KEY (username, doc_id)
+                    ) WITHOUT ROWID""")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS postings (
+                        username TEXT, term TEXT, doc_id TEXT, field TEXT, tf INTEGER,
+                        PRIMARY KEY (username, term, doc_id, field)
+                    ) WITHOUT ROWID""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_postings_doc ON postings (username, doc_id, field)")
+                row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+                if not row or row[0] != INDEX_VERSION:
+                    for table in ("users", "synced", "docs", "postings"):
+                        conn.execute(f"DELETE FROM {table}")
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (INDEX_VERSION,))
+                _initialized = True
+    return conn
+
+@contextmanager
+def _db():
+    conn = _connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+@contextmanager
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _is_built(conn, username):
+    return conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone() is not None
+
+def _timestamp(value):
+    return value.timestamp() if hasattr(value, 'timestamp') else None
+
+def _delete_doc(conn, username, doc_id):
+    conn.execute("DELETE FROM postings WHERE username = ? AND doc_id = ?", (username, doc_id))
+    conn.execute("DELETE FROM docs WHERE username = ? AND doc_id = ?", (username, doc_id))
+
+def _index_fields(conn, username, doc_id, fields):
+    """Reindexa só os campos pesquisáveis presentes em fields (os demais do item ficam como estão)."""
+    present = [f for f in FIELD_WEIGHTS if f in fields]
+    if not present: return
+    conn.execute("INSERT OR IGNORE INTO docs (username, doc_id, created_at) VALUES (?, ?, ?)",
+                 (username, doc_id, _timestamp(fields.get('created_at'))))
+    for field in present:
+        conn.execute("DELETE FROM postings WHERE username = ? AND doc_id = ? AND field = ?", (username, doc_id, field))
+        counts = Counter(terms(fields[field]))
+        conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?, ?)",
+                         [(username, t, doc_id, field, c) for t, c in counts.items()])
+    rows = conn.execute("SELECT field, SUM(tf) FROM postings WHERE username = ? AND doc_id = ? GROUP BY field",
+                        (username, doc_id)).fetchall()
+    length = sum(FIELD_WEIGHTS[f] * n for f, n in rows)
+    conn.execute("UPDATE docs SET length = ? WHERE username = ? AND doc_id = ?", (length, username, doc_id))
+
+# --- ATUALIZAÇÃO ---
+
+def _apply_event(conn, username, doc_id, fields):
+    if fields is None: _delete_doc(conn, username, doc_id)
+    else: _index_fields(conn, username, doc_id, fields)
+
+def on_history_change(username, doc_id, fields):
+    """Gancho do database.py: fields = campos gravados no item, ou None se ele foi excluído."""
+    with _pending_lock:
+        if username in _pending:  # Leitura do Firestore em andamento: aplicado junto com ela
+            _pending[username].append((doc_id, fields))
+            return
+    with _db() as conn:
+        with _transaction(conn):
+            # Checado dentro da transação: uma leitura que termina agora já terá marcado o usuário
+            if not _is_built(conn, username): return  # A primeira busca indexa a coleção inteira
+            _apply_event(conn, username, doc_id, fields)
+
+def _user_lock(username):
+    with _pending_lock:
+        return _user_locks.setdefault(username, threading.Lock())
+
+def _read_and_index(username, since=None):
+    """
+    Lê do Firestore os itens do usuário (todos, ou só os criados depois de since) e os indexa.
+    Eventos do gancho que chegam durante a leitura ficam em _pending e são aplicados por cima dela, na mesma
+    transação; os que chegam depois esperam a transação terminar. Retorna False se a leitura falhar.
+    """
+    full = since is None
+    with _user_lock(username):
+        with _pending_lock: _pending[username] = []
+        try:
+            items = db.get_user_history_texts(username, since=None if full else
+                                              datetime.datetime.fromtimestamp(since, datetime.timezone.utc))
+        except Exception:
+            items = None
+        with _db() as conn:
+            with _transaction(conn):
+                with _pending_lock: events = _pending.pop(username, [])
+                if items is not None:
+                    if full:
+                        conn.execute("DELETE FROM postings WHERE username = ?", (username,))
+                        conn.execute("DELETE FROM docs WHERE username = ?", (username,))
+                        conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?)", (username, time.time()))
+                    for item in items:
+                        _index_fields(conn, username, item['id'], item)
+                    newest = max([_timestamp(i.get('created_at')) or 0 for i in items] + [since or 0])
+                    conn.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (username, newest))
+                if _is_built(conn, username):
+                    for doc_id, fields in events:
+                        _apply_event(conn, username, doc_id, fields)
+    _last_sync[username] = time.time()
+    return items is not None
+
+def rebuild(username):
+    """Indexa todo o histórico do usuário a partir do Firestore. Retorna False se a leitura falhar."""
+    return _read_and_index(username)
+
+def ensure_built(username):
+    """Índice pronto e em dia: leitura completa na primeira vez ou se estiver velho, senão só os itens novos."""
+    with _db() as conn:
+        row = conn.execute("SELECT built_at FROM users WHERE username = ?", (username,)).fetchone()
+        synced = conn.execute("SELECT until FROM synced WHERE username = ?", (username,)).fetchone()
+    if row is None or time.time() - row[0] > REBUILD_SECONDS:
+        return rebuild(username)
+    if time.time() - _last_sync.get(username, 0) >= SYNC_SECONDS:
+        _read_and_index(username, since=synced[0] if synced else 0)  # Falha: busca no índice como está
+    return True
+
+db.register_history_hook(on_history_change)
+
+# --- BUSCA ---
+
+def search(username, query, limit=MAX_RESULTS):
+    """
+    Ids dos itens que contêm todos os termos da busca, do mais relevante ao menos (BM25 com peso por campo).
+    Termos curtos também valem como prefixo ("pav" encontra "pavimentação").
+    """
+    query_terms = list(dict.fromkeys(terms(query)))
+    if not query_terms or not ensure_built(username): return []
+    with _db() as conn:
+        docs = {d: (length, created) for d, length, created in
+                conn.execute("SELECT doc_id, length, created_at FROM docs WHERE username = ?", (username,))}
+        if not docs: return []
+        n = len(docs)
+        avgdl = (sum(length for length, _ in docs.values()) / n) or 1.0
+        scores = None
+        for term in query_terms:
+            if len(term) < STEM_CHARS:
+                rows = conn.execute("SELECT doc_id, field, tf FROM postings WHERE username = ? AND term >= ? AND term < ?",
+                                    (username, term, term + "\uffff"))
+            else:
+                rows = conn.execute("SELECT doc_id, field, tf FROM postings WHERE username = ? AND term = ?", (username, term))
+            weighted = defaultdict(float)
+            for doc_id, field, tf in rows:
+                weighted[doc_id] += FIELD_WEIGHTS[field] * tf
+            if not weighted: return []
+            idf = math.log(1 + (n - len(weighted) + 0.5) / (len(weighted) + 0.5))
+            term_scores = {}
+            for doc_id, w in weighted.items():
+                dl = docs.get(doc_id, (avgdl, None))[0]
+                term_scores[doc_id] = idf * w * (BM25_K1 + 1) / (w + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+            scores = term_scores if scores is None else {d: scores[d] + s for d, s in term_scores.items() if d in scores}
+            if not scores: return []
+    ranked = sorted(scores, key=lambda d: (-scores[d], -(docs.get(d, (0, 0))[1] or 0)))
+    return ranked[:limit]
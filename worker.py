@@ -0,0 +1,42 @@
+# --- ARQUIVO: worker.py ---
+# Atende a fila de jobs (jobs.py) em um processo separado do Streamlit.
+# Uso: URBANO_EXTERNAL_WORKERS=1 no app e, em outro terminal: python worker.py [n_workers]
+import toml
+import sys
+import time
+from unittest.mock import MagicMock
+
+# --- 1. CONFIGURAÇÃO DO AMBIENTE (MOCK) ---
+# Igual ao scheduler_local.py: o database.py espera encontrar 'st.secrets'.
+print("🔧 Lendo arquivo de segredos local (.streamlit/secrets.toml)...")
+
+try:
+    local_secrets = toml.load(".streamlit/secrets.toml")
+    mock_st = MagicMock()
+    mock_st.secrets = local_secrets
+    sys.modules["streamlit"] = mock_st
+    print("✅ Segredos carregados com sucesso.")
+except Exception as e:
+    print(f"❌ Erro ao ler secrets.toml: {e}")
+    exit(1)
+
+# --- 2. IMPORTAÇÕES (DEPOIS DO MOCK) ---
+import google.generativeai as genai
+import jobs
+import ia  # Registra os handlers dos jobs
+import search_index  # Mantém o índice de busca atualizado com o que os jobs gravam
+
+if "GOOGLE_API_KEY" in local_secrets:
+    genai.configure(api_key=local_secrets["GOOGLE_API_KEY"])
+
+# --- 3. EXECUÇÃO ---
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else jobs.WORKERS
+    print(f"\n🚀 {n} worker(s) atendendo a fila em {jobs.DB_PATH}")
+    stop = jobs.start_workers(n)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        print("🏁 Workers encerrados.")